@@ -4,68 +4,43 @@ from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 # the above is so that I can test this code in isolation
 
-from llama_index.readers.notion import NotionPageReader
 import os
 from dotenv import load_dotenv
-from notion_client import Client
-import requests
+from src import config
+from src.core.structured_logging import setup_logging
+from src.services.notion_crawler import NotionCrawler
+from src.services.notion_sync_state import NotionSyncState
 # import shutil
 
 load_dotenv()
+setup_logging()  # the crawler logs what it fetched and downloaded
 
 NOTION_TOKEN = os.getenv("NOTION_TOKEN")
-notion = Client(auth=NOTION_TOKEN)
+# one pooled HTTP session + rate limit shared by the crawl and the downloads
+crawler = NotionCrawler(NOTION_TOKEN)
+# what the previous run of this script saw, so only edited pages are fetched and only changed files downloaded.
+# It has its own file: embed_documents.py keeps notion_sync.db to know what it still has to re-embed, and a
+# crawl saved there by this script would mark edits as synced before they were embedded
+notion_state = NotionSyncState(config.repo_path("data/interim/notion_download_sync.db"))
 
 
-# function to fetch blocks
+# function to fetch blocks: the whole tree under the page (child blocks and child pages), fetched concurrently.
+# Pages that weren't edited since the last run come from notion_state instead of Notion
 def get_blocks(PAGE_ID: str):
-    blocks = []
-    cursor = None
-    while True:
-        response = notion.blocks.children.list(block_id=PAGE_ID, start_cursor=cursor)
-        blocks.extend(response["results"])
-        cursor = response.get("next_cursor")
-        if not response.get("has_more"):
-            break
-    return blocks
+    return crawler.crawl_incremental(PAGE_ID, notion_state)
 
 
-# Function to Download PDFs from the Blocks
-def download_pdfs_from_blocks(blocks, save_folder="../data/raw"):
-    os.makedirs(save_folder, exist_ok=True)
-    downloaded_paths = []
+# Function to Download PDFs from the Blocks. They're streamed to disk in chunks and stored once per content hash,
+# files that are already there (same last_edited_time or same ETag/size) are not downloaded again
+def download_pdfs_from_blocks(blocks, save_folder=config.repo_path("data/raw")):
+    return list(crawler.download_pdfs(blocks, save_folder, state=notion_state).values())
 
-    for block in blocks:
-        if block["type"] == "file":
-            file_info = block["file"]
-            url = None
-            if file_info["type"] == "external":
-                url = file_info["external"]["url"]
-            elif file_info["type"] == "file":
-                url = file_info["file"]["url"]
 
-            if url and ".pdf" in url:
-                file_name = f"{block['id']}.pdf"
-                file_path = os.path.join(save_folder, file_name)
-                print(f"Downloading: {url}")
-                with open(file_path, "wb") as f:
-                    f.write(requests.get(url).content)
-                downloaded_paths.append(file_path)
-
-    return downloaded_paths
-
-
-# Load Notion page text (optional)
-reader = NotionPageReader(integration_token=NOTION_TOKEN)
-docs = reader.load_data(["1cdb82a32896804e8282efc96fed1712"])
-
-# for doc in docs:
-#     print("✅ Title:", doc.metadata.get("title"))
-#     print("📄 Text preview:", doc.text[:300], "...\n")
-
-# Load PDFs from the same page
+# Load PDFs from the Notion page
 PAGE_ID = os.getenv("NOTION_PAGE_ID")
-blocks = get_blocks(PAGE_ID)
+crawl = get_blocks(PAGE_ID)
+blocks = crawl["blocks"]
+print(f"🔄 {len(crawl['changed'])} new/edited block(s), {len(crawl['removed'])} removed")
 for block in blocks:
     print("🔍 Block type:", block.get("type"))
     if block.get("type") == "file":
@@ -73,6 +48,7 @@ for block in blocks:
 pdf_paths = download_pdfs_from_blocks(blocks)
 
 print("Pdfs downloaded:", pdf_paths)
+notion_state.save_crawl(PAGE_ID, crawl)
 
 
 # Optional: clean up this deletes the temporary file created
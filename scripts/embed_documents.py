@@ -1,21 +1,47 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+# the above is so that I can use the src package from this script
+
 import os
 import json
-import hashlib
+import argparse
 import datetime
 from dotenv import load_dotenv
-from typing import List
+from typing import Iterator
 
-from llama_index.core import (
-    SimpleDirectoryReader,
-    VectorStoreIndex,
-    StorageContext,
-    Document,
-)
+from llama_index.core import SimpleDirectoryReader, Document
 from llama_index.readers.notion import NotionPageReader
-from llama_index.vector_stores.pinecone import PineconeVectorStore
 from llama_index.core.node_parser import SentenceSplitter
-from llama_index.embeddings.openai import OpenAIEmbedding
-from pinecone import Pinecone, ServerlessSpec
+
+from src import config
+from src.core.structured_logging import setup_logging
+from src.services import vector_store
+from src.services.embedding import get_embeddings, EMBEDDING_MODEL
+from src.services.ingestion import Stage, run_pipeline
+from src.services.sync_manifest import SyncManifest, generate_chunk_ids, get_doc_hash
+from src.services.notion_crawler import NotionCrawler
+from src.services.notion_sync_state import NotionSyncState
+
+# ================================
+# ⚙️ Command line options
+# ================================
+arg_parser = argparse.ArgumentParser(description="Sync the Notion page and ../data/raw into the vector index")
+arg_parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    help="Only show what would be embedded, upserted and deleted. Nothing is sent or saved.",
+)
+arg_parser.add_argument(
+    "--full",
+    action="store_true",
+    help="Read the whole Notion page again, even if nothing was edited since the last sync.",
+)
+args = arg_parser.parse_args()
+setup_logging()  # pipeline progress and Notion crawl summaries are logged
+DRY_RUN = args.dry_run
+FULL_SYNC = args.full
 
 # ================================
 # 🔐 Load environment variables
@@ -32,223 +58,284 @@ PINECONE_ENV = os.getenv("PINECONE_ENVIRONMENT")
 # ================================
 INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
 CHUNK_DIM = 1536
-# EMBEDDING_MODEL = "text-embedding-3-small"
-CACHE_PATH = "../data/document_cache.json"
-embedding_model = OpenAIEmbedding(model="text-embedding-3-small")
+# The manifest replaces the old ../data/document_cache.json (which is imported once if it's still there)
+MANIFEST_PATH = config.repo_path("data/interim/sync_manifest.db")
+LEGACY_CACHE_PATH = config.repo_path("data/document_cache.json")
+# last_edited_time of every Notion block seen in the last sync, to skip the Notion page when nothing changed
+NOTION_STATE_PATH = config.repo_path("data/interim/notion_sync.db")
 
-
-# ================================
-# 💾 Load or create doc cache: creates a JSON file that tracks all embeddings created
-# ================================
-if os.path.exists(CACHE_PATH):
-    with open(CACHE_PATH, "r") as f:
-        doc_hash_cache = json.load(f)
-else:
-    doc_hash_cache = {}
-
-
-def get_doc_hash(text: str) -> str:
-    """Generate a hash of the document text for change detection."""
-    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+# 🏭 Pipeline sizes: how many chunks per embedding call / per upsert, how many embedding calls at once,
+# and how many items can wait between two stages (this is what keeps memory flat)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "4"))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "100"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "256"))
 
 
 def generate_doc_id(doc: Document) -> str:
-    """Create a unique ID for each document based on source."""
+    """Create a stable ID for each document based on source. It doesn't change when the document is edited."""
     source = doc.metadata.get("source", "unknown")
     identifier = (
-        doc.metadata.get("title", "")
+        doc.metadata.get("page_id", doc.metadata.get("title", ""))
         if source == "notion"
         else doc.metadata.get("file", "unknown")
     )
-    return f"{source}::{identifier[:40]}::{get_doc_hash(doc.text)}"
+    return f"{source}::{identifier}"
 
 
 # ================================
-# 🧠 Initialize Pinecone
+# 🧠 Initialize Pinecone (not needed for a dry run or for VECTOR_BACKEND=local)
 # ================================
-pc = Pinecone(api_key=PINECONE_API_KEY)
-if INDEX_NAME not in [idx["name"] for idx in pc.list_indexes()]:
-    print(f"Creating Pinecone index: {INDEX_NAME}")
-    pc.create_index(
-        name=INDEX_NAME,
-        dimension=CHUNK_DIM,
-        metric="cosine",
-        spec=ServerlessSpec(cloud="aws", region="us-east-1"),
+# Upserts and deletes go through services/vector_store, like the rest of the app, so VECTOR_BACKEND decides
+# where the knowledge base ends up. Here we only make sure the Pinecone index exists.
+if not DRY_RUN and config.VECTOR_BACKEND == "pinecone":
+    from pinecone import Pinecone, ServerlessSpec
+
+    pc = Pinecone(api_key=PINECONE_API_KEY)
+    if INDEX_NAME not in [idx["name"] for idx in pc.list_indexes()]:
+        print(f"Creating Pinecone index: {INDEX_NAME}")
+        pc.create_index(
+            name=INDEX_NAME,
+            dimension=CHUNK_DIM,
+            metric="cosine",
+            spec=ServerlessSpec(cloud="aws", region="us-east-1"),
+        )
+
+    stats = pc.Index(INDEX_NAME).describe_index_stats()
+    print(
+        f"📊 Pinecone Index '{INDEX_NAME}' now contains {stats['total_vector_count']} vectors."
     )
 
 
-pinecone_index = pc.Index(INDEX_NAME)
-
-stats = pinecone_index.describe_index_stats()
-print(
-    f"📊 Pinecone Index '{INDEX_NAME}' now contains {stats['total_vector_count']} vectors."
-)
-
-vector_store = PineconeVectorStore(pinecone_index=pinecone_index)
-storage_context = StorageContext.from_defaults(vector_store=vector_store)
+# ================================
+# 📒 Open the sync manifest
+# ================================
+manifest = SyncManifest(MANIFEST_PATH)
+
+# Docs from the old JSON cache. Entries written before the chunk-level format only have a doc hash and an
+# old style doc ID, so their vectors are removed by doc_id filter and the docs are embedded again.
+legacy_doc_ids = []
+if os.path.exists(LEGACY_CACHE_PATH):
+    with open(LEGACY_CACHE_PATH, "r") as f:
+        legacy_cache = json.load(f)
+    for doc_id, entry in legacy_cache.items():
+        if DRY_RUN:
+            continue
+        if isinstance(entry, dict):
+            chunks = entry.get("chunks", {})
+            manifest.plan_doc(doc_id, entry["hash"], EMBEDDING_MODEL, chunks, set(chunks))
+            manifest.mark_upserted(list(chunks))
+        else:
+            legacy_doc_ids.append(doc_id)
+    if DRY_RUN:
+        print(f"📒 {len(legacy_cache)} doc(s) in {LEGACY_CACHE_PATH} would be imported into the manifest.")
+    else:
+        print(f"📒 Imported {len(legacy_cache)} doc(s) from {LEGACY_CACHE_PATH} into the manifest.")
 
 
 # ================================
-# 📥 Load documents
+# 📥 Load documents (one at a time)
 # ================================
-all_docs: List[Document] = []
+# Documents are yielded one by one instead of collected in a list, so only the documents that are being
+# processed right now are in memory.
+local_path = config.repo_path("data/raw")
+
+
+notion_state = NotionSyncState(NOTION_STATE_PATH)
+notion_crawl = None
+
+
+# NotionPageReader reads the whole page (every block, every time), so first a cheap incremental crawl checks
+# whether anything was edited. If not, the Notion docs of the last sync are kept as they are
+def load_notion_docs() -> Iterator[Document]:
+    global notion_crawl
+    notion_crawl = NotionCrawler(NOTION_TOKEN).crawl_incremental(PAGE_ID, notion_state, force=FULL_SYNC)
+    synced_notion_docs = {doc_id for doc_id in manifest.doc_ids() if doc_id.startswith("notion::")}
+    if synced_notion_docs and not notion_crawl["changed"] and not notion_crawl["removed"]:
+        print(f" => Notion page not edited since the last sync, skipping {len(synced_notion_docs)} doc(s)")
+        current_doc_ids.update(synced_notion_docs)
+        return
+
+    notion_reader = NotionPageReader(integration_token=NOTION_TOKEN)
+    for doc in notion_reader.load_data(page_ids=[PAGE_ID]):
+        doc.metadata = {
+            "source": "notion",
+            "page_id": doc.metadata.get("page_id", doc.id_),
+            "title": doc.metadata.get("title", "Untitled"),
+            "synced_at": str(datetime.datetime.now()),
+        }
+        yield doc
 
-# Load Notion docs
-notion_reader = NotionPageReader(integration_token=NOTION_TOKEN)
-notion_docs = notion_reader.load_data(page_ids=[PAGE_ID])
-for doc in notion_docs:
-    doc.metadata = {
-        "source": "notion",
-        "title": doc.metadata.get("title", "Untitled"),
-        "synced_at": str(datetime.datetime.now()),
-    }
-all_docs.extend(notion_docs)
 
 # ================================
 # 📥 Load local Markdown / PDFs
 # ================================
-local_docs = []
-
-local_path = "../data/raw"
-if os.path.exists(local_path) and os.listdir(local_path):
+def load_local_docs() -> Iterator[Document]:
+    if not (os.path.exists(local_path) and os.listdir(local_path)):
+        print("../data/raw directroy does not exist.")
+        return
     try:
-        local_docs = SimpleDirectoryReader(input_dir="../data/raw").load_data()
-        for doc in local_docs:
+        reader = SimpleDirectoryReader(input_dir=local_path)
+    except ValueError:
+        print("No documents found in ../data/raw. Skipping local embedding.")
+        return
+    # iter_data reads one file at a time (a big PDF collection never has to fit in memory)
+    for file_docs in reader.iter_data():
+        for doc in file_docs:
             doc.metadata = {
                 "source": "local",
                 "file": doc.metadata.get("file_name", "unknown"),
                 "type": "reference",
             }
-        print(f"Loaded {len(local_docs)} local document(s).")
-    except ValueError:
-        print("No documents found in ../data/raw. Skipping local embedding.")
-else:
-    print("../data/raw directroy does not exist.")
+            yield doc
+
+
+def load_all_docs() -> Iterator[Document]:
+    yield from load_notion_docs()
+    yield from load_local_docs()
 
 
 # ================================
-# 🧠 Combine with Notion docs
+# 🧠 Pipeline stages
 # ================================
-all_docs.extend(local_docs)
+# load -> filter (skip empty / unchanged docs) -> chunk (keep only new chunks) -> embed -> upsert,
+# all running at the same time
+parser = SentenceSplitter(chunk_size=512, chunk_overlap=100)
+current_doc_ids = set()
+# what a dry run would do, per doc
+plan = {"new_docs": 0, "changed_docs": 0, "chunks_to_embed": 0, "chunks_to_delete": 0}
 
-# ✅ Remove empty documents (blank Notion pages, failed loads, etc.)
-all_docs = [doc for doc in all_docs if doc.text.strip() != ""]
-print(f"✅ {len(all_docs)} non-empty documents retained for syncing.")
 
+# ✅ Remove empty documents (blank Notion pages, failed loads, etc.) and skip the ones that are fully synced.
+# A doc that was only half synced when the last run crashed is not skipped, so the run resumes it
+def filter_stage(doc: Document):
+    if doc.text.strip() == "":
+        return []
 
-# ================================
-# 🧼 Remove deleted document vectors
-# ================================
+    doc_id = generate_doc_id(doc)
+    current_hash = get_doc_hash(doc.text)
+    current_doc_ids.add(doc_id)
 
-# Detect deleted documents
-current_doc_ids = {generate_doc_id(doc) for doc in all_docs}
-print(f"\n📂 Total current_docs: {len(current_doc_ids)}")
-# this is all the doc IDs from the last run (based on cache)
-previous_doc_ids = set(doc_hash_cache.keys())
-print(f"🗃️  Total previous_docs: {len(previous_doc_ids)}")
-# Everything that’s missing now but existed before
-deleted_doc_ids = previous_doc_ids - current_doc_ids
-print(f"🗑️  Marked for deletion: {len(deleted_doc_ids)}")
-
-# Remove deleted docs from Pinecone and cache
-if deleted_doc_ids:
-    print(
-        f"🗑️ Removing {len(deleted_doc_ids)} outdated vectors from Pinecone using filters..."
-    )
-    for doc_id in deleted_doc_ids:
-        print("   → Deleting doc_id:", doc_id)
-        pinecone_index.delete(filter={"doc_id": {"$in": list(deleted_doc_ids)}})
-        del doc_hash_cache[doc_id]
+    if manifest.is_doc_synced(doc_id, current_hash):
+        print(f" => Skiping unchanged doc: {doc_id}")
+        return []
 
+    print(f"Checking new or changed doc: {doc_id}")
+    doc.metadata["doc_id"] = doc_id
+    doc.metadata["doc_hash"] = current_hash
+    return [doc]
 
-# ================================
-# 🧠 Filter changed documents only
-# ================================
-# ------------------------------------------------------------------------------------
-# docs_to_embed = []
 
-# for doc in all_docs:
-#     doc_id = generate_doc_id(doc)
-#     current_hash = get_doc_hash(doc.text)
+# ✅ Chunk the doc and only pass on the chunks that aren't in the index yet (with the current model).
+# The plan for the doc is saved in the manifest before anything is embedded
+def chunk_stage(doc: Document):
+    doc_id = doc.metadata.pop("doc_id")
+    doc_hash = doc.metadata.pop("doc_hash")
+    nodes = parser.get_nodes_from_documents([doc])
+    chunk_ids = generate_chunk_ids(doc_id, [node.text for node in nodes])
+    chunks = {chunk_id: get_doc_hash(node.text) for chunk_id, node in zip(chunk_ids, nodes)}
+
+    to_embed, removed = manifest.diff_doc(doc_id, EMBEDDING_MODEL, chunks)
+    new_nodes = []
+    for i, (node, chunk_id) in enumerate(zip(nodes, chunk_ids)):
+        if chunk_id not in to_embed:
+            continue
+        node.metadata["doc_id"] = doc_id
+        node.metadata["chunk_id"] = chunk_id
+        node.metadata["chunk_index"] = i
+        # the API puts the text of the retrieved chunks in the prompt, so it travels with the vector
+        node.metadata["text"] = node.text
+        new_nodes.append(node)
 
-#     if doc_id in doc_hash_cache and doc_hash_cache[doc_id] == current_hash:
-#         print(f" => Skipping unchanged doc: {doc_id}")
-#         continue
+    print(
+        f"   {doc_id}: {len(new_nodes)} new/changed chunk(s), {len(nodes) - len(new_nodes)} unchanged, "
+        f"{len(removed)} removed"
+    )
+    plan["changed_docs" if manifest.has_doc(doc_id) else "new_docs"] += 1
+    plan["chunks_to_embed"] += len(new_nodes)
+    plan["chunks_to_delete"] += len(removed)
 
-#     print(f"Embedding new or changed doc: {doc_id}")
-#     doc_hash_cache[doc_id] = current_hash
-#     docs_to_embed.append(doc)
+    if DRY_RUN:
+        return []
+    manifest.plan_doc(doc_id, doc_hash, EMBEDDING_MODEL, chunks, to_embed)
+    return new_nodes
 
 
-# -----------THE ABOVE WAS REPLACED WITH THE BELOW-------------------------------------------------------------------------
-parser = SentenceSplitter(chunk_size=512, chunk_overlap=100)
-all_nodes = []
+# Embeds a batch of chunks, several of these run in parallel (EMBED_WORKERS). get_embeddings skips the chunks
+# already in the embedding cache and packs the rest into as few API calls as it can.
+def embed_stage(nodes: list):
+    embeddings = get_embeddings([node.text for node in nodes])
+    # (id, embedding, metadata) tuples, the format of vector_store.upsert_embeddings
+    return [(node.metadata["chunk_id"], emb, node.metadata) for node, emb in zip(nodes, embeddings)]
 
-for doc in all_docs:
-    doc_id = generate_doc_id(doc)
-    current_hash = get_doc_hash(doc.text)
 
-    if doc_id in doc_hash_cache and doc_hash_cache[doc_id] == current_hash:
-        print(f" => Skiping unchanged doc: {doc_id}")
-        continue
+# 💾 Every upsert batch is checkpointed in the manifest, so a crash never loses embeddings already paid for
+def upsert_stage(vectors: list):
+    vector_store.upsert_embeddings(vectors)
+    manifest.mark_upserted([chunk_id for chunk_id, _, _ in vectors])
+    return []
 
-    print(f"Embedding new or changed doc: {doc_id}")
-    doc_hash_cache[doc_id] = current_hash
 
-    # ✅ Chunk and tag each node with its doc ID
-    nodes = parser.get_nodes_from_documents([doc])
-    for i, node in enumerate(nodes):
-        node.metadata["doc_id"] = doc_id
-        node.metadata["chunk_index"] = i
-        all_nodes.append(node)
-
-
-# ================================
-# 🚀 Embed and push to Pinecone
-# ================================
-# This was added to make sure that when the docs are split up each chunk recieves an ID so
-# they can be found and deleted after
-# for doc in docs_to_embed:
-#     doc.metadata["doc_id"] = generate_doc_id(doc)
-#     doc.excluded_embed_metadata_keys = []
-
-# if docs_to_embed:
-#     index = VectorStoreIndex.from_documents(
-#         docs_to_embed,
-#         embed_model=OpenAIEmbedding(model=EMBEDDING_MODEL),
-#         storage_context=storage_context,
-#     )
-#     print(f"✅ Embedded and indexed {len(docs_to_embed)} document(s) to Pinecone.")
-# else:
-#     print("✅ All documents are up to date. No re-embedding needed.")
-
-# -----------THE ABOVE WAS REPLACED WITH THE BELOW-------------------------------------------------------------------------
-# Embed the chunked text
-texts = [node.text for node in all_nodes]
-embeddings = embedding_model.get_text_embedding_batch(texts)
-
-# Format for Pinecone upload
-vectors = [
-    {
-        "id": f"{node.metadata['doc_id']}::chunk-{node.metadata['chunk_index']}",
-        "values": emb,
-        "metadata": node.metadata,
-    }
-    for node, emb in zip(all_nodes, embeddings)
-]
-
-if vectors:
-    pinecone_index.upsert(vectors=vectors)
-    print(f"✅ Embedded and uploaded {len(vectors)} vectors to Pinecone.")
-else:
-    print("✅ All documents are up to date. No re-embedding needed.")
+# ================================
+# 🚀 Run: load -> chunk -> embed -> push to the vector index
+# ================================
+stages = [Stage("filter", filter_stage), Stage("chunk", chunk_stage)]
+if not DRY_RUN:
+    stages += [
+        Stage("embed", embed_stage, workers=EMBED_WORKERS, batch_size=EMBED_BATCH_SIZE),
+        Stage("upsert", upsert_stage, batch_size=UPSERT_BATCH_SIZE),
+    ]
+stats = run_pipeline(load_all_docs(), stages, queue_size=PIPELINE_QUEUE_SIZE)
+
+print("\n📈 Pipeline stats:")
+for stage_name, stage_stats in stats.items():
+    print(
+        f"   {stage_name:>7}: {stage_stats['in']} in / {stage_stats['out']} out, "
+        f"{stage_stats['per_second']}/s, busy {stage_stats['busy_seconds']}s"
+    )
+print(f"✅ {len(current_doc_ids)} non-empty documents retained for syncing.")
 
 
 # ================================
-# 💾 Save updated hash cache
+# 🧼 Remove deleted documents and stale chunks
 # ================================
-# When you use with open(...) as f, Python will automatically close the file for you after that block is done — no need for f.close().
-os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+# (done after the pipeline because we only know all current doc IDs once every document has been loaded)
+deleted_doc_ids = manifest.doc_ids() - current_doc_ids
+delete_ids = manifest.stale_chunk_ids() + manifest.chunk_ids_of_docs(deleted_doc_ids)
+print(f"\n📂 Total current_docs: {len(current_doc_ids)}")
+print(f"🗑️  Docs marked for deletion: {len(deleted_doc_ids)}")
+
+if DRY_RUN:
+    plan["chunks_to_delete"] += len(manifest.chunk_ids_of_docs(deleted_doc_ids))
+    print("\n📝 Dry run, nothing was changed. Plan:")
+    print(f"   New docs: {plan['new_docs']}")
+    print(f"   Changed docs: {plan['changed_docs']}")
+    print(f"   Deleted docs: {len(deleted_doc_ids)}")
+    print(f"   Chunks to embed + upsert: {plan['chunks_to_embed']}")
+    print(f"   Chunks to delete: {plan['chunks_to_delete']}")
+    sys.exit(0)
+
+if stats.get("upsert", {}).get("in"):
+    print(f"✅ Embedded and uploaded {stats['upsert']['in']} vectors to the {config.VECTOR_BACKEND} index.")
+else:
+    print("✅ All documents are up to date. No re-embedding needed.")
+
+# One batched delete for everything (the Pinecone backend splits it in calls of 1000 IDs only if bigger)
+if delete_ids:
+    print(f"🗑️ Removing {len(delete_ids)} outdated vectors from the {config.VECTOR_BACKEND} index...")
+    vector_store.delete_embeddings(delete_ids)
+    manifest.forget(delete_ids, deleted_doc_ids)
+
+if legacy_doc_ids:
+    print(f"🗑️ Removing vectors of {len(legacy_doc_ids)} doc(s) from the old cache format...")
+    vector_store.delete_embeddings(filter={"doc_id": {"$in": legacy_doc_ids}})
+
+# the old cache has been fully moved into the manifest
+if os.path.exists(LEGACY_CACHE_PATH):
+    os.replace(LEGACY_CACHE_PATH, LEGACY_CACHE_PATH + ".migrated")
+
+# saved last: if the run failed before this point, the next one reads the edited Notion page again
+if notion_crawl is not None:
+    notion_state.save_crawl(PAGE_ID, notion_crawl)
 
-with open(CACHE_PATH, "w") as f:
-    json.dump(doc_hash_cache, f, indent=2)
+print(f"📒 Manifest: {manifest.stats()}")
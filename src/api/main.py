@@ -1,15 +1,41 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from src.api.routes import router
+from src.api.middleware import TracingMiddleware
+from src.api.routes import job_queue, job_workers, router
+from src import config
+from src.core.context_window import stop_summarizer
+from src.core.session import flush_sessions
+from src.services.vector_queue import shutdown_vector_queue
 from fastapi.middleware.cors import CORSMiddleware
 
 # This is the entry point for the API application
 
+
+# Runs once when the server starts (before the yield) and once when it stops (after the yield)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # jobs left in the queue by the previous run are picked up again
+    job_queue.purge(config.JOB_RETENTION)
+    job_workers.start()
+    yield
+    # running jobs go back to the queue, the next start runs them
+    await job_workers.stop()
+    stop_summarizer()
+    # vectors still waiting in the write queue are sent before exiting
+    shutdown_vector_queue()
+    # sessions are written back in the background, make sure nothing pending is lost
+    flush_sessions()
+
+
 # Creates an instance of the FastAPI application. Shown when I test on webpage
-app = FastAPI(title="Dream AI Interpreter")
+app = FastAPI(title="Dream AI Interpreter", lifespan=lifespan)
 
 # Adds the routes from router.py to the main FastAPI. Modular approach: keeps code clean
 app.include_router(router)
 
+# Server-Timing header and on-demand profiling of requests (added first so CORS stays the outermost layer)
+app.add_middleware(TracingMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # or limit to ["http://192.168.0.16"] in prod
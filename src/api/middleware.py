@@ -0,0 +1,52 @@
+import asyncio
+import logging
+
+from src import config
+from src.core.structured_logging import log_event
+from src.core.tracing import SamplingProfiler, end_trace, should_profile, start_trace
+
+logger = logging.getLogger(__name__)
+
+
+# Pure ASGI middleware (not BaseHTTPMiddleware, which would run the endpoint in another task and buffer streams).
+# Starts the trace of each request, adds the Server-Timing header when the response starts and, for the requests
+# that ask for it, runs the whole request under the sampling profiler.
+# Streamed responses send their headers before the body, so their Server-Timing only covers what ran until then.
+class TracingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace, token = start_trace()
+        profiler = None
+        headers = dict(scope.get("headers") or [])
+        if should_profile(headers.get(b"x-profile", b"").decode("latin-1")):
+            profiler = SamplingProfiler()
+            if not profiler.start():
+                log_event(logger, "profile.busy", path=scope["path"])
+                profiler = None
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and config.TRACING_ENABLED:
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"server-timing", trace.server_timing().encode("latin-1")),
+                    # lets the frontend (another origin) read the timings too
+                    (b"timing-allow-origin", b"*"),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            end_trace(token)
+            if profiler is not None:
+                # stop() joins the sampling thread (up to one interval), not something to do on the event loop
+                await asyncio.to_thread(profiler.stop)
+                name = f"{scope['method']}-{scope['path']}"
+                path = await asyncio.to_thread(profiler.save, name)
+                log_event(logger, "profile.saved", request=name, samples=profiler.samples, file=path)
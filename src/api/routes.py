@@ -1,11 +1,49 @@
-from fastapi import APIRouter, HTTPException
-from src.api.schemas import DreamInput, Step0Input, Step1Input, Step2Input, Step3Input
-from src.core.pipeline import process_dream_step
-from src.core.session import get_session_context, save_session_context
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from src.api.schemas import (
+    BatchDreamInput,
+    DreamInput,
+    Step0Input,
+    Step1Input,
+    Step2Input,
+    Step3Input,
+)
+from src.core.admission import AdmissionController, AdmissionRejected
+from src.core.context_window import aload_context_window
+from src.core.metrics import count_error, registry as metrics_registry, stage_timer, track_request
+from src.core.llm_client import (
+    DEGRADED_RESPONSE,
+    LLMError,
+    LLMTimeoutError,
+    LLMUnavailableError,
+)
+from src.core.pipeline import (
+    aprocess_dream_step,
+    discard_retrieval,
+    llm_calls,
+    llm_client,
+    response_cache,
+    start_retrieval,
+    stream_dream_step,
+    symbol_lexicon,
+)
+from src.core.retrieval import retrieval_cache
+from src.core.structured_logging import log_event, logging_stats, setup_logging
+from src.core.session import (
+    aappend_session_step,
+    session_cache_stats,
+)
 
+from src import config
+from src.services.job_queue import JobFailed, JobQueue, JobWorkers
+from src.services.vector_queue import VectorQueueFullError, get_vector_queue
+
+import json
+import math
+import asyncio
 import logging
 
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 
@@ -28,41 +66,508 @@ router = APIRouter(tags=["Dream Analysis"])
 #     return {"response": response}
 
 
-# This sets up a POST endpoint at /analyze. When a user makes a POST request to /analyze, it triggers this analyze_dream function
-# This takes the context of the conversation into account
-@router.post("/analyze")
-def analyze_dream(input: DreamInput):
-    context = get_session_context(input.user_id, input.dream_id)
-    convo_context = context.get("convo_context", "")
-    step = input.step
+# Checks the input_data against the schema for the step. Shared by all the /analyze endpoints
+def validate_step_input(step: int, input_data: dict) -> dict:
+    with stage_timer(step, "validation"):
+        try:
+            return _validate_step_input(step, input_data)
+        except HTTPException:
+            count_error("validation")
+            raise
+
 
+def _validate_step_input(step: int, input_data: dict) -> dict:
     try:
         if step == 0:
-            validated_data = Step0Input(**input.input_data).dict()
+            return Step0Input(**input_data).dict()
         elif step == 1:
-            validated_data = Step1Input(**input.input_data).dict()
+            return Step1Input(**input_data).dict()
         elif step == 2:
-            validated_data = Step2Input(**input.input_data).dict()
+            return Step2Input(**input_data).dict()
         elif step == 3:
-            validated_data = Step3Input(**input.input_data).dict()
+            return Step3Input(**input_data).dict()
         else:
             raise HTTPException(status_code=422, detail="Invalid step")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"Invalid data: {e}")
 
-    logger.info(f"[STEP {step}] User: {input.user_id} | Dream: {input.dream_id}")
-    logger.info(f"[INPUT DATA]: {validated_data}")
-    logger.info(f"[CONVO CONTEXT]: {convo_context[:200]}")
 
-    response = process_dream_step(
-        step=step, data=validated_data, convo_context=convo_context
+# Turns an LLM failure into the HTTP error of the request: 503 with the degraded message (and when to retry)
+# while the circuit breaker is open, 504 when the step ran out of time, 502 for any other upstream failure
+def llm_http_error(e: LLMError) -> HTTPException:
+    if isinstance(e, LLMUnavailableError):
+        return HTTPException(
+            status_code=503,
+            detail=DEGRADED_RESPONSE,
+            headers={"Retry-After": str(int(e.retry_after + 0.999))},
+        )
+    if isinstance(e, LLMTimeoutError):
+        return HTTPException(status_code=504, detail=DEGRADED_RESPONSE)
+    return HTTPException(status_code=502, detail=DEGRADED_RESPONSE)
+
+
+# Decides which analyses run now, which wait for a slot and which are turned away (see core/admission.py)
+admission = AdmissionController()
+
+
+# Turns a rejection of the admission control into a 429 telling the client when to come back
+def admission_http_error(e: AdmissionRejected) -> HTTPException:
+    detail = {
+        "rate_limited": "Too many requests for this user, slow down",
+        "overloaded": "The server is busy, try again later",
+        "queue_timeout": "The server is busy, try again later",
+    }[e.reason]
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(int(math.ceil(e.retry_after)))},
     )
 
-    # Update and save convo context
-    new_entry = f"\nPaso {step}:\n{response}\n"
-    context["convo_context"] = convo_context + new_entry
-    save_session_context(input.user_id, input.dream_id, context)
 
-    logger.info(f"[RESPONSE]: {response[:200]}")
+# Charges the request to its user (token bucket) and sheds it if the server is already too busy
+def admit(user_id: str):
+    try:
+        admission.check(user_id)
+    except AdmissionRejected as e:
+        log_event(
+            logger, "admission.rejected", logging.WARNING, user_id=user_id, reason=e.reason, retry_after=e.retry_after
+        )
+        count_error(e.reason)
+        raise admission_http_error(e)
+
+
+# Queues the interpretation to be embedded and stored in the vector index by the background writer.
+# Never waits: if the queue is full the interpretation just isn't indexed, the user still gets the answer
+def index_interpretation(user_id: str, dream_id: str, step: int, response: str):
+    if not config.INDEX_INTERPRETATIONS or step < 1:
+        return
+    try:
+        get_vector_queue().enqueue(
+            f"{user_id}::{dream_id}::step-{step}",
+            text=response,
+            metadata={"user_id": user_id, "dream_id": dream_id, "step": step, "type": "interpretation"},
+            timeout=0,
+        )
+    except VectorQueueFullError as e:
+        log_event(logger, "index.skipped", logging.WARNING, dream_id=dream_id, step=step, error=str(e))
+
+
+# Runs one (already validated) step: loads the session, asks the LLM and saves the step. Shared by /analyze,
+# /analyze/batch and the jobs. LLM failures come out as the HTTPException of llm_http_error.
+# It holds an admission slot the whole time. background (batch items, jobs) waits behind the interactive requests
+async def run_analysis(input: DreamInput, validated_data: dict, background: bool = False) -> str:
+    try:
+        async with admission.slot(input.step, background):
+            return await _run_analysis(input, validated_data)
+    except AdmissionRejected as e:
+        log_event(
+            logger,
+            "admission.not_admitted",
+            logging.WARNING,
+            dream_id=input.dream_id,
+            step=input.step,
+            reason=e.reason,
+            retry_after=e.retry_after,
+        )
+        count_error(e.reason)
+        raise admission_http_error(e)
+
+
+async def _run_analysis(input: DreamInput, validated_data: dict) -> str:
+    step = input.step
+    # the knowledge lookup (steps 1 and 2) runs while the session is loaded. This runs inside the admission slot,
+    # so a rejected request never starts one, and it's discarded if the request fails before using it
+    retrieval = start_retrieval(step, validated_data)
+    try:
+        with stage_timer(step, "session_load"):
+            # only the part of the conversation that fits in the token budget of this step
+            convo_context = await aload_context_window(input.user_id, input.dream_id, step)
+
+        log_event(logger, "analysis.start", step=step, user_id=input.user_id, dream_id=input.dream_id)
+        log_event(
+            logger,
+            "analysis.input",
+            step=step,
+            dream_id=input.dream_id,
+            input_data=validated_data,
+            convo_context=convo_context,
+        )
+
+        response = await aprocess_dream_step(
+            step=step, data=validated_data, convo_context=convo_context, retrieval=retrieval
+        )
+    except LLMError as e:
+        log_event(logger, "analysis.llm_failed", logging.ERROR, step=step, dream_id=input.dream_id, error=repr(e))
+        count_error(type(e).__name__)
+        raise llm_http_error(e)
+    finally:
+        await discard_retrieval(retrieval)
+
+    # Add this step to the convo context (only the new step is written, not the whole conversation)
+    with stage_timer(step, "session_save"):
+        await aappend_session_step(input.user_id, input.dream_id, step, response)
+    index_interpretation(input.user_id, input.dream_id, step, response)
 
+    log_event(logger, "analysis.response", step=step, dream_id=input.dream_id, response=response)
+    return response
+
+
+# Runs an /analyze job taken from the job queue. The input was validated when the job was submitted, but it's
+# checked again since the job may come from an older version of the app (queued before a restart)
+async def run_analysis_job(payload: dict) -> dict:
+    input = DreamInput(**payload)
+    try:
+        with track_request("job", input.step):
+            validated_data = validate_step_input(input.step, input.input_data)
+            return {"response": await run_analysis(input, validated_data, background=True)}
+    except HTTPException as e:
+        raise JobFailed(e.status_code, e.detail)
+
+
+job_queue = JobQueue(config.JOB_DB_PATH, config.JOB_LEASE_SECONDS, config.JOB_MAX_ATTEMPTS)
+# started and stopped by the lifespan of the app (main.py)
+job_workers = JobWorkers(
+    job_queue, {"analyze": run_analysis_job}, config.JOB_WORKERS, config.JOB_POLL_INTERVAL
+)
+
+
+# This sets up a POST endpoint at /analyze. When a user makes a POST request to /analyze, it triggers this analyze_dream function
+# This takes the context of the conversation into account
+# It is async all the way down (LLM call and session I/O) so one worker can have many interpretations in flight.
+# With ?mode=job the request is only validated and queued: it answers 202 with a job_id straight away and the
+# interpretation is fetched later from GET /jobs/{job_id}. Jobs of the same dream run in the order they were sent.
+@router.post("/analyze")
+async def analyze_dream(input: DreamInput, mode: str = Query("sync", pattern="^(sync|job)$")):
+    if mode == "job":
+        return await submit_analysis_job(input)
+    with track_request("analyze", input.step):
+        validated_data = validate_step_input(input.step, input.input_data)
+        admit(input.user_id)
+        response = await run_analysis(input, validated_data)
     return {"response": response}
+
+
+# /analyze?mode=job: validates the request and queues it for the job workers
+async def submit_analysis_job(input: DreamInput):
+    validate_step_input(input.step, input.input_data)
+    admit(input.user_id)
+    job_id = await asyncio.to_thread(
+        job_queue.submit, "analyze", input.dict(), f"{input.user_id}::{input.dream_id}"
+    )
+    job_workers.notify()
+    log_event(logger, "jobs.queued", job_id=job_id, dream_id=input.dream_id, step=input.step)
+    return JSONResponse(
+        status_code=202,
+        content={"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"},
+        headers={"Location": f"/jobs/{job_id}"},
+    )
+
+
+# State of a job of /analyze?mode=job: "queued", "running", "done" (with "result") or "failed" (with "error").
+# With ?wait=<seconds> it's a long-poll: it answers as soon as the job finishes, or when the wait is over
+# (at most JOB_MAX_WAIT)
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = Query(0, ge=0)):
+    job = await job_workers.wait(job_id, min(wait, config.JOB_MAX_WAIT))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+# How many jobs there are in each status
+@router.get("/jobs")
+def get_job_stats():
+    return job_queue.stats()
+
+
+# Runs one item of a batch and returns its result. Errors are returned in the result, not raised, so one
+# failed item doesn't fail the others
+async def run_batch_item(index: int, item: DreamInput, validated_data: dict) -> dict:
+    result = {"index": index, "user_id": item.user_id, "dream_id": item.dream_id, "step": item.step}
+    try:
+        with track_request("batch", item.step):
+            result["response"] = await run_analysis(item, validated_data, background=True)
+    except HTTPException as e:
+        result["error"] = {"status": e.status_code, "detail": e.detail}
+    except Exception as e:
+        log_event(
+            logger,
+            "batch.item_failed",
+            logging.ERROR,
+            index=index,
+            dream_id=item.dream_id,
+            step=item.step,
+            error=repr(e),
+        )
+        result["error"] = {"status": 500, "detail": str(e)}
+    return result
+
+
+# Many /analyze calls in one request (e.g. importing a dream journal). Every item is validated before anything
+# runs: invalid items get their error straight away and the valid ones are processed, at most
+# BATCH_MAX_CONCURRENCY at a time. Items of the same dream run one after the other, in the order they were
+# sent, because each step builds on the convo context saved by the previous one. A batch costs each of its
+# users one request of their rate limit, whatever the number of items (a journal import is one action, and
+# its items are throttled by waiting behind the interactive requests for a slot). If a user is over their
+# limit, all of their items get the 429 in their result.
+# The response is {"results": [...]} in the order of the items, or with "stream": true, one NDJSON line per
+# item as soon as it's done (each line has the "index" of its item).
+@router.post("/analyze/batch")
+async def analyze_dream_batch(batch: BatchDreamInput):
+    if len(batch.items) > config.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"A batch can have at most {config.BATCH_MAX_ITEMS} items")
+
+    results = {}
+    dreams = {}  # (user_id, dream_id) -> [(index, item, validated_data)] in order
+    admitted = {}  # user_id -> None, or the HTTPException their items get
+    for index, item in enumerate(batch.items):
+        try:
+            validated_data = validate_step_input(item.step, item.input_data)
+            if item.user_id not in admitted:
+                try:
+                    admit(item.user_id)
+                    admitted[item.user_id] = None
+                except HTTPException as e:
+                    admitted[item.user_id] = e
+            if admitted[item.user_id] is not None:
+                raise admitted[item.user_id]
+        except HTTPException as e:
+            results[index] = {
+                "index": index,
+                "user_id": item.user_id,
+                "dream_id": item.dream_id,
+                "step": item.step,
+                "error": {"status": e.status_code, "detail": e.detail},
+            }
+            continue
+        dreams.setdefault((item.user_id, item.dream_id), []).append((index, item, validated_data))
+
+    log_event(logger, "batch.received", items=len(batch.items), invalid=len(results), dreams=len(dreams))
+    slots = asyncio.Semaphore(config.BATCH_MAX_CONCURRENCY)
+    finished = asyncio.Queue()
+    for result in results.values():
+        finished.put_nowait(result)
+
+    async def run_dream(items: list):
+        async with slots:
+            for index, item, validated_data in items:
+                await finished.put(await run_batch_item(index, item, validated_data))
+
+    tasks = [asyncio.create_task(run_dream(items)) for items in dreams.values()]
+
+    async def results_as_completed():
+        try:
+            for _ in range(len(batch.items)):
+                yield await finished.get()
+        finally:
+            # the client went away: don't keep running the rest of the batch
+            for task in tasks:
+                task.cancel()
+
+    if batch.stream:
+
+        async def ndjson_lines():
+            async for result in results_as_completed():
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+    async for result in results_as_completed():
+        results[result["index"]] = result
+    ordered = [results[index] for index in range(len(batch.items))]
+    failed = sum(1 for result in ordered if "error" in result)
+    return {"results": ordered, "succeeded": len(ordered) - failed, "failed": failed}
+
+
+# Formats one Server-Sent Event. The payload is JSON so newlines inside the text don't break the event
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# Same as /analyze but the interpretation is streamed back as Server-Sent Events while the model writes it.
+# Events: "token" for every piece of text, "done" with the full response at the end, "error" if the model fails.
+# The convo context is only saved once the whole response has been generated. If the client disconnects
+# half way we stop generating and nothing is saved, so the session never ends up with half an answer.
+@router.post("/analyze/stream")
+async def analyze_dream_stream(input: DreamInput, request: Request):
+    step = input.step
+    validated_data = validate_step_input(step, input.input_data)
+    admit(input.user_id)
+
+    with stage_timer(step, "session_load"):
+        convo_context = await aload_context_window(input.user_id, input.dream_id, step)
+
+    log_event(logger, "stream.start", step=step, user_id=input.user_id, dream_id=input.dream_id)
+
+    # the admission slot is taken when the stream starts (not before returning the response), so a client that
+    # never reads the stream can't keep a slot. Waiting too long for it ends the stream with a 429 error event
+    async def event_stream():
+        parts = []
+        # the knowledge lookup is started by stream_dream_step itself, once the slot is held (the generator
+        # doesn't run before that), so a rejected or abandoned stream never starts one
+        tokens = stream_dream_step(step=step, data=validated_data, convo_context=convo_context)
+        try:
+            async with admission.slot(step):
+                async for token in tokens:
+                    if await request.is_disconnected():
+                        log_event(logger, "stream.disconnected", step=step, dream_id=input.dream_id)
+                        return
+                    parts.append(token)
+                    yield sse_event("token", {"text": token})
+        except AdmissionRejected as e:
+            log_event(
+                logger, "stream.not_admitted", logging.WARNING, step=step, dream_id=input.dream_id, reason=e.reason
+            )
+            count_error(e.reason)
+            error = admission_http_error(e)
+            yield sse_event(
+                "error", {"detail": error.detail, "status": error.status_code, "retry_after": e.retry_after}
+            )
+            return
+        except LLMError as e:
+            log_event(logger, "stream.failed", logging.ERROR, step=step, dream_id=input.dream_id, error=repr(e))
+            count_error(type(e).__name__)
+            error = llm_http_error(e)
+            yield sse_event("error", {"detail": error.detail, "status": error.status_code, "degraded": True})
+            return
+        except Exception as e:
+            log_event(logger, "stream.failed", logging.ERROR, step=step, dream_id=input.dream_id, error=repr(e))
+            count_error(type(e).__name__)
+            yield sse_event("error", {"detail": str(e)})
+            return
+        finally:
+            await tokens.aclose()
+
+        response = "".join(parts).strip()
+        with stage_timer(step, "session_save"):
+            await aappend_session_step(input.user_id, input.dream_id, step, response)
+        index_interpretation(input.user_id, input.dream_id, step, response)
+
+        log_event(logger, "stream.response", step=step, dream_id=input.dream_id, response=response)
+        yield sse_event("done", {"response": response})
+
+    # the total time of a stream goes from the request to the last event
+    async def tracked_event_stream():
+        with track_request("stream", step):
+            async for event in event_stream():
+                yield event
+
+    return StreamingResponse(
+        tracked_event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Hit/miss/eviction counters of the in-memory session cache
+@router.get("/sessions/stats")
+def get_session_stats():
+    return session_cache_stats()
+
+
+# Hit/miss counters of the LLM response cache (overall and per step) and of the knowledge retrieval cache,
+# how many step 0 requests the symbol lexicon answered without the LLM, and how many LLM calls were saved by
+# coalescing identical prompts in flight ("coalesced")
+@router.get("/cache/stats")
+def get_cache_stats():
+    return {
+        **response_cache.stats(),
+        "retrieval": retrieval_cache.stats(),
+        "lexicon": symbol_lexicon.stats(),
+        "single_flight": llm_calls.stats(),
+    }
+
+
+# The counters that the caches, the LLM client, the admission control and the job queue already keep, read
+# when /metrics is scraped instead of being recorded twice
+def collect_metrics() -> list:
+    llm_cache = response_cache.stats()
+    retrieval = retrieval_cache.stats()
+    sessions = session_cache_stats()
+    lexicon = symbol_lexicon.stats()
+    coalesced = llm_calls.stats()
+    cache_samples = [
+        ({"cache": "llm_response", "result": "hit"}, llm_cache["memory_hits"] + llm_cache["disk_hits"]),
+        ({"cache": "llm_response", "result": "miss"}, llm_cache["misses"]),
+        ({"cache": "retrieval", "result": "hit"}, retrieval["hits"]),
+        ({"cache": "retrieval", "result": "miss"}, retrieval["misses"]),
+        ({"cache": "session", "result": "hit"}, sessions["hits"]),
+        ({"cache": "session", "result": "miss"}, sessions["misses"]),
+        # step 0 answered by the symbol lexicon / identical LLM calls that shared one in flight
+        ({"cache": "lexicon", "result": "hit"}, lexicon["answered"]),
+        ({"cache": "lexicon", "result": "miss"}, lexicon["hinted"]),
+        ({"cache": "single_flight", "result": "hit"}, coalesced["coalesced"]),
+        ({"cache": "single_flight", "result": "miss"}, coalesced["calls"]),
+    ]
+    llm = llm_client.status()
+    slots = admission.stats()
+    return [
+        ("dream_cache_requests_total", "counter", "Cache lookups by cache and result", cache_samples),
+        (
+            "dream_llm_events_total",
+            "counter",
+            "LLM client calls, retries, hedges, timeouts and failures",
+            [({"event": event}, value) for event, value in llm["counters"].items()],
+        ),
+        (
+            "dream_llm_breaker_open",
+            "gauge",
+            "1 while the circuit breaker of the LLM is open",
+            [({}, int(llm["breaker"]["state"] == "open"))],
+        ),
+        (
+            "dream_admission_slots",
+            "gauge",
+            "Admission slots in use and requests waiting for one",
+            [
+                ({"state": "in_flight"}, slots["in_flight"]),
+                ({"state": "queued"}, slots["queued"]),
+                ({"state": "queued_background"}, slots["queued_background"]),
+            ],
+        ),
+        (
+            "dream_admission_rejected_total",
+            "counter",
+            "Requests turned away by the admission control",
+            [
+                ({"reason": "rate_limited"}, slots["rate_limited"]),
+                ({"reason": "overloaded"}, slots["shed"]),
+                ({"reason": "queue_timeout"}, slots["queue_timeouts"]),
+            ],
+        ),
+        (
+            "dream_log_records_dropped_total",
+            "counter",
+            "Log records dropped because the log writer couldn't keep up",
+            [({}, logging_stats()["dropped"])],
+        ),
+        (
+            "dream_jobs",
+            "gauge",
+            "Jobs in the queue by status",
+            [({"status": status}, count) for status, count in job_queue.stats().items()],
+        ),
+    ]
+
+
+metrics_registry.add_collector(collect_metrics)
+
+
+# Prometheus metrics: time per stage and step of the analyses, requests, errors, requests in flight, cache hits
+@router.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# Slots in use, requests waiting and how many were rate limited or shed by the admission control
+@router.get("/admission/stats")
+async def get_admission_stats():
+    return admission.stats()
+
+
+# State of the LLM client: circuit breaker, retry/hedge/timeout counters and latency percentiles per step
+@router.get("/llm/status")
+def get_llm_status():
+    return llm_client.status()
@@ -36,5 +36,11 @@ class DreamInput(BaseModel):
     input_data: Dict[str, Any]  # initial raw input
 
 
+# many DreamInput at once (/analyze/batch). stream=True returns the results as NDJSON while they finish
+class BatchDreamInput(BaseModel):
+    items: List[DreamInput]
+    stream: bool = False
+
+
 # how to make an optional field
 # context: Optional[str] = None  # Optional field
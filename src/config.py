@@ -0,0 +1,227 @@
+import os
+from pathlib import Path
+from dotenv import load_dotenv
+
+# Central place for the settings of the app. Everything can be overridden with environment variables (.env)
+
+load_dotenv()
+
+# Relative paths (the defaults, or the ones in .env) are relative to the repo root, not to the working
+# directory, so the API (started from the root) and the scripts (started from scripts/) use the same files
+ROOT_DIR = Path(__file__).resolve().parents[1]
+
+
+def repo_path(path: str) -> str:
+    return path if os.path.isabs(path) else os.path.join(ROOT_DIR, path)
+
+
+# ================================
+# 💾 Session storage
+# ================================
+# Where the conversation context of each dream is kept: "file", "sqlite" or "mongo"
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "file")
+SESSION_PATH = repo_path(os.getenv("SESSION_PATH", "./session_data/"))
+SESSION_DB_PATH = repo_path(os.getenv("SESSION_DB_PATH", "./session_data/sessions.db"))
+SESSION_COLLECTION = os.getenv("SESSION_COLLECTION", "sessions")
+
+# Sessions are kept in memory (LRU) and written back to the backend in the background
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1024"))
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "2.0"))
+
+# The file backend keeps an append-only log per dream and folds it into the .json snapshot every N steps
+SESSION_LOG_COMPACT_EVERY = int(os.getenv("SESSION_LOG_COMPACT_EVERY", "16"))
+SESSION_LOG_FSYNC = os.getenv("SESSION_LOG_FSYNC", "false").lower() == "true"
+
+# ================================
+# 🧠 Convo context budget
+# ================================
+# Max tokens of convo context injected in the prompt. Can be set per step with CONTEXT_TOKEN_BUDGET_STEP_<n>
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_TOKEN_BUDGET_BY_STEP = {
+    step: int(os.getenv(f"CONTEXT_TOKEN_BUDGET_STEP_{step}", CONTEXT_TOKEN_BUDGET)) for step in range(4)
+}
+# Older turns start being summarised once the verbatim turns use this fraction of the budget,
+# so the summary is ready before they would have to be dropped
+CONTEXT_SUMMARY_TRIGGER = float(os.getenv("CONTEXT_SUMMARY_TRIGGER", "0.6"))
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "600"))
+
+# ================================
+# ⚡ LLM response cache
+# ================================
+# Identical prompts of the same step get the stored answer instead of a new LLM call.
+# TTL in seconds per step, 0 means that step is never cached (2 and 3 depend on the whole conversation, and
+# the prompt of 1 has the user's personal context, which shouldn't be kept on disk unless asked for)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_PATH = repo_path(os.getenv("LLM_CACHE_PATH", "./data/interim/llm_cache.db"))
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "2048"))
+LLM_CACHE_TTL_BY_STEP = {
+    step: int(os.getenv(f"LLM_CACHE_TTL_STEP_{step}", default))
+    for step, default in {0: 30 * 24 * 3600, 1: 0, 2: 0, 3: 0}.items()
+}
+# Rows kept in the SQLite file. Expired rows, and the ones closest to expiring when there are more than this,
+# are deleted every LLM_CACHE_PURGE_EVERY writes (and when the app starts)
+LLM_CACHE_MAX_DISK_ENTRIES = int(os.getenv("LLM_CACHE_MAX_DISK_ENTRIES", "100000"))
+LLM_CACHE_PURGE_EVERY = int(os.getenv("LLM_CACHE_PURGE_EVERY", "500"))
+
+# ================================
+# 📦 Batch analyze
+# ================================
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+# dreams of a batch processed at the same time
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+
+# ================================
+# 🚦 Admission control
+# ================================
+# Per user token bucket: requests per second (0 disables it) and how many can come at once
+RATE_LIMIT_PER_USER = float(os.getenv("RATE_LIMIT_PER_USER", "1.0"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "10000"))  # buckets kept in memory
+# Analyses running at the same time (all endpoints). The rest wait, later steps first
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "32"))
+# with this many requests waiting new ones get 429 + Retry-After, and none waits longer than ADMISSION_MAX_WAIT
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "20"))
+
+# ================================
+# 🗂️ Job mode (/analyze?mode=job)
+# ================================
+# Jobs are kept in SQLite, so queued (and interrupted) jobs are picked up again after a restart
+JOB_DB_PATH = repo_path(os.getenv("JOB_DB_PATH", "./data/interim/jobs.db"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))  # jobs running at the same time in this process
+# a running job whose worker died is given to another worker after this many seconds
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+JOB_MAX_WAIT = float(os.getenv("JOB_MAX_WAIT", "30"))  # longest long-poll of GET /jobs/{id}?wait=
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", str(24 * 3600)))  # finished jobs are deleted after this
+
+# ================================
+# 🛡️ LLM client
+# ================================
+# Max seconds a step can wait for the LLM, retries included. Can be set per step with LLM_TIMEOUT_STEP_<n>
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+LLM_TIMEOUT_BY_STEP = {
+    step: float(os.getenv(f"LLM_TIMEOUT_STEP_{step}", default))
+    for step, default in {0: 15, 1: 45, 2: 45, 3: 30}.items()
+}
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+# Streams get the step deadline for their first token, then fail if no token comes for this many seconds
+LLM_STREAM_IDLE_TIMEOUT = float(os.getenv("LLM_STREAM_IDLE_TIMEOUT", "20"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+# Hedging: if a call is slower than the p95 of its step a second identical one is sent and the first answer wins
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))  # latencies needed before trusting the p95
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1.0"))
+# Circuit breaker: after this many failures in a row the LLM isn't called for LLM_BREAKER_COOLDOWN seconds
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+# ================================
+# 🔎 Step 0 symbol lexicon
+# ================================
+# "hints" (default): always ask the LLM, with the hits as hints. "off": don't use the lexicon
+# "hybrid": dreams well covered by the lexicon are answered without the LLM, the rest get the hits as hints.
+# Opt-in, since a keyword match can't tell a symbol from the same word used in another sense.
+SYMBOL_LEXICON_MODE = os.getenv("SYMBOL_LEXICON_MODE", "hints")
+SYMBOL_LEXICON_PATH = os.getenv("SYMBOL_LEXICON_PATH")  # optional JSON with more symbols {"symbol": ["term", ...]}
+# the lexicon alone answers when its symbols cover this fraction of the meaningful words, and there are enough
+SYMBOL_LEXICON_MIN_COVERAGE = float(os.getenv("SYMBOL_LEXICON_MIN_COVERAGE", "0.5"))
+SYMBOL_LEXICON_MIN_SYMBOLS = int(os.getenv("SYMBOL_LEXICON_MIN_SYMBOLS", "3"))
+
+# ================================
+# 📌 Embeddings
+# ================================
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+# Embeddings already computed are kept on disk (float32) keyed by the hash of model + text
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_PATH = repo_path(os.getenv("EMBEDDING_CACHE_PATH", "./data/interim/embedding_cache.db"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+# get_embeddings packs texts into requests of at most this many tokens / inputs and sends a few at a time
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "100000"))
+EMBEDDING_BATCH_MAX_INPUTS = int(os.getenv("EMBEDDING_BATCH_MAX_INPUTS", "2048"))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "3"))
+
+# ================================
+# 🧠 Vector index
+# ================================
+# "pinecone" uses the hosted index, "local" an in-process index on disk (no network, good for tests/offline)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pinecone")
+LOCAL_INDEX_PATH = repo_path(os.getenv("LOCAL_INDEX_PATH", "./data/processed/vector_index"))
+LOCAL_INDEX_DIM = int(os.getenv("LOCAL_INDEX_DIM", "1536"))
+# The API picks up what scripts/embed_documents.py writes to the local index without a restart (on the next
+# query). Knowledge lookups already cached keep their old result for up to RETRIEVAL_CACHE_TTL seconds.
+
+# Vector writes go through a background queue and are sent in batches
+VECTOR_QUEUE_MAX_SIZE = int(os.getenv("VECTOR_QUEUE_MAX_SIZE", "10000"))
+VECTOR_QUEUE_BATCH_SIZE = int(os.getenv("VECTOR_QUEUE_BATCH_SIZE", "100"))
+VECTOR_QUEUE_MAX_WAIT = float(os.getenv("VECTOR_QUEUE_MAX_WAIT", "2.0"))
+VECTOR_QUEUE_MAX_RETRIES = int(os.getenv("VECTOR_QUEUE_MAX_RETRIES", "5"))
+# Embed and index every interpretation (steps 1-3) so similar dreams can be found later
+INDEX_INTERPRETATIONS = os.getenv("INDEX_INTERPRETATIONS", "false").lower() == "true"
+
+# ================================
+# 📚 Notion sync
+# ================================
+# Notion allows ~3 requests per second on average per integration
+NOTION_RATE_LIMIT = float(os.getenv("NOTION_RATE_LIMIT", "3"))
+NOTION_MAX_WORKERS = int(os.getenv("NOTION_MAX_WORKERS", "8"))
+
+# ================================
+# 📖 Knowledge retrieval (steps 1 and 2)
+# ================================
+# The query of the step is embedded and the closest chunks of the knowledge base (what embed_documents.py
+# uploads) are added to the prompt
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "true").lower() == "true"
+RETRIEVAL_STEPS = {int(step) for step in os.getenv("RETRIEVAL_STEPS", "1,2").split(",") if step.strip()}
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+# matches below this cosine similarity are not worth the prompt tokens
+RETRIEVAL_MIN_SCORE = float(os.getenv("RETRIEVAL_MIN_SCORE", "0.3"))
+RETRIEVAL_MAX_CHARS = int(os.getenv("RETRIEVAL_MAX_CHARS", "1200"))  # per chunk
+# if retrieval takes longer than this the prompt goes out without knowledge instead of waiting
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", "3.0"))
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "1024"))
+RETRIEVAL_CACHE_TTL = int(os.getenv("RETRIEVAL_CACHE_TTL", "3600"))
+
+# ================================
+# ⏱️ Tracing and profiling
+# ================================
+# Every response gets a Server-Timing header with the time spent in each part of the request
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+# A request with the header "X-Profile: <PROFILING_TOKEN>" runs under the sampling profiler (no token, no
+# profiling). PROFILE_SAMPLE_RATE profiles that fraction of the requests without the header
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # seconds between samples
+PROFILE_DIR = repo_path(os.getenv("PROFILE_DIR", "./reports/profiles"))
+
+# ================================
+# 🪵 Logging
+# ================================
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # "text" or "json" (one object per line)
+# records waiting for the writer thread, past this they're dropped instead of slowing requests down
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Fraction of each event that is logged, "event=rate,..." (events not listed use LOG_SAMPLE_DEFAULT).
+# By default 1 in 10 of the events with whole payloads (dream data, prompts, responses) is kept
+LOG_SAMPLE_DEFAULT = float(os.getenv("LOG_SAMPLE_DEFAULT", "1.0"))
+LOG_SAMPLE_RATES = {
+    event.strip(): float(rate)
+    for event, rate in (
+        pair.split("=")
+        for pair in os.getenv(
+            "LOG_SAMPLE_RATES",
+            "analysis.input=0.1,analysis.response=0.1,stream.response=0.1,"
+            "pipeline.input=0.1,pipeline.prompt=0.1,pipeline.response=0.1",
+        ).split(",")
+        if "=" in pair
+    )
+}
+# What happens to payload fields (LOG_PAYLOAD_FIELDS): "truncate" to LOG_MAX_FIELD_CHARS, "redact" (only the
+# length and a hash are written) or "full". Every other field is truncated too
+LOG_PAYLOAD_POLICY = os.getenv("LOG_PAYLOAD_POLICY", "truncate")
+LOG_PAYLOAD_FIELDS = set(
+    os.getenv("LOG_PAYLOAD_FIELDS", "input_data,convo_context,prompt,response").split(",")
+)
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "200"))
@@ -0,0 +1,184 @@
+import math
+import time
+import asyncio
+import heapq
+import itertools
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from src import config
+
+# ================================
+# 🚦 Admission control
+# ================================
+# Decides which /analyze requests get to run, so one client can't take the whole LLM quota:
+# - every user has a token bucket (RATE_LIMIT_PER_USER requests per second, bursts of RATE_LIMIT_BURST)
+# - at most ADMISSION_MAX_IN_FLIGHT analyses run at the same time, the rest wait in a priority queue where a
+#   later step goes first (finishing a dream at step 3 beats starting a new one at step 0)
+# - when ADMISSION_MAX_QUEUE requests are already waiting, new ones are turned away (429 + Retry-After)
+#   instead of queueing forever
+# Background work (batch items, jobs) uses the same slots but queues behind the interactive requests and is
+# never turned away. Everything runs in the event loop, so there are no locks.
+
+
+class AdmissionRejected(Exception):
+    """
+    The request was not admitted. reason is "rate_limited", "overloaded" or "queue_timeout", and retry_after
+    the seconds the client should wait before trying again.
+    """
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"{reason}, retry in {retry_after:.1f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBuckets:
+    """
+    One token bucket per key (user). Buckets of users not seen for a while are dropped (LRU) once there are
+    more than max_keys; a dropped bucket would have been full anyway.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key -> [tokens, updated]
+
+    def take(self, key: str) -> float:
+        """Takes a token for key. Returns 0 if there was one, or else the seconds until there is."""
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [float(self.burst), now]
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / self.rate
+
+
+class AdmissionController:
+    """
+    Args:
+        max_in_flight (int): Analyses running at the same time
+        max_queue (int): Interactive requests allowed to wait for a slot, the next ones are turned away
+        max_wait (float): Seconds an interactive request waits for a slot before giving up
+        rate (float): Requests per second per user (0 = no per user limit)
+        burst (int): Requests a user can make at once before the rate applies
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = None,
+        max_queue: int = None,
+        max_wait: float = None,
+        rate: float = None,
+        burst: int = None,
+    ):
+        self.max_in_flight = max(1, max_in_flight or config.ADMISSION_MAX_IN_FLIGHT)
+        self.max_queue = config.ADMISSION_MAX_QUEUE if max_queue is None else max_queue
+        self.max_wait = max_wait or config.ADMISSION_MAX_WAIT
+        rate = config.RATE_LIMIT_PER_USER if rate is None else rate
+        self.buckets = None
+        if rate > 0:
+            self.buckets = TokenBuckets(rate, burst or config.RATE_LIMIT_BURST, config.RATE_LIMIT_MAX_USERS)
+        self.in_flight = 0
+        self.waiters = []  # heap of (background, -step, seq, future)
+        self.seq = itertools.count()
+        self.queued = 0  # interactive requests waiting
+        self.service_time = None  # moving average of how long a slot is held, for Retry-After
+        self.counters = {"admitted": 0, "waited": 0, "rate_limited": 0, "shed": 0, "queue_timeouts": 0}
+
+    def retry_after(self) -> float:
+        """Rough time until a new request would get a slot: the queue ahead of it, max_in_flight at a time."""
+        service_time = self.service_time or 1.0
+        return max(1.0, math.ceil(service_time * (self.queued + 1) / self.max_in_flight))
+
+    def check(self, user_id: str):
+        """
+        Charges a request to the user and raises AdmissionRejected if they're over their rate, or if the queue
+        is already full (so a request that would be shed isn't charged and doesn't load its session).
+        """
+        if self.queued >= self.max_queue and self.in_flight >= self.max_in_flight:
+            self.counters["shed"] += 1
+            raise AdmissionRejected("overloaded", self.retry_after())
+        if self.buckets is not None:
+            wait = self.buckets.take(user_id)
+            if wait > 0:
+                self.counters["rate_limited"] += 1
+                raise AdmissionRejected("rate_limited", wait)
+
+    @asynccontextmanager
+    async def slot(self, step: int, background: bool = False):
+        """
+        Holds one of the max_in_flight slots while the block runs. Raises AdmissionRejected if the queue is
+        full or the wait is longer than max_wait (background work waits as long as it takes).
+        """
+        await self._acquire(step, background)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - started)
+
+    async def _acquire(self, step: int, background: bool):
+        while self.waiters and self.waiters[0][3].done():
+            heapq.heappop(self.waiters)  # gave up waiting
+        if self.in_flight < self.max_in_flight and not self.waiters:
+            self.in_flight += 1
+            self.counters["admitted"] += 1
+            return
+        if not background and self.queued >= self.max_queue:
+            self.counters["shed"] += 1
+            raise AdmissionRejected("overloaded", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (background, -step, next(self.seq), future))
+        self.counters["waited"] += 1
+        if not background:
+            self.queued += 1
+        try:
+            await asyncio.wait_for(future, None if background else self.max_wait)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just as we gave up: pass it on
+                self._release(None)
+            else:
+                future.cancel()  # left in the heap, _release skips it
+            if isinstance(e, asyncio.TimeoutError):
+                self.counters["queue_timeouts"] += 1
+                raise AdmissionRejected("queue_timeout", self.retry_after())
+            raise
+        finally:
+            if not background:
+                self.queued -= 1
+        self.counters["admitted"] += 1
+
+    # Hands the slot to the first waiter in priority order, or frees it if nobody is waiting
+    def _release(self, held_for):
+        if held_for is not None:
+            previous = held_for if self.service_time is None else self.service_time
+            self.service_time = 0.9 * previous + 0.1 * held_for
+        while self.waiters:
+            future = heapq.heappop(self.waiters)[3]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queued": self.queued,
+            "queued_background": sum(1 for waiter in self.waiters if waiter[0] and not waiter[3].done()),
+            "max_queue": self.max_queue,
+            "avg_service_time": round(self.service_time or 0.0, 3),
+            **self.counters,
+        }
@@ -0,0 +1,180 @@
+import re
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src import config
+from src.core.pipeline import summary_llm_client
+from src.core.session import get_session_context, update_session_context
+from src.core.session_store import format_step_entry
+
+logger = logging.getLogger(__name__)
+
+# This block keeps the convo context that goes into the prompt under a token budget.
+# The most recent turns are kept word for word, and older turns are folded into a running summary
+# that is stored in the session ("convo_summary"). The summary is written by a background thread,
+# so a request never waits for it: it uses whatever summary is ready at that moment.
+
+# Splits "\nPaso 1:\n...\n\nPaso 2:\n...\n" into its turns
+TURN_PATTERN = re.compile(r"\nPaso (\d+):\n")
+
+SUMMARY_PROMPT = (
+    "Responde en español (España).\n"
+    "Eres el asistente de una conversación de interpretación de sueños junguiana. "
+    "Actualiza el resumen de la conversación incorporando los nuevos pasos. "
+    "Conserva los símbolos, emociones, lo que resonó o no con el usuario, sus objetivos y las "
+    "conclusiones principales. Escribe como máximo {max_words} palabras y devuelve solo el resumen.\n\n"
+    "Resumen actual:\n{summary}\n\n"
+    "Nuevos pasos:\n{turns}"
+)
+
+# only one summary is written at a time, and never two for the same dream
+summarizer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="convo-summarizer")
+summaries_in_progress = set()
+summaries_lock = threading.Lock()
+
+_encoding = None
+
+
+# Counts tokens with tiktoken when it's available, otherwise estimates ~4 characters per token
+def count_tokens(text: str) -> int:
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+# Returns the turns of the conversation as a list of (step, text)
+def split_turns(convo_context: str) -> list:
+    parts = TURN_PATTERN.split(convo_context)
+    turns = []
+    for i in range(1, len(parts) - 1, 2):
+        text = parts[i + 1]
+        # every entry ends with the "\n" added by format_step_entry
+        if text.endswith("\n"):
+            text = text[:-1]
+        turns.append((int(parts[i]), text))
+    return turns
+
+
+# How many of the newest turns (after the summarised ones) fit in the budget
+def count_recent_turns(turn_tokens: list, budget: int) -> int:
+    used = 0
+    kept = 0
+    for tokens in reversed(turn_tokens):
+        if used + tokens > budget and kept > 0:
+            break
+        used += tokens
+        kept += 1
+    return kept
+
+
+def build_context_window(user_id: str, dream_id: str, context: dict, step: int) -> str:
+    """
+    Builds the convo context for the prompt of a step, within the token budget of that step.
+
+    Args:
+        user_id (str): Owner of the session
+        dream_id (str): Dream the session belongs to
+        context (dict): The session context (as returned by get_session_context)
+        step (int): Step being processed, used to pick the budget
+
+    Returns:
+        str: The summary of the older turns (if any) followed by the recent turns verbatim
+    """
+    convo_context = context.get("convo_context", "")
+    budget = config.CONTEXT_TOKEN_BUDGET_BY_STEP.get(step, config.CONTEXT_TOKEN_BUDGET)
+    if count_tokens(convo_context) <= budget * config.CONTEXT_SUMMARY_TRIGGER:
+        return convo_context
+
+    turns = split_turns(convo_context)
+    summary = context.get("convo_summary", "")
+    summarised = context.get("convo_summary_turns", 0)
+    pending = turns[summarised:]
+    pending_tokens = [count_tokens(format_step_entry(s, t)) for s, t in pending]
+
+    summary_block = f"Resumen de la conversación anterior:\n{summary}\n" if summary else ""
+    remaining = budget - count_tokens(summary_block)
+    kept = count_recent_turns(pending_tokens, remaining)
+    recent = pending[len(pending) - kept :]
+
+    # The turns that would fall out with a smaller budget are folded into the summary now (in the background),
+    # so by the time they really don't fit anymore the summary already covers them
+    keep_after_fold = count_recent_turns(pending_tokens, int(remaining * config.CONTEXT_SUMMARY_TRIGGER))
+    fold_upto = summarised + len(pending) - keep_after_fold
+    if fold_upto > summarised:
+        schedule_summary(user_id, dream_id, summarised, fold_upto)
+
+    if len(recent) < len(pending):
+        logger.info(
+            "[CONTEXT] %s/%s step %s: %s turn(s) left out of the prompt (budget %s tokens, summary covers %s turn(s))",
+            user_id,
+            dream_id,
+            step,
+            len(pending) - len(recent),
+            budget,
+            summarised,
+        )
+
+    window = summary_block + "".join(format_step_entry(s, t) for s, t in recent)
+    # a single huge turn can still be over the budget, cut it keeping the end (the newest part)
+    if count_tokens(window) > budget:
+        window = summary_block + window[len(summary_block) :][-budget * 4 :]
+    return window
+
+
+# Loads the session and builds its context window in the same hop off the event loop: counting the tokens of a
+# long conversation takes a few milliseconds, and every other request would wait for them on the loop
+def load_context_window(user_id: str, dream_id: str, step: int) -> str:
+    return build_context_window(user_id, dream_id, get_session_context(user_id, dream_id), step)
+
+
+async def aload_context_window(user_id: str, dream_id: str, step: int) -> str:
+    return await asyncio.to_thread(load_context_window, user_id, dream_id, step)
+
+
+# Queues a summary update for the turns [start, end) of a dream, unless one is already running for it
+def schedule_summary(user_id: str, dream_id: str, start: int, end: int):
+    key = (user_id, dream_id)
+    with summaries_lock:
+        if key in summaries_in_progress:
+            return
+        summaries_in_progress.add(key)
+    summarizer.submit(update_summary, user_id, dream_id, start, end)
+
+
+def update_summary(user_id: str, dream_id: str, start: int, end: int):
+    key = (user_id, dream_id)
+    try:
+        context = get_session_context(user_id, dream_id)
+        if context.get("convo_summary_turns", 0) != start:
+            return  # someone else already moved the summary forward
+        turns = split_turns(context.get("convo_context", ""))[start:end]
+        prompt = SUMMARY_PROMPT.format(
+            max_words=int(config.CONTEXT_SUMMARY_MAX_TOKENS * 0.75),
+            summary=context.get("convo_summary", "") or "(vacío)",
+            turns="".join(format_step_entry(s, t) for s, t in turns),
+        )
+        summary = summary_llm_client.complete(prompt, "summary").text.strip()
+        update_session_context(
+            user_id, dream_id, {"convo_summary": summary, "convo_summary_turns": end}
+        )
+        logger.info("[CONTEXT] Summary of %s/%s now covers %s turn(s)", user_id, dream_id, end)
+    except Exception as e:
+        logger.error("[CONTEXT] Failed to update summary of %s/%s: %s", user_id, dream_id, e)
+    finally:
+        with summaries_lock:
+            summaries_in_progress.discard(key)
+
+
+# Called on shutdown: lets the summary being written finish (so it gets flushed with the sessions) and drops the rest
+def stop_summarizer():
+    summarizer.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,210 @@
+import os
+import re
+import time
+import asyncio
+import hashlib
+import sqlite3
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# This block caches LLM answers for prompts we've already seen (e.g. the same dream sent twice to step 0).
+# There are two tiers: a small LRU in memory and a SQLite file on disk that survives restarts.
+# Each step has its own TTL, and a TTL of 0 turns the cache off for that step.
+# The disk tier is kept in check on write: every purge_every stores, expired rows are deleted and, if there are
+# still more than max_disk_entries, the ones closest to expiring go too.
+
+
+# Whitespace and unicode differences shouldn't make two prompts look different
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", prompt)).strip()
+
+
+def make_cache_key(model: str, step: int, prompt: str) -> str:
+    raw = f"{model}\x00{step}\x00{normalize_prompt(prompt)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Exact-match cache of LLM responses keyed by sha256(model, step, normalized prompt).
+
+    Args:
+        db_path (str): SQLite file for the persistent tier (None keeps everything in memory only)
+        max_entries (int): Size of the in-memory LRU tier
+        ttl_by_step (dict): Seconds a response stays valid for each step. Steps missing or with 0 are not cached
+        max_disk_entries (int): Rows kept in the SQLite tier (0 = no limit)
+        purge_every (int): Stores between two purges of the SQLite tier
+    """
+
+    def __init__(
+        self,
+        db_path: str = None,
+        max_entries: int = 2048,
+        ttl_by_step: dict = None,
+        max_disk_entries: int = 100000,
+        purge_every: int = 500,
+    ):
+        self.max_entries = max(1, max_entries)
+        self.ttl_by_step = ttl_by_step or {}
+        self.max_disk_entries = max_disk_entries
+        self.purge_every = max(1, purge_every)
+        self.writes_since_purge = 0
+        self.memory = OrderedDict()  # key -> (expires_at, text)
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+        self.step_counters = {}
+
+        self.conn = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.db_lock = threading.Lock()
+            with self.db_lock, self.conn:
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("PRAGMA synchronous=NORMAL")
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_cache ("
+                    " key TEXT PRIMARY KEY,"
+                    " step INTEGER NOT NULL,"
+                    " response TEXT NOT NULL,"
+                    " expires_at REAL NOT NULL)"
+                )
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_expires ON llm_cache (expires_at)")
+            # whatever expired while the app was down
+            self.purge_expired()
+
+    def is_cached_step(self, step: int) -> bool:
+        return self.ttl_by_step.get(step, 0) > 0
+
+    # counter is one of memory_hits, disk_hits or misses
+    def _count(self, step: int, counter: str):
+        with self.lock:
+            self.counters[counter] += 1
+            per_step = self.step_counters.setdefault(step, {"hits": 0, "misses": 0})
+            per_step["misses" if counter == "misses" else "hits"] += 1
+
+    def get(self, model: str, step: int, prompt: str):
+        """Returns the cached response text, or None if there isn't a valid one."""
+        if not self.is_cached_step(step):
+            return None
+        key = make_cache_key(model, step, prompt)
+        text = self._get_memory(key)
+        if text is not None:
+            self._count(step, "memory_hits")
+            return text
+
+        text = self._get_disk(key)
+        if text is not None:
+            self._count(step, "disk_hits")
+            return text
+        self._count(step, "misses")
+        return None
+
+    def _get_memory(self, key: str):
+        now = time.time()
+        with self.lock:
+            item = self.memory.get(key)
+            if item is None:
+                return None
+            if item[0] < now:
+                del self.memory[key]
+                return None
+            self.memory.move_to_end(key)
+            return item[1]
+
+    def _get_disk(self, key: str):
+        if self.conn is None:
+            return None
+        with self.db_lock:
+            row = self.conn.execute(
+                "SELECT response, expires_at FROM llm_cache WHERE key = ? AND expires_at >= ?",
+                (key, time.time()),
+            ).fetchone()
+        if row is None:
+            return None
+        # found on disk, keep it in memory for the next time
+        self._put_memory(key, row[0], row[1])
+        return row[0]
+
+    def _put_memory(self, key: str, text: str, expires_at: float):
+        with self.lock:
+            self.memory[key] = (expires_at, text)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def put(self, model: str, step: int, prompt: str, text: str):
+        """Stores a response (does nothing for steps that are not cached)."""
+        if not self.is_cached_step(step):
+            return
+        key = make_cache_key(model, step, prompt)
+        expires_at = time.time() + self.ttl_by_step[step]
+        self._put_memory(key, text, expires_at)
+        if self.conn is not None:
+            try:
+                with self.db_lock, self.conn:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO llm_cache (key, step, response, expires_at) VALUES (?, ?, ?, ?)",
+                        (key, step, text, expires_at),
+                    )
+            except sqlite3.Error as e:
+                # the cache is an optimisation, a failed write must never fail the request
+                logger.error(f"[LLM CACHE] Failed to store response: {e}")
+        with self.lock:
+            self.counters["stores"] += 1
+            self.writes_since_purge += 1
+            purge = self.writes_since_purge >= self.purge_every
+            if purge:
+                self.writes_since_purge = 0
+        if purge:
+            try:
+                self.purge_expired()
+            except sqlite3.Error as e:
+                logger.error(f"[LLM CACHE] Failed to purge the disk tier: {e}")
+
+    # Async versions: the memory tier is checked right away, only the SQLite part goes to a thread
+    async def aget(self, model: str, step: int, prompt: str):
+        if not self.is_cached_step(step):
+            return None
+        text = self._get_memory(make_cache_key(model, step, prompt))
+        if text is not None:
+            self._count(step, "memory_hits")
+            return text
+        if self.conn is None:
+            self._count(step, "misses")
+            return None
+        text = await asyncio.to_thread(self._get_disk, make_cache_key(model, step, prompt))
+        self._count(step, "misses" if text is None else "disk_hits")
+        return text
+
+    async def aput(self, model: str, step: int, prompt: str, text: str):
+        if self.is_cached_step(step):
+            await asyncio.to_thread(self.put, model, step, prompt, text)
+
+    def purge_expired(self):
+        """Deletes expired rows from the disk tier, then the ones closest to expiring above max_disk_entries."""
+        if self.conn is None:
+            return
+        with self.db_lock, self.conn:
+            self.conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (time.time(),))
+            if self.max_disk_entries > 0:
+                self.conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN ("
+                    " SELECT key FROM llm_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,),
+                )
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            return {
+                **self.counters,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_size": len(self.memory),
+                "by_step": {step: dict(c) for step, c in self.step_counters.items()},
+            }
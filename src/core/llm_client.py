@@ -0,0 +1,411 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from src import config
+
+logger = logging.getLogger(__name__)
+
+# 🛡️ Wrapper around the LLM that every call of the pipeline goes through. It gives each step a deadline
+# (retries included), retries failed calls with jittered backoff, can send a second identical request when
+# the first one is slower than usual for its step (hedging) and has a circuit breaker: after several failures
+# in a row it stops calling the LLM for a while and fails straight away, so a provider outage doesn't keep
+# every worker waiting on timeouts.
+
+# Shown to the user when the LLM can't be used (the API answers 503 with it)
+DEGRADED_RESPONSE = (
+    "El servicio de interpretación no está disponible en este momento. Inténtalo de nuevo en unos minutos."
+)
+
+
+class LLMError(Exception):
+    """The LLM call failed (after the retries)."""
+
+
+class LLMTimeoutError(LLMError):
+    """The LLM didn't answer before the deadline of the step."""
+
+
+# marks the end of a stream (the first chunk of an empty stream)
+_END = object()
+
+
+class LLMUnavailableError(LLMError):
+    """The circuit breaker is open, the LLM isn't being called right now."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# 4xx errors (except timeouts/conflicts/rate limits) are our fault: retrying won't help and they don't mean
+# the provider is unhealthy
+def is_retryable(error: Exception) -> bool:
+    status = getattr(error, "status_code", None)
+    return status is None or status >= 500 or status in (408, 409, 429)
+
+
+class CircuitBreaker:
+    """
+    closed -> open after max_failures failures in a row. open -> half_open after cooldown seconds, where one
+    trial call is let through: if it works the breaker closes, if not it opens again.
+    """
+
+    def __init__(self, max_failures: int, cooldown: float):
+        self.max_failures = max(1, max_failures)
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """Raises LLMUnavailableError if the call isn't allowed."""
+        with self.lock:
+            if self.state == "closed":
+                return
+            retry_after = self.opened_at + self.cooldown - time.monotonic()
+            if self.state == "open" and retry_after <= 0:
+                self.state = "half_open"
+            if self.state == "half_open" and not self.trial_running:
+                self.trial_running = True
+                return
+            raise LLMUnavailableError("The LLM circuit breaker is open", max(1.0, retry_after))
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                logger.info("[LLM] Circuit breaker closed, the LLM is answering again")
+            self.state = "closed"
+            self.failures = 0
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.max_failures):
+                logger.error(f"[LLM] Circuit breaker open for {self.cooldown}s after {self.failures} failure(s)")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    # a call that was let through but ended without a verdict (e.g. the client went away)
+    def release(self):
+        with self.lock:
+            self.trial_running = False
+
+    def status(self) -> dict:
+        with self.lock:
+            retry_after = self.opened_at + self.cooldown - time.monotonic() if self.state == "open" else 0
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "retry_after": round(max(0.0, retry_after), 1),
+            }
+
+
+class ResilientLLM:
+    """
+    Args:
+        llm: The llama_index LLM (complete / acomplete / astream_complete)
+        timeout_by_step (dict): Deadline in seconds per step (timeout for the rest)
+        max_retries (int): Extra attempts after a failed one, as long as the deadline allows
+        max_concurrency (int): LLM calls running at the same time (hedges included)
+        hedge (bool): Send a second request when the first is slower than the p95 of the step
+        breaker (CircuitBreaker): Defaults to one built from config
+        stream_idle_timeout (float): Seconds a stream can go without a chunk once it has started
+    """
+
+    def __init__(
+        self,
+        llm,
+        timeout: float = None,
+        timeout_by_step: dict = None,
+        max_retries: int = None,
+        max_concurrency: int = None,
+        hedge: bool = None,
+        breaker: CircuitBreaker = None,
+        stream_idle_timeout: float = None,
+    ):
+        self.llm = llm
+        self.model = llm.model
+        self.timeout = timeout or config.LLM_TIMEOUT
+        self.timeout_by_step = config.LLM_TIMEOUT_BY_STEP if timeout_by_step is None else timeout_by_step
+        self.max_retries = config.LLM_MAX_RETRIES if max_retries is None else max_retries
+        self.max_concurrency = max_concurrency or config.LLM_MAX_CONCURRENCY
+        self.hedge = config.LLM_HEDGE_ENABLED if hedge is None else hedge
+        self.breaker = breaker or CircuitBreaker(config.LLM_BREAKER_FAILURES, config.LLM_BREAKER_COOLDOWN)
+        self.stream_idle_timeout = stream_idle_timeout or config.LLM_STREAM_IDLE_TIMEOUT
+        self.pool = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="llm-call")
+        self.async_slots = None  # asyncio.Semaphore, created in the event loop on first use
+        self.latencies = {}  # step -> deque of the latest successful call durations
+        self.counters = {
+            "calls": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "timeouts": 0,
+            "failures": 0,
+            "rejected": 0,  # failed fast because the breaker was open
+        }
+        self.lock = threading.Lock()
+
+    def _count(self, counter: str):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _deadline(self, step) -> float:
+        return time.monotonic() + self.timeout_by_step.get(step, self.timeout)
+
+    def _record_latency(self, step, seconds: float):
+        with self.lock:
+            self.latencies.setdefault(step, deque(maxlen=200)).append(seconds)
+
+    def _percentile(self, step, fraction: float):
+        with self.lock:
+            samples = sorted(self.latencies.get(step, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    # Seconds to wait before hedging a call of this step (None = don't hedge)
+    def _hedge_delay(self, step):
+        if not self.hedge:
+            return None
+        with self.lock:
+            samples = len(self.latencies.get(step, ()))
+        if samples < config.LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return max(config.LLM_HEDGE_MIN_DELAY, self._percentile(step, 0.95))
+
+    def _backoff(self, attempt: int, deadline: float) -> float:
+        delay = min(8.0, 0.5 * 2**attempt) * random.uniform(0.5, 1.5)
+        return min(delay, max(0.0, deadline - time.monotonic()))
+
+    def _before_call(self):
+        try:
+            self.breaker.before_call()
+        except LLMUnavailableError:
+            self._count("rejected")
+            raise
+        self._count("calls")
+
+    # ---------------- sync ----------------
+
+    def complete(self, prompt: str, step=None):
+        """llm.complete with the deadline of the step, retries, hedging and the circuit breaker."""
+        self._before_call()
+        deadline = self._deadline(step)
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                response = self._attempt(prompt, step, deadline)
+            except LLMTimeoutError:
+                self._count("timeouts")
+                self.breaker.record_failure()
+                raise
+            except Exception as e:
+                retry = is_retryable(e) and attempt < self.max_retries and time.monotonic() < deadline
+                if not retry:
+                    self._fail(e)
+                    raise LLMError(f"LLM call failed: {e}") from e
+                self._count("retries")
+                logger.warning(f"[LLM] Step {step} call failed ({e}), retrying")
+                time.sleep(self._backoff(attempt, deadline))
+                attempt += 1
+                continue
+            self._record_latency(step, time.monotonic() - started)
+            self.breaker.record_success()
+            return response
+
+    def _attempt(self, prompt: str, step, deadline: float):
+        futures = [self.pool.submit(self.llm.complete, prompt)]
+        hedge_delay = self._hedge_delay(step)
+        if hedge_delay is not None:
+            done, _ = wait(futures, timeout=min(hedge_delay, max(0.0, deadline - time.monotonic())))
+            if not done and time.monotonic() < deadline:
+                self._count("hedges")
+                futures.append(self.pool.submit(self.llm.complete, prompt))
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                # the threads can't be stopped, they end with the client's own timeout
+                raise LLMTimeoutError(f"No answer from the LLM before the deadline of step {step}")
+            for future in done:
+                if future.exception() is None:
+                    if future is not futures[0]:
+                        self._count("hedge_wins")
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _fail(self, error: Exception):
+        self._count("failures")
+        if is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.release()
+
+    # ---------------- async ----------------
+
+    async def acomplete(self, prompt: str, step=None):
+        """Async version of complete (cancellable: the request is dropped if the caller is cancelled)."""
+        self._before_call()
+        deadline = self._deadline(step)
+        attempt = 0
+        try:
+            while True:
+                started = time.monotonic()
+                try:
+                    response = await self._aattempt(prompt, step, deadline)
+                except LLMTimeoutError:
+                    self._count("timeouts")
+                    self.breaker.record_failure()
+                    raise
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    retry = is_retryable(e) and attempt < self.max_retries and time.monotonic() < deadline
+                    if not retry:
+                        self._fail(e)
+                        raise LLMError(f"LLM call failed: {e}") from e
+                    self._count("retries")
+                    logger.warning(f"[LLM] Step {step} call failed ({e}), retrying")
+                    await asyncio.sleep(self._backoff(attempt, deadline))
+                    attempt += 1
+                    continue
+                self._record_latency(step, time.monotonic() - started)
+                self.breaker.record_success()
+                return response
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+
+    async def _acall(self, prompt: str):
+        if self.async_slots is None:
+            self.async_slots = asyncio.Semaphore(self.max_concurrency)
+        async with self.async_slots:
+            return await self.llm.acomplete(prompt)
+
+    async def _aattempt(self, prompt: str, step, deadline: float):
+        tasks = [asyncio.ensure_future(self._acall(prompt))]
+        try:
+            hedge_delay = self._hedge_delay(step)
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=min(hedge_delay, max(0.0, deadline - time.monotonic())))
+                if not done and time.monotonic() < deadline:
+                    self._count("hedges")
+                    tasks.append(asyncio.ensure_future(self._acall(prompt)))
+            error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise LLMTimeoutError(f"No answer from the LLM before the deadline of step {step}")
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self._count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # the losing / timed out requests are cancelled, which closes their connections
+            for task in tasks:
+                task.cancel()
+
+    async def astream_complete(self, prompt: str, step=None):
+        """
+        llm.astream_complete with the circuit breaker, the deadline of the step for the first chunk and
+        stream_idle_timeout between chunks. No retries or hedging: once tokens have been sent to the client
+        the call can't be repeated.
+        """
+        self._before_call()
+        started = time.monotonic()
+        deadline = self._deadline(step)
+        upstream = None
+        try:
+            upstream = await asyncio.wait_for(self.llm.astream_complete(prompt), deadline - time.monotonic())
+            # the request is only sent when the stream is first iterated, so the deadline covers the first chunk
+            try:
+                first = await asyncio.wait_for(upstream.__anext__(), max(0.0, deadline - time.monotonic()))
+            except StopAsyncIteration:
+                first = _END
+        except asyncio.TimeoutError:
+            self._count("timeouts")
+            self.breaker.record_failure()
+            await self._close(upstream)
+            raise LLMTimeoutError(f"The LLM stream of step {step} didn't start before the deadline")
+        except asyncio.CancelledError:
+            self.breaker.release()
+            await self._close(upstream)
+            raise
+        except Exception as e:
+            self._fail(e)
+            await self._close(upstream)
+            raise LLMError(f"LLM call failed: {e}") from e
+        return self._relay(upstream, first, step, started)
+
+    @staticmethod
+    async def _close(upstream):
+        if upstream is not None:
+            try:
+                await upstream.aclose()
+            except Exception:
+                pass
+
+    async def _relay(self, upstream, first, step, started: float):
+        finished = False
+        try:
+            chunk = first
+            while chunk is not _END:
+                yield chunk
+                try:
+                    chunk = await asyncio.wait_for(upstream.__anext__(), self.stream_idle_timeout)
+                except StopAsyncIteration:
+                    chunk = _END
+            finished = True
+        except asyncio.TimeoutError:
+            # a stuck upstream would otherwise keep the client's stream open forever
+            self._count("timeouts")
+            self.breaker.record_failure()
+            raise LLMTimeoutError(f"The LLM stream of step {step} sent nothing for {self.stream_idle_timeout}s")
+        except Exception as e:
+            self._fail(e)
+            raise LLMError(f"LLM stream failed: {e}") from e
+        finally:
+            await self._close(upstream)
+            if finished:
+                self._record_latency(step, time.monotonic() - started)
+                self.breaker.record_success()
+            else:
+                self.breaker.release()
+
+    def status(self) -> dict:
+        """Breaker state, counters and latency percentiles per step, for monitoring."""
+        with self.lock:
+            counters = dict(self.counters)
+            steps = list(self.latencies)
+        latency = {}
+        for step in steps:
+            p50, p95, p99 = (self._percentile(step, f) for f in (0.5, 0.95, 0.99))
+            latency[str(step)] = {"p50": round(p50, 3), "p95": round(p95, 3), "p99": round(p99, 3)}
+        return {
+            "model": self.model,
+            "breaker": self.breaker.status(),
+            "hedging": self.hedge,
+            "counters": counters,
+            "latency_seconds": latency,
+        }
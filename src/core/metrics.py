@@ -0,0 +1,260 @@
+import time
+import asyncio
+import bisect
+import threading
+
+from src.core.tracing import record_span
+
+# ================================
+# 📈 Metrics (Prometheus text format)
+# ================================
+# Counters, gauges and histograms served by GET /metrics. Recording has to cost next to nothing on the hot
+# path, so every thread writes to its own shard (a plain dict, no lock) and the shards are only added up when
+# /metrics is scraped. A scrape may miss an observation that is being written at that moment, it shows up in
+# the next one.
+#
+# Values that other parts of the app already count (cache hits, LLM client counters...) are not recorded
+# twice: a collector reads them from their stats() when /metrics is scraped.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.shards = []  # one dict per thread that recorded something: (metric name, label values) -> value
+        self.local = threading.local()
+        self.lock = threading.Lock()  # only taken when a thread records for the first time
+
+    def _shard(self) -> dict:
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def counter(self, name: str, help: str, labels: tuple = ()):
+        return self._register(Counter(self, name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple = ()):
+        return self._register(Gauge(self, name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, help, labels, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """
+        collect() is called on every scrape and returns a list of (name, type, help, samples), where samples
+        is a list of ({label: value}, number).
+        """
+        self.collectors.append(collect)
+
+    # Adds up the shards: (name, label values) -> value (a list for histograms)
+    def _merge(self) -> dict:
+        with self.lock:
+            shards = list(self.shards)
+        merged = {}
+        for shard in shards:
+            for key, value in list(shard.items()):
+                if isinstance(value, list):
+                    total = merged.setdefault(key, [0] * len(value))
+                    for i, v in enumerate(value):
+                        total[i] += v
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self) -> str:
+        """Everything in the Prometheus text exposition format (version 0.0.4)."""
+        merged = self._merge()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            values = sorted((key[1], value) for key, value in merged.items() if key[0] == metric.name)
+            for label_values, value in values:
+                labels = dict(zip(metric.labels, label_values))
+                lines.extend(metric.samples(labels, value))
+        for collect in self.collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                lines.append(f"# collector failed: {e}")
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, registry: MetricsRegistry, name: str, help: str, labels: tuple):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def inc(self, *label_values, amount: float = 1):
+        shard = self.registry._shard()
+        key = (self.name, tuple(str(v) for v in label_values))
+        shard[key] = shard.get(key, 0) + amount
+
+    def samples(self, labels: dict, value) -> list:
+        return [f"{self.name}{format_labels(labels)} {format_value(value)}"]
+
+
+class Gauge(Counter):
+    """
+    Goes up and down (e.g. requests in flight). inc and dec of the same request must run in the same thread,
+    one shard can go below 0 but the sum of all of them is right.
+    """
+
+    type = "gauge"
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, registry: MetricsRegistry, name: str, help: str, labels: tuple, buckets: tuple):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values):
+        shard = self.registry._shard()
+        key = (self.name, tuple(str(v) for v in label_values))
+        counts = shard.get(key)
+        if counts is None:
+            # one count per bucket (not cumulative, they're added up when rendered), +Inf, sum, count
+            counts = shard[key] = [0] * (len(self.buckets) + 3)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def samples(self, labels: dict, counts: list) -> list:
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), counts):
+            cumulative += count
+            le = bound if bound == "+Inf" else format_value(bound)
+            lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': le})} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(counts[-2])}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {counts[-1]}")
+        return lines
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value) -> str:
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+# ================================
+# /analyze metrics
+# ================================
+registry = MetricsRegistry()
+
+stage_seconds = registry.histogram(
+    "dream_analyze_stage_seconds",
+    "Seconds spent in each stage of an analysis (total, validation, session_load, prompt_build, llm_call, "
+    "session_save), per step",
+    ("step", "stage"),
+)
+requests_total = registry.counter(
+    "dream_analyze_requests_total",
+    "Analyses finished, per endpoint, step and HTTP status",
+    ("endpoint", "step", "status"),
+)
+errors_total = registry.counter("dream_analyze_errors_total", "Failed analyses by type of error", ("type",))
+in_flight = registry.gauge("dream_analyze_in_flight", "Analyses being processed right now", ("endpoint",))
+
+
+class stage_timer:
+    """
+    Times a block into dream_analyze_stage_seconds (and into the trace of the request, see tracing.py):
+
+        with stage_timer(step, "llm_call"):
+            ...
+    """
+
+    __slots__ = ("step", "stage", "started")
+
+    def __init__(self, step, stage: str):
+        self.step = step
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        stage_seconds.observe(elapsed, self.step, self.stage)
+        record_span(self.stage, elapsed)  # shows up in the Server-Timing header too
+        return False
+
+
+class track_request:
+    """
+    Counts an analysis as in flight while the block runs, then records its total time and its status (the
+    status_code of the exception it raised, 499 if the client went away, 500 for any other exception).
+
+        with track_request("analyze", step):
+            ...
+    """
+
+    __slots__ = ("endpoint", "step", "started")
+
+    def __init__(self, endpoint: str, step):
+        self.endpoint = endpoint
+        self.step = step
+
+    def __enter__(self):
+        in_flight.inc(self.endpoint)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        stage_seconds.observe(time.perf_counter() - self.started, self.step, "total")
+        in_flight.dec(self.endpoint)
+        if exc is None:
+            status = 200
+        elif isinstance(exc, (asyncio.CancelledError, GeneratorExit)):
+            status = 499
+        else:
+            status = getattr(exc, "status_code", 500)
+            if not hasattr(exc, "status_code"):
+                # unexpected failures, the expected ones (LLM, admission, validation) are counted where they happen
+                errors_total.inc(type(exc).__name__)
+        requests_total.inc(self.endpoint, self.step, status)
+        return False
+
+
+def count_error(error_type: str):
+    errors_total.inc(error_type)
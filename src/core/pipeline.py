@@ -1,92 +1,277 @@
-# from llama_index.core.indices.vector_store.base import VectorStoreIndex
-# from llama_index.core import SimpleDirectoryReader
 from llama_index.llms.openai import OpenAI
 import os
+import json
+import time
+import asyncio
 from dotenv import load_dotenv
+from src import config
+from src.core.llm_cache import LLMResponseCache, make_cache_key
+from src.core.llm_client import ResilientLLM
+from src.core.metrics import stage_seconds, stage_timer
+from src.core.retrieval import (
+    aretrieve_knowledge,
+    build_retrieval_query,
+    format_knowledge,
+    retrieve_knowledge,
+)
+from src.core.single_flight import SingleFlight
+from src.core.structured_logging import log_event, setup_logging
+from src.core.symbol_lexicon import SymbolLexicon
+from src.core.tracing import span
 
 # ---------------------------------------------------
 import logging
 
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 # ---------------------------------------------------
 
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 
-llm = OpenAI(model="gpt-4o-mini", api_key=api_key)
-
-# Load Jungian Knowledge
-jungian_index = None
-
-# Reads files from a jungian_knowledge folder and indexes them using a vector store
-# The below would create the embeddins
-# ----------------------------------------------------------------------------------------------
-# def load_jungian_index():
-#     docs = SimpleDirectoryReader("./data/jungian_knowledge").load_data()
-#     return VectorStoreIndex.from_documents(docs)
-
-# if jungian_index is None:
-#     jungian_index = load_jungian_index()
-#     jungian_engine = jungian_index.as_query_engine()
-# ----------------------------------------------------------------------------------------------
-
-# The below calls a databse (still need to set this up)
-# Change ChromeVectorStore to Pinecone
-# Initialize the vector store (e.g., Chroma, FAISS, etc.)
-# vector_store = ChromaVectorStore(persist_dir="./db")  # update path as needed
-# storage_context = StorageContext.from_defaults(vector_store=vector_store)
-
-# Load the index from the persisted vector store
-# jungian_index = VectorStoreIndex.from_vector_store(vector_store, storage_context=storage_context)
-# jungian_engine = jungian_index.as_query_engine()
-
-
-# The process_dream_step function analyzes a step in a dream interpretation process by generating a tailored prompt, querying
-# a Jungian semantic engine for symbolic insight, and optionally falling back to a general language model if the Jungian response
-# is insufficient. It returns a formatted interpretation combining both sources when needed.
-# def process_dream_step(step: int, data: dict, context: dict) -> str:
-#     query_str = build_prompt_from_step(step, data, context)
-#     jungian_response = jungian_engine.query(query_str)
-#     if len(jungian_response.response.strip()) > 100:
-#         return f"**Jungian Interpretation:**\n{jungian_response.response.strip()}"
-#     else:
-#         fallback = llm.query(query_str)
-#         return f"**Jungian Interpretation (Limited):**\n{jungian_response.response.strip()}\n\n**General Psychological Insight:**\n{fallback.response.strip()}"
-
-
-# ----only until I have Jung documentation (above code to access DB)-----------------------
-# The process_dream_step function generates a prompt based on the dream data and context, then uses a general language model
-# to produce a psychological interpretation. It returns the result as a formatted string labeled "Psychological Insight."
+# retries and timeouts are handled by llm_client, the OpenAI client only has to give up after the longest deadline
+llm = OpenAI(
+    model="gpt-4o-mini",
+    api_key=api_key,
+    max_retries=0,
+    timeout=max([config.LLM_TIMEOUT, *config.LLM_TIMEOUT_BY_STEP.values()]),
+)
+# every LLM call goes through here: per-step deadlines, retries, hedging and the circuit breaker
+llm_client = ResilientLLM(llm)
+# the background summaries of context_window.py have a client (and so a circuit breaker) of their own: a failing
+# summary must not open the breaker of the interpretations users are waiting for. They're never hedged either
+summary_llm_client = ResilientLLM(llm, hedge=False, max_concurrency=1)
+
+# Repeated prompts (e.g. the same dream sent twice to step 0) are answered from here without calling the LLM
+response_cache = LLMResponseCache(
+    db_path=config.LLM_CACHE_PATH if config.LLM_CACHE_ENABLED else None,
+    max_entries=config.LLM_CACHE_SIZE,
+    ttl_by_step=config.LLM_CACHE_TTL_BY_STEP if config.LLM_CACHE_ENABLED else {},
+    max_disk_entries=config.LLM_CACHE_MAX_DISK_ENTRIES,
+    purge_every=config.LLM_CACHE_PURGE_EVERY,
+)
+
+# Identical prompts that arrive while the first one is still waiting on the LLM (double-clicks, client retries)
+# share that one call instead of making their own
+llm_calls = SingleFlight()
+
+# 🔎 Step 0 symbols: the local lexicon finds the common symbols of a dream in microseconds. When they cover
+# most of the dream that's the answer and the LLM isn't called, otherwise they go into the prompt as hints
+symbol_lexicon = SymbolLexicon(extra_path=config.SYMBOL_LEXICON_PATH)
+
+
+def lexicon_symbols(step: int, data: dict) -> tuple:
+    """
+    Returns (answer, hints) for a step: answer is the response text when the lexicon alone is enough
+    (None otherwise) and hints the symbols to suggest to the LLM. (None, []) for the other steps.
+    """
+    if step != 0 or config.SYMBOL_LEXICON_MODE == "off":
+        return None, []
+    result = symbol_lexicon.extract(data.get("dream") or "")
+    symbols = result["symbols"]
+    if (
+        config.SYMBOL_LEXICON_MODE == "hybrid"
+        and result["coverage"] >= config.SYMBOL_LEXICON_MIN_COVERAGE
+        and len(symbols) >= config.SYMBOL_LEXICON_MIN_SYMBOLS
+    ):
+        symbol_lexicon.count("answered")
+        log_event(logger, "lexicon.answered", symbols=len(symbols), coverage=result["coverage"])
+        # same format the prompt asks the LLM for
+        return json.dumps(symbols, ensure_ascii=False), []
+    symbol_lexicon.count("hinted")
+    log_event(logger, "lexicon.hinted", symbols=len(symbols), coverage=result["coverage"])
+    return None, symbols
+
+
+# 📖 Jungian knowledge: steps 1 and 2 get the closest chunks of the knowledge base (the vector index built by
+# scripts/embed_documents.py) added to their prompt. The lookup (embed the query + top-k from the index) is
+# started as a background task as soon as the input is validated, so it runs while the session is loaded and
+# the prompt is assembled, and it's cached per normalized query. If it fails or is too slow the step just goes
+# ahead without knowledge.
+def start_retrieval(step: int, data: dict):
+    """Starts the knowledge lookup of a step in the background. Returns the task (None if the step has no retrieval)."""
+    query = build_retrieval_query(step, data)
+    if not query:
+        return None
+    return asyncio.create_task(aretrieve_knowledge(query))
+
+
+# Waits (at most RETRIEVAL_TIMEOUT) for a lookup started with start_retrieval and returns the prompt section
+async def await_knowledge(step: int, retrieval) -> str:
+    if retrieval is None:
+        return ""
+    try:
+        chunks = await asyncio.wait_for(retrieval, config.RETRIEVAL_TIMEOUT)
+    except asyncio.TimeoutError:
+        log_event(logger, "retrieval.timeout", logging.WARNING, step=step, timeout=config.RETRIEVAL_TIMEOUT)
+        return ""
+    except Exception as e:
+        log_event(logger, "retrieval.failed", logging.WARNING, step=step, error=repr(e))
+        return ""
+    log_event(logger, "retrieval.added", step=step, chunks=len(chunks))
+    return format_knowledge(chunks)
+
+
+# Makes sure a lookup started with start_retrieval doesn't outlive its request: cancelled if it's still running
+# (the request failed before using it), and its exception, if any, consumed so asyncio doesn't log
+# "Task exception was never retrieved"
+async def discard_retrieval(retrieval):
+    if retrieval is None:
+        return
+    if not retrieval.done():
+        retrieval.cancel()
+    await asyncio.gather(retrieval, return_exceptions=True)
+
+
+# Same lookup for the sync pipeline
+def get_knowledge(step: int, data: dict) -> str:
+    query = build_retrieval_query(step, data)
+    if not query:
+        return ""
+    try:
+        return format_knowledge(retrieve_knowledge(query))
+    except Exception as e:
+        log_event(logger, "retrieval.failed", logging.WARNING, step=step, error=repr(e))
+        return ""
+
+
+# The process_dream_step function generates a prompt based on the dream data, the context and the Jungian knowledge
+# retrieved for it, then uses a general language model to produce a psychological interpretation. It returns the
+# result as a formatted string labeled "Psychological Insight."
 def process_dream_step(step: int, data: dict, convo_context: dict) -> str:
-    logger.info(f"[PROCESS STEP {step}] Input data: {data}")
-    logger.info(
-        f"[PROCESS STEP {step}] Convo context (truncated): {convo_context[:200]}"
-    )
+    log_event(logger, "pipeline.input", step=step, input_data=data, convo_context=convo_context)
+
+    answer, hints = lexicon_symbols(step, data)
+    if answer is not None:
+        return f"**Psychological Insight:**\n{answer}"
+
+    with span("knowledge"):
+        knowledge = get_knowledge(step, data)
+    with stage_timer(step, "prompt_build"):
+        query_str = build_prompt_from_step(step, data, convo_context, knowledge, hints)
+    log_event(logger, "pipeline.prompt", step=step, prompt=query_str)
+
+    with span("cache_lookup"):
+        response_text = response_cache.get(llm.model, step, query_str)
+    if response_text is not None:
+        log_event(logger, "pipeline.cache_hit", step=step)
+    else:
 
-    query_str = build_prompt_from_step(step, data, convo_context)
-    logger.info(f"[PROCESS STEP {step}] Built prompt:\n{query_str[:500]}")
+        def call_llm():
+            text = llm_client.complete(query_str, step).text.strip()
+            response_cache.put(llm.model, step, query_str, text)
+            return text
 
-    llm_response = llm.complete(query_str)
-    response_text = llm_response.text.strip()  # this is only here so that I can log it
-    logger.info(f"[PROCESS STEP {step}] LLM response:\n{response_text[:500]}")
+        with stage_timer(step, "llm_call"):
+            response_text = llm_calls.do(make_cache_key(llm.model, step, query_str), call_llm)
+    log_event(logger, "pipeline.response", step=step, response=response_text)
 
-    return f"**Psychological Insight:**\n{llm_response.text.strip()}"
+    return f"**Psychological Insight:**\n{response_text}"
+
+
+# Async version of process_dream_step, used by the API routes. It awaits llm.acomplete so the event loop can
+# keep serving other requests while this one waits on OpenAI, instead of blocking a threadpool worker.
+# retrieval is the task from start_retrieval when the caller already started it (otherwise it's started here).
+async def aprocess_dream_step(step: int, data: dict, convo_context: str, retrieval=None) -> str:
+    log_event(logger, "pipeline.input", step=step, input_data=data, convo_context=convo_context)
+
+    answer, hints = lexicon_symbols(step, data)
+    if answer is not None:
+        return f"**Psychological Insight:**\n{answer}"
+
+    if retrieval is None:
+        retrieval = start_retrieval(step, data)
+    with span("knowledge"):
+        knowledge = await await_knowledge(step, retrieval)
+    with stage_timer(step, "prompt_build"):
+        query_str = build_prompt_from_step(step, data, convo_context, knowledge, hints)
+    log_event(logger, "pipeline.prompt", step=step, prompt=query_str)
+
+    with span("cache_lookup"):
+        response_text = await response_cache.aget(llm.model, step, query_str)
+    if response_text is not None:
+        log_event(logger, "pipeline.cache_hit", step=step)
+    else:
+
+        async def call_llm():
+            text = (await llm_client.acomplete(query_str, step)).text.strip()
+            await response_cache.aput(llm.model, step, query_str, text)
+            return text
+
+        with stage_timer(step, "llm_call"):
+            response_text = await llm_calls.ado(make_cache_key(llm.model, step, query_str), call_llm)
+    log_event(logger, "pipeline.response", step=step, response=response_text)
+
+    return f"**Psychological Insight:**\n{response_text}"
+
+
+# Streaming version of process_dream_step. Instead of waiting for the whole interpretation it yields the text
+# piece by piece as the model produces it, so the frontend can start showing the answer straight away.
+# The header is yielded first so the user sees something before the first token arrives.
+async def stream_dream_step(step: int, data: dict, convo_context: str, retrieval=None):
+    log_event(logger, "pipeline.input", step=step, input_data=data, stream=True)
+
+    answer, hints = lexicon_symbols(step, data)
+    if answer is not None:
+        yield "**Psychological Insight:**\n"
+        yield answer
+        return
+
+    if retrieval is None:
+        retrieval = start_retrieval(step, data)
+    with span("knowledge"):
+        knowledge = await await_knowledge(step, retrieval)
+    with stage_timer(step, "prompt_build"):
+        query_str = build_prompt_from_step(step, data, convo_context, knowledge, hints)
+    log_event(logger, "pipeline.prompt", step=step, prompt=query_str, stream=True)
+
+    yield "**Psychological Insight:**\n"
+
+    with span("cache_lookup"):
+        cached = await response_cache.aget(llm.model, step, query_str)
+    if cached is not None:
+        yield cached
+        return
+
+    parts = []
+    # llm_call here is the whole generation, from the request to the last token
+    started = time.perf_counter()
+    token_stream = await llm_client.astream_complete(query_str, step)
+    try:
+        async for chunk in token_stream:
+            if chunk.delta:
+                parts.append(chunk.delta)
+                yield chunk.delta
+    finally:
+        # if the client goes away we stop reading, this closes the upstream request too
+        await token_stream.aclose()
+    stage_seconds.observe(time.perf_counter() - started, step, "llm_call")
+
+    # only reached when the whole response was generated
+    await response_cache.aput(llm.model, step, query_str, "".join(parts).strip())
 
 
 # ------------------------------------------------------------------------
 
 # This dynamically builds prompts based on which part of the dream interpretation process you're in. It tailors
-# the language to match Jungian analysis at each step.
+# the language to match Jungian analysis at each step. knowledge is the section with the retrieved Jungian
+# knowledge (steps 1 and 2), "" when there is none. hints are the symbols the lexicon already found (step 0).
 
 
-def build_prompt_from_step(step, data, convo_context):
+def build_prompt_from_step(step, data, convo_context, knowledge="", hints=None):
     if step == 0:
+        hints_block = (
+            f"Símbolos ya detectados (confírmalos, descarta los que no encajen y añade los que falten): "
+            f"{', '.join(hints)}\n\n"
+            if hints
+            else ""
+        )
         return (
             f"Responde en español (España).\n"
             f"Identifica y extrae los símbolos principales presentes en el siguiente sueño, "
             f"utilizando el enfoque de la teoría junguiana.\n"
             f"Devuelve solo un array de cadenas de texto con los símbolos extraídos (sin explicación u otro texto).\n\n"
+            f"{hints_block}"
             f"Sueño: {data.get('dream')}"
         )
     elif step == 1:
@@ -111,6 +296,7 @@ def build_prompt_from_step(step, data, convo_context):
             "El título generalmente indica el tema central o la dinámica subyacente.\n\n"
             # "Finalmente, proporciona una conclusión práctica conectada con su situación actual. Habla de forma directa al usuario, como si conversaras con él (sin consejos médicos o terapéuticos).\n\n"
             "Finalmente, proporciona una conclusión práctica conectada con su situación actual. Habla de forma directa al usuario(sin consejos médicos o terapéuticos). Habla siempre con el usuario como si estuvieras conversando directamente con él.\n\n"
+            f"{knowledge}"
             f"Título: {data.get('title')}\n"
             f"Sueño: {data.get('dream')}\n"
             f"Símbolos extraídos: {', '.join(symbols_only)}\n"
@@ -123,6 +309,7 @@ def build_prompt_from_step(step, data, convo_context):
         return (
             f"Responde en español (España), aplicando teoría junguiana.\n\n"
             f"Contexto de lo discutido hasta ahora:\n{convo_context}\n\n"
+            f"{knowledge}"
             f"El usuario ha resonado con: {data.get('resonated')}.\n"
             f"No ha estado de acuerdo con: {data.get('disagreed')}.\n"
             f"Ofrece una interpretación junguiana más profunda basándote en esta información.\n"
@@ -0,0 +1,153 @@
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from src import config
+from src.core.llm_cache import normalize_prompt
+
+logger = logging.getLogger(__name__)
+
+# This block finds the Jungian knowledge (the Notion page and ../data/raw documents that embed_documents.py
+# uploads to the vector index) that is relevant to a step: the query is embedded, the top-k closest chunks
+# are fetched and formatted as a section of the prompt. Results are cached per normalized query, so the same
+# dream asked again (or retried) doesn't pay for the embedding and the index round trip twice.
+
+# only the knowledge base, not the interpretations indexed by the API (INDEX_INTERPRETATIONS)
+KNOWLEDGE_FILTER = {"source": {"$in": ["notion", "local"]}}
+
+
+class RetrievalCache:
+    """
+    In-memory LRU of retrieval results keyed by sha256(backend, top_k, normalized query).
+
+    Args:
+        max_entries (int): Queries kept
+        ttl (int): Seconds a result stays valid (the index only changes when the knowledge base is synced)
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: int = 3600):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, chunks)
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def make_key(query: str, top_k: int) -> str:
+        raw = f"{config.VECTOR_BACKEND}\x00{top_k}\x00{normalize_prompt(query).lower()}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, query: str, top_k: int):
+        key = self.make_key(query, top_k)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, query: str, top_k: int, chunks: list):
+        if self.ttl <= 0:
+            return
+        key = self.make_key(query, top_k)
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, chunks)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.counters["hits"] + self.counters["misses"]
+            return {
+                **self.counters,
+                "entries": len(self.entries),
+                "hit_rate": round(self.counters["hits"] / total, 3) if total else 0.0,
+            }
+
+
+retrieval_cache = RetrievalCache(config.RETRIEVAL_CACHE_SIZE, config.RETRIEVAL_CACHE_TTL)
+
+
+# The text that is embedded for a step: what the dream is about (step 1) or what the user reacted to (step 2).
+# Empty for the steps without retrieval
+def build_retrieval_query(step: int, data: dict) -> str:
+    if not config.RETRIEVAL_ENABLED or step not in config.RETRIEVAL_STEPS:
+        return ""
+    if step == 1:
+        symbols = [s["symbol"] for s in data.get("symbols", []) if "symbol" in s]
+        parts = [data.get("title"), data.get("dream"), ", ".join(symbols), data.get("emotion")]
+    elif step == 2:
+        parts = [data.get("resonated"), data.get("disagreed")]
+    else:
+        parts = [data.get("dream") or data.get("goal")]
+    return "\n".join(str(part) for part in parts if part)
+
+
+def retrieve_knowledge(query: str, top_k: int = None) -> list:
+    """
+    Returns the knowledge chunks closest to the query, best first.
+
+    Returns:
+        list[dict]: {"text", "score", "title"} per chunk (only matches above RETRIEVAL_MIN_SCORE)
+    """
+    top_k = top_k or config.RETRIEVAL_TOP_K
+    if not query.strip():
+        return []
+    cached = retrieval_cache.get(query, top_k)
+    if cached is not None:
+        return cached
+    return search_knowledge(query, top_k)
+
+
+# Embeds the query and searches the index (no cache lookup), the result is stored in the cache
+def search_knowledge(query: str, top_k: int) -> list:
+    # imported here so the pipeline doesn't need the vector backend unless retrieval is used
+    from src.services.embedding import get_embedding
+    from src.services.vector_store import query_embedding
+
+    result = query_embedding(get_embedding(query), top_k=top_k, filter=KNOWLEDGE_FILTER)
+    chunks = []
+    for match in result.get("matches", []):
+        metadata = match.get("metadata") or {}
+        # vectors uploaded before the chunk text was stored in the metadata can't be used
+        if match.get("score", 0) < config.RETRIEVAL_MIN_SCORE or not metadata.get("text"):
+            continue
+        chunks.append(
+            {
+                "text": metadata["text"][: config.RETRIEVAL_MAX_CHARS],
+                "score": round(float(match["score"]), 4),
+                "title": metadata.get("title") or metadata.get("file", ""),
+            }
+        )
+    retrieval_cache.put(query, top_k, chunks)
+    return chunks
+
+
+async def aretrieve_knowledge(query: str, top_k: int = None) -> list:
+    """Async version of retrieve_knowledge (cache hits are answered without leaving the event loop)."""
+    top_k = top_k or config.RETRIEVAL_TOP_K
+    if not query.strip():
+        return []
+    cached = retrieval_cache.get(query, top_k)
+    if cached is not None:
+        return cached
+    return await asyncio.to_thread(search_knowledge, query, top_k)
+
+
+# The prompt section with the retrieved chunks ("" when there are none)
+def format_knowledge(chunks: list) -> str:
+    if not chunks:
+        return ""
+    lines = ["Conocimiento junguiano de referencia (úsalo solo si es relevante para este sueño):"]
+    for i, chunk in enumerate(chunks, 1):
+        source = f" ({chunk['title']})" if chunk.get("title") else ""
+        lines.append(f"[{i}]{source} {chunk['text'].strip()}")
+    return "\n".join(lines) + "\n\n"
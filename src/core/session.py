@@ -1,26 +1,86 @@
-import os
-import json
+import asyncio
+
+from src import config
+from src.core.tracing import span
+from src.core.session_store import (
+    CachedSessionStore,
+    FileSessionStore,
+    MongoSessionStore,
+    SQLiteSessionStore,
+)
 
 # This block handles session management.
 
-# Sets a directory where user session data will be stored as .json files.
-# THIS MUST BE CHANGED TO A DATABASE
-SESSION_PATH = "./session_data/"
+# Sets a directory where user session data will be stored as .json files (when SESSION_BACKEND is "file").
+SESSION_PATH = config.SESSION_PATH
+
+
+# Picks the backend from the config and puts the in-memory LRU cache in front of it,
+# so steps 1 -> 2 -> 3 of the same dream are served from memory
+def create_session_store():
+    if config.SESSION_BACKEND == "file":
+        backend = FileSessionStore(
+            SESSION_PATH,
+            compact_every=config.SESSION_LOG_COMPACT_EVERY,
+            fsync=config.SESSION_LOG_FSYNC,
+        )
+    elif config.SESSION_BACKEND == "sqlite":
+        backend = SQLiteSessionStore(config.SESSION_DB_PATH)
+    elif config.SESSION_BACKEND == "mongo":
+        backend = MongoSessionStore(config.SESSION_COLLECTION)
+    else:
+        raise ValueError(f"Unknown SESSION_BACKEND: {config.SESSION_BACKEND}")
+
+    return CachedSessionStore(
+        backend,
+        max_entries=config.SESSION_CACHE_SIZE,
+        flush_interval=config.SESSION_FLUSH_INTERVAL,
+    )
+
 
+session_store = create_session_store()
 
-# finds or creates a session folder
+
+# finds the session of a dream (empty dict if it's new)
 def get_session_context(user_id: str, dream_id: str) -> dict:
-    os.makedirs(SESSION_PATH, exist_ok=True)
-    filepath = os.path.join(SESSION_PATH, f"{user_id}_{dream_id}.json")
-    if os.path.exists(filepath):
-        with open(filepath, "r") as f:
-            return json.load(f)
-    return {}
+    with span("session_read"):
+        return session_store.load(user_id, dream_id)
 
 
-# Saves session context dictionary back to their session file
+# Saves session context dictionary back to the store (written to the backend in the background)
 def save_session_context(user_id: str, dream_id: str, context: dict):
-    os.makedirs(SESSION_PATH, exist_ok=True)
-    filepath = os.path.join(SESSION_PATH, f"{user_id}_{dream_id}.json")
-    with open(filepath, "w") as f:
-        json.dump(context, f)
+    with span("session_write"):
+        session_store.save(user_id, dream_id, context)
+
+
+# Adds the response of a step to the convo context. Cheaper than get + save: only the new step is written
+def append_session_step(user_id: str, dream_id: str, step: int, response: str):
+    with span("session_write"):
+        session_store.append_step(user_id, dream_id, step, response)
+
+
+# Sets some fields of the session (like the convo summary) without overwriting steps saved in the meantime
+def update_session_context(user_id: str, dream_id: str, fields: dict):
+    session_store.update(user_id, dream_id, fields)
+
+
+# Writes every pending session to the backend. Called when the API shuts down
+def flush_sessions():
+    session_store.close()
+
+
+def session_cache_stats() -> dict:
+    return session_store.stats()
+
+
+# Async versions for the API routes. The file I/O runs in a worker thread so it doesn't block the event loop
+async def aget_session_context(user_id: str, dream_id: str) -> dict:
+    return await asyncio.to_thread(get_session_context, user_id, dream_id)
+
+
+async def asave_session_context(user_id: str, dream_id: str, context: dict):
+    await asyncio.to_thread(save_session_context, user_id, dream_id, context)
+
+
+async def aappend_session_step(user_id: str, dream_id: str, step: int, response: str):
+    await asyncio.to_thread(append_session_step, user_id, dream_id, step, response)
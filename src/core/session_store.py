@@ -0,0 +1,458 @@
+import os
+import json
+import copy
+import time
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# This block holds the different places a session (the convo context of one dream) can be stored.
+# All of them follow the same SessionStore interface so session.py doesn't care which one is used.
+# CachedSessionStore sits in front of any of them and keeps the hot sessions in memory.
+
+
+class SessionStore(ABC):
+    """Interface every session backend implements. A session is identified by (user_id, dream_id)."""
+
+    @abstractmethod
+    def load(self, user_id: str, dream_id: str) -> dict:
+        """Returns the stored context, or an empty dict if the session doesn't exist yet."""
+
+    @abstractmethod
+    def save(self, user_id: str, dream_id: str, context: dict):
+        """Replaces the stored context of the session."""
+
+    def append_step(self, user_id: str, dream_id: str, step: int, response: str):
+        """Adds the response of a step to the end of convo_context. Backends override this when they can
+        append without rewriting the whole session."""
+        context = self.load(user_id, dream_id)
+        context["convo_context"] = context.get("convo_context", "") + format_step_entry(step, response)
+        self.save(user_id, dream_id, context)
+
+    def update(self, user_id: str, dream_id: str, fields: dict):
+        """Sets some keys of the context (e.g. the summary) without touching the rest."""
+        context = self.load(user_id, dream_id)
+        context.update(fields)
+        self.save(user_id, dream_id, context)
+
+    def close(self):
+        """Releases connections/files. Nothing to do by default."""
+
+
+# The text each step adds to the convo context
+def format_step_entry(step: int, response: str) -> str:
+    return f"\nPaso {step}:\n{response}\n"
+
+
+class FileSessionStore(SessionStore):
+    """
+    One snapshot file plus one append-only log per dream.
+
+    ./session_data/{user_id}_{dream_id}.json is the snapshot (same format as the old session files, so they
+    keep working) and {user_id}_{dream_id}.log has one JSON line per step added since the snapshot. A step is
+    a single small append instead of rewriting the whole conversation, and the context is only rebuilt
+    (snapshot + log) when it is read. Every compact_every steps the log is folded into a new snapshot.
+
+    Each log line has a sequence number and the snapshot remembers the last one it contains, so a crash
+    between writing the snapshot and truncating the log never applies a step twice. Snapshots are written
+    to a temp file and renamed, and a half-written last log line is ignored, so a crash can't corrupt a session.
+
+    Args:
+        path (str): Folder for the session files
+        compact_every (int): Number of logged steps that triggers a compaction
+        fsync (bool): fsync every append (slower, but survives power loss and not just a process crash)
+    """
+
+    SEQ_KEY = "_log_seq"
+
+    def __init__(self, path: str, compact_every: int = 16, fsync: bool = False):
+        self.path = path
+        self.compact_every = max(1, compact_every)
+        self.fsync = fsync
+        # created once here instead of on every read and write
+        os.makedirs(self.path, exist_ok=True)
+        # per-dream locks so two threads never append/compact the same session at once
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        # (last seq written, lines in the log) per dream, filled the first time we touch it
+        self.log_state = {}
+
+    def _filepath(self, user_id: str, dream_id: str) -> str:
+        return os.path.join(self.path, f"{user_id}_{dream_id}.json")
+
+    def _logpath(self, user_id: str, dream_id: str) -> str:
+        return os.path.join(self.path, f"{user_id}_{dream_id}.log")
+
+    def _lock(self, key) -> threading.Lock:
+        with self.locks_lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def _read_snapshot(self, user_id: str, dream_id: str) -> dict:
+        filepath = self._filepath(user_id, dream_id)
+        if os.path.exists(filepath):
+            with open(filepath, "r") as f:
+                return json.load(f)
+        return {}
+
+    # log entries newer than the snapshot. A torn last line (crash mid append) is cut off the file,
+    # otherwise the next append would be glued onto it
+    def _read_log(self, user_id: str, dream_id: str, after_seq: int) -> list:
+        logpath = self._logpath(user_id, dream_id)
+        if not os.path.exists(logpath):
+            return []
+        entries = []
+        good_size = 0
+        with open(logpath, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"[SESSION] Skipping unreadable log line in {logpath}")
+                else:
+                    if entry["seq"] > after_seq:
+                        entries.append(entry)
+                good_size += len(line)
+        if good_size < os.path.getsize(logpath):
+            logger.warning(f"[SESSION] Dropping half-written last line of {logpath}")
+            os.truncate(logpath, good_size)
+        return entries
+
+    def _rebuild(self, user_id: str, dream_id: str):
+        context = self._read_snapshot(user_id, dream_id)
+        snapshot_seq = context.pop(self.SEQ_KEY, 0)
+        entries = self._read_log(user_id, dream_id, snapshot_seq)
+        if entries:
+            context["convo_context"] = context.get("convo_context", "") + "".join(
+                format_step_entry(e["step"], e["response"]) for e in entries
+            )
+        last_seq = entries[-1]["seq"] if entries else snapshot_seq
+        return context, last_seq, len(entries)
+
+    def load(self, user_id: str, dream_id: str) -> dict:
+        with self._lock((user_id, dream_id)):
+            context, last_seq, log_entries = self._rebuild(user_id, dream_id)
+            self.log_state[(user_id, dream_id)] = (last_seq, log_entries)
+        return context
+
+    # writes the snapshot atomically: temp file + rename, so readers see the old or the new file, never half
+    def _write_snapshot(self, user_id: str, dream_id: str, context: dict, seq: int):
+        filepath = self._filepath(user_id, dream_id)
+        tmp_path = f"{filepath}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({**context, self.SEQ_KEY: seq}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+
+    def _truncate_log(self, user_id: str, dream_id: str):
+        logpath = self._logpath(user_id, dream_id)
+        if os.path.exists(logpath):
+            open(logpath, "w").close()
+
+    def save(self, user_id: str, dream_id: str, context: dict):
+        key = (user_id, dream_id)
+        with self._lock(key):
+            if key not in self.log_state:
+                _, last_seq, _ = self._rebuild(user_id, dream_id)
+            else:
+                last_seq = self.log_state[key][0]
+            # a full save replaces everything in the log
+            self._write_snapshot(user_id, dream_id, context, last_seq)
+            self._truncate_log(user_id, dream_id)
+            self.log_state[key] = (last_seq, 0)
+
+    def append_step(self, user_id: str, dream_id: str, step: int, response: str):
+        key = (user_id, dream_id)
+        with self._lock(key):
+            if key not in self.log_state:
+                _, last_seq, log_entries = self._rebuild(user_id, dream_id)
+            else:
+                last_seq, log_entries = self.log_state[key]
+            seq = last_seq + 1
+
+            line = json.dumps({"seq": seq, "step": step, "response": response}) + "\n"
+            # O_APPEND + a single write: the line lands at the end of the file in one piece
+            fd = os.open(self._logpath(user_id, dream_id), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode("utf-8"))
+                if self.fsync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+            log_entries += 1
+
+            if log_entries >= self.compact_every:
+                context, seq, _ = self._rebuild(user_id, dream_id)
+                self._write_snapshot(user_id, dream_id, context, seq)
+                self._truncate_log(user_id, dream_id)
+                log_entries = 0
+            self.log_state[key] = (seq, log_entries)
+
+
+# All sessions in a single SQLite file, one row per dream
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # one connection shared by all threads, the lock makes sure only one uses it at a time
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " user_id TEXT NOT NULL,"
+                " dream_id TEXT NOT NULL,"
+                " context TEXT NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " PRIMARY KEY (user_id, dream_id))"
+            )
+
+    def load(self, user_id: str, dream_id: str) -> dict:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT context FROM sessions WHERE user_id = ? AND dream_id = ?",
+                (user_id, dream_id),
+            ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def save(self, user_id: str, dream_id: str, context: dict):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO sessions (user_id, dream_id, context, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user_id, dream_id) DO UPDATE SET "
+                "context = excluded.context, updated_at = excluded.updated_at",
+                (user_id, dream_id, json.dumps(context), time.time()),
+            )
+
+    # appends inside SQLite with json_set, no need to read the session into Python first
+    def append_step(self, user_id: str, dream_id: str, step: int, response: str):
+        entry = format_step_entry(step, response)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO sessions (user_id, dream_id, context, updated_at) VALUES (?, ?, json_object('convo_context', ?), ?) "
+                "ON CONFLICT (user_id, dream_id) DO UPDATE SET "
+                "context = json_set(sessions.context, '$.convo_context', "
+                "coalesce(json_extract(sessions.context, '$.convo_context'), '') || ?), "
+                "updated_at = excluded.updated_at",
+                (user_id, dream_id, entry, time.time(), entry),
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# Sessions as documents in MongoDB, using the connection from services/mongo.py
+class MongoSessionStore(SessionStore):
+    def __init__(self, collection_name: str):
+        # imported here so the file/sqlite backends don't need a MongoDB connection
+        from src.services.mongo import get_collection
+
+        self.collection = get_collection(collection_name)
+        self.collection.create_index([("user_id", 1), ("dream_id", 1)], unique=True)
+
+    def load(self, user_id: str, dream_id: str) -> dict:
+        doc = self.collection.find_one(
+            {"user_id": user_id, "dream_id": dream_id}, {"_id": 0, "context": 1}
+        )
+        return doc["context"] if doc else {}
+
+    def save(self, user_id: str, dream_id: str, context: dict):
+        self.collection.update_one(
+            {"user_id": user_id, "dream_id": dream_id},
+            {"$set": {"context": context}},
+            upsert=True,
+        )
+
+    # $concat runs on the server, so only the new step is sent over the network
+    def append_step(self, user_id: str, dream_id: str, step: int, response: str):
+        entry = format_step_entry(step, response)
+        self.collection.update_one(
+            {"user_id": user_id, "dream_id": dream_id},
+            [
+                {
+                    "$set": {
+                        "context.convo_context": {
+                            "$concat": [{"$ifNull": ["$context.convo_context", ""]}, entry]
+                        }
+                    }
+                }
+            ],
+            upsert=True,
+        )
+
+
+class CachedSessionStore(SessionStore):
+    """
+    Bounded LRU cache with write-back in front of another SessionStore.
+
+    Reads are served from memory after the first load, and saves/appends only update memory and mark the
+    session as dirty. Dirty sessions are written to the backend by a background thread every flush_interval
+    seconds, when they are evicted from the cache, and when flush()/close() is called (on shutdown).
+    Sessions that were only appended to are flushed with append_step, so the backend never has to
+    rewrite the whole conversation.
+
+    Args:
+        store (SessionStore): The backend where sessions are persisted
+        max_entries (int): How many sessions to keep in memory
+        flush_interval (float): Seconds between background flushes (0 disables the thread)
+    """
+
+    def __init__(self, store: SessionStore, max_entries: int = 1024, flush_interval: float = 2.0):
+        self.store = store
+        self.max_entries = max(1, max_entries)
+        self.cache = OrderedDict()
+        # key -> None if the whole context has to be saved, or the list of (step, response) appended since the last flush
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.stats_counters = {"hits": 0, "misses": 0, "evictions": 0, "dirty_evictions": 0, "flushes": 0}
+
+        self._stop = threading.Event()
+        self._flusher = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(
+                target=self._flush_loop, args=(flush_interval,), name="session-flusher", daemon=True
+            )
+            self._flusher.start()
+
+    def load(self, user_id: str, dream_id: str) -> dict:
+        key = (user_id, dream_id)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.stats_counters["hits"] += 1
+                # copy so the caller can modify it without touching the cached version
+                return copy.deepcopy(self.cache[key])
+            self.stats_counters["misses"] += 1
+
+        self._load_into_cache(key)
+        with self.lock:
+            return copy.deepcopy(self.cache[key])
+
+    # reads the session from the backend if it isn't cached already
+    def _load_into_cache(self, key):
+        if key in self.cache:
+            return
+        context = self.store.load(key[0], key[1])
+        evicted = []
+        with self.lock:
+            # another request may have saved it while we were loading, that version wins
+            if key not in self.cache:
+                evicted = self._put(key, context)
+        self._write_evicted(evicted)
+
+    def save(self, user_id: str, dream_id: str, context: dict):
+        key = (user_id, dream_id)
+        with self.lock:
+            evicted = self._put(key, copy.deepcopy(context))
+            self.cache.move_to_end(key)
+            self.dirty[key] = None
+        self._write_evicted(evicted)
+
+    def append_step(self, user_id: str, dream_id: str, step: int, response: str):
+        key = (user_id, dream_id)
+        while True:
+            self._load_into_cache(key)
+            with self.lock:
+                # it could have been evicted again before we got the lock (very unlikely), then just retry
+                if key not in self.cache:
+                    continue
+                context = self.cache[key]
+                context["convo_context"] = context.get("convo_context", "") + format_step_entry(step, response)
+                self.cache.move_to_end(key)
+                if key in self.dirty and self.dirty[key] is None:
+                    return  # a full save is already pending and will include this step
+                self.dirty.setdefault(key, []).append((step, response))
+                return
+
+    # done under the lock so a step appended at the same time is not lost
+    def update(self, user_id: str, dream_id: str, fields: dict):
+        key = (user_id, dream_id)
+        while True:
+            self._load_into_cache(key)
+            with self.lock:
+                if key not in self.cache:
+                    continue
+                self.cache[key].update(copy.deepcopy(fields))
+                self.dirty[key] = None
+                return
+
+    # must be called with the lock held. Returns the dirty sessions that were pushed out of the cache
+    def _put(self, key, context: dict) -> list:
+        self.cache[key] = context
+        evicted = []
+        while len(self.cache) > self.max_entries:
+            old_key, old_context = self.cache.popitem(last=False)
+            self.stats_counters["evictions"] += 1
+            if old_key in self.dirty:
+                self.stats_counters["dirty_evictions"] += 1
+                evicted.append((old_key, old_context, self.dirty.pop(old_key)))
+        return evicted
+
+    # evicted dirty sessions are written straight away so nothing is lost
+    def _write_evicted(self, evicted: list):
+        if not evicted:
+            return
+        with self.write_lock:
+            for key, context, steps in evicted:
+                self._write(key, context, steps)
+
+    def _write(self, key, context: dict, steps) -> bool:
+        try:
+            if steps is None:
+                self.store.save(key[0], key[1], context)
+            else:
+                for step, response in steps:
+                    self.store.append_step(key[0], key[1], step, response)
+            return True
+        except Exception as e:
+            logger.error(f"[SESSION] Failed to write session {key}: {e}")
+            return False
+
+    def flush(self):
+        """Writes every dirty session to the backend."""
+        # write_lock keeps flushes and eviction writes in order, so an older copy never overwrites a newer one
+        with self.write_lock:
+            with self.lock:
+                pending = [
+                    (key, copy.deepcopy(self.cache[key]), steps) for key, steps in self.dirty.items()
+                ]
+                self.dirty.clear()
+            failed = [key for key, context, steps in pending if not self._write(key, context, steps)]
+            with self.lock:
+                # keep the failed ones dirty (as a full save, we don't know which appends made it) so the
+                # next flush tries again
+                for key in failed:
+                    if key in self.cache:
+                        self.dirty[key] = None
+                self.stats_counters["flushes"] += 1
+
+    def _flush_loop(self, interval: float):
+        while not self._stop.wait(interval):
+            if self.dirty:
+                self.flush()
+
+    def stats(self) -> dict:
+        """Cache counters, useful to check the hit rate and how often sessions get evicted."""
+        with self.lock:
+            return {
+                **self.stats_counters,
+                "size": len(self.cache),
+                "max_entries": self.max_entries,
+                "dirty": len(self.dirty),
+            }
+
+    def close(self):
+        """Stops the background flusher, writes everything pending and closes the backend."""
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        self.store.close()
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+
+# Coalesces identical calls that are running at the same time: the first caller for a key (e.g. the hash of a
+# prompt) makes the real call and everyone who asks for the same key while it's running waits for it and gets
+# the same result (or the same exception). Double-clicks and client retries then cost one LLM call, not N.
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Works for threads (do) and for asyncio (ado). The two don't share calls with each other.
+    """
+
+    def __init__(self):
+        self.calls = {}  # key -> _Call, for the threads
+        self.async_calls = {}  # key -> asyncio.Task, for the event loop
+        self.lock = threading.Lock()
+        self.counters = {"calls": 0, "coalesced": 0}
+
+    def do(self, key: str, fn):
+        """Runs fn() unless a call for key is already running, in which case it waits for that one's result."""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            self.counters["calls" if leader else "coalesced"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    async def ado(self, key: str, fn):
+        """Async version of do: fn is an async function, awaited once per key however many callers there are."""
+        task = self.async_calls.get(key)
+        if task is None:
+            # the call runs in its own task, so the caller that started it can go away (client disconnected)
+            # without cancelling it for the others
+            task = asyncio.ensure_future(fn())
+            self.async_calls[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+            counter = "calls"
+        else:
+            counter = "coalesced"
+        with self.lock:
+            self.counters[counter] += 1
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task):
+        if self.async_calls.get(key) is task:
+            del self.async_calls[key]
+        # mark the error as seen, in case every caller was gone by the time it failed
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                **self.counters,
+                "in_flight": len(self.calls) + len(self.async_calls),
+            }
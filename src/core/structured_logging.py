@@ -0,0 +1,157 @@
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import hashlib
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+from src import config
+
+# ================================
+# 🪵 Structured logging
+# ================================
+# log_event(logger, "event.name", field=value, ...) logs an event with its fields, without formatting anything
+# in the request: the record goes into a queue and a background thread (QueueListener) formats it and writes
+# it. On top of that:
+# - events below the log level return straight away, before any work
+# - each event can be sampled (LOG_SAMPLE_RATES), e.g. keep 1 in 10 prompts
+# - payload fields (prompts, responses, dream data) are truncated or redacted by LOG_PAYLOAD_POLICY when they
+#   are written, and secrets are always redacted
+# - if the writer can't keep up, records are dropped instead of slowing the requests down
+#
+# The fields are formatted later, in the writer thread, so they must not be changed after they're logged
+# (they aren't: validated data, prompts and responses are never modified once built).
+
+SECRET_FIELDS = ("api_key", "token", "authorization", "password", "secret")
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.INFO, **fields):
+    """
+    Logs event with its fields. Nothing is formatted here: if the level is off or the event is sampled out
+    this only costs a couple of lookups.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    rate = config.LOG_SAMPLE_RATES.get(event, config.LOG_SAMPLE_DEFAULT)
+    if rate < 1.0 and random.random() >= rate:
+        return
+    logger.log(level, event, extra={"event": event, "fields": fields}, stacklevel=2)
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """QueueHandler that leaves the formatting to the listener thread and drops records when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # The base class formats the message here (in the calling thread), we only hand the record over
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Turns a field value into what is written: payloads by policy, secrets redacted, everything capped in length
+def render_field(name: str, value):
+    if any(secret in name.lower() for secret in SECRET_FIELDS):
+        return "<redacted>"
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    if name in config.LOG_PAYLOAD_FIELDS:
+        if config.LOG_PAYLOAD_POLICY == "redact":
+            digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+            return f"<redacted {len(text)} chars sha256:{digest}>"
+        if config.LOG_PAYLOAD_POLICY == "full":
+            return text
+    if len(text) > config.LOG_MAX_FIELD_CHARS:
+        return f"{text[:config.LOG_MAX_FIELD_CHARS]}... (+{len(text) - config.LOG_MAX_FIELD_CHARS} chars)"
+    return text
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Args:
+        style (str): "json" (one JSON object per line) or "text" (event key=value ...)
+    """
+
+    def __init__(self, style: str = "text"):
+        super().__init__()
+        self.style = style
+
+    def format(self, record) -> str:
+        event = getattr(record, "event", None)
+        fields = {name: render_field(name, value) for name, value in getattr(record, "fields", {}).items()}
+        if event is None:
+            # plain logger.info(...) calls of the rest of the app and of the libraries
+            message = record.getMessage()
+        if self.style == "json":
+            entry = {
+                "ts": round(record.created, 3),
+                "level": record.levelname,
+                "logger": record.name,
+                **({"event": event} if event is not None else {"message": message}),
+                **fields,
+            }
+            if record.exc_info:
+                entry["exc"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created))
+        text = f"{timestamp} {record.levelname:<7} {record.name} {event if event is not None else message}"
+        if fields:
+            text += " " + " ".join(f"{name}={render_text(value)}" for name, value in fields.items())
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+
+def render_text(value) -> str:
+    if isinstance(value, str) and (not value or any(c in value for c in ' ="\n')):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def setup_logging():
+    """
+    Sends the logs of the app through the background writer. Safe to call more than once (every entry point
+    calls it), only the first call does something.
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        log_queue = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+        output = logging.StreamHandler(sys.stderr)
+        output.setFormatter(StructuredFormatter(config.LOG_FORMAT))
+        _listener = QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(BackgroundQueueHandler(log_queue))
+        root.setLevel(config.LOG_LEVEL)
+        # whatever is still in the queue is written before the process exits
+        atexit.register(_listener.stop)
+
+
+def logging_stats() -> dict:
+    """Records waiting to be written and records dropped because the queue was full."""
+    handlers = [h for h in logging.getLogger().handlers if isinstance(h, BackgroundQueueHandler)]
+    return {
+        "queued": sum(h.queue.qsize() for h in handlers),
+        "dropped": sum(h.dropped for h in handlers),
+    }
@@ -0,0 +1,303 @@
+import json
+import logging
+import threading
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+# This block finds the dream symbols of step 0 locally, without the LLM. A lexicon of common Spanish dream
+# symbols is compiled into an Aho-Corasick automaton over normalized words (lowercase, no accents, singular),
+# so one pass over the dream finds every symbol in it (multi-word ones included) in microseconds.
+# The pipeline answers step 0 with the hits when they cover enough of the dream, and otherwise passes them
+# to the LLM as hints.
+
+# symbol -> the ways it can appear in a dream (singular; plurals and accents are handled by normalize_word)
+# A dream can be answered from these hits alone, so a term is only here if it nearly always means its symbol.
+# Words with a common everyday meaning are left out or only matched in a phrase that pins them down: "llama"
+# (also "he calls"), "clase", "prueba", "corriente", "vía", "piso", "cuarto", "de pie", "vacío", "vestido"...
+DEFAULT_LEXICON = {
+    "agua": ["agua"],
+    "mar": ["mar", "océano", "playa", "ola"],
+    "río": ["río", "arroyo"],
+    "lago": ["lago", "estanque", "laguna"],
+    "lluvia": ["lluvia", "llover", "tormenta"],
+    "inundación": ["inundación", "inundar", "diluvio", "tsunami"],
+    "fuego": ["fuego", "incendio", "hoguera", "quemar"],
+    "casa": ["casa", "hogar", "vivienda"],
+    "habitación": ["habitación", "dormitorio"],
+    "puerta": ["puerta", "portal"],
+    "ventana": ["ventana"],
+    "escalera": ["escalera", "escalón", "peldaño"],
+    "sótano": ["sótano", "bodega"],
+    "ático": ["ático", "desván", "buhardilla"],
+    "pasillo": ["pasillo", "corredor"],
+    "baño": ["baño", "váter", "inodoro"],
+    "espejo": ["espejo"],
+    "llave": ["llave", "cerradura"],
+    "puente": ["puente"],
+    "camino": ["camino", "sendero", "carretera", "calle"],
+    "laberinto": ["laberinto"],
+    "bosque": ["bosque", "selva", "árbol"],
+    "montaña": ["montaña", "cumbre", "colina"],
+    "cueva": ["cueva", "caverna", "túnel"],
+    "desierto": ["desierto"],
+    "jardín": ["jardín", "huerto"],
+    "flor": ["flor", "rosal"],
+    "cielo": ["cielo", "nube"],
+    "sol": ["sol", "amanecer"],
+    "luna": ["luna"],
+    "estrella": ["estrella"],
+    "noche": ["noche", "oscuridad"],
+    "luz": ["luz"],
+    "serpiente": ["serpiente", "víbora", "culebra"],
+    "perro": ["perro", "cachorro"],
+    "gato": ["gato", "gatito"],
+    "lobo": ["lobo"],
+    "león": ["león", "leona"],
+    "tigre": ["tigre"],
+    "oso": ["oso"],
+    "caballo": ["caballo", "yegua"],
+    "pájaro": ["pájaro", "ave"],
+    "águila": ["águila"],
+    "búho": ["búho", "lechuza"],
+    "pez": ["pez"],
+    "araña": ["araña", "telaraña"],
+    "insecto": ["insecto", "cucaracha", "mosca", "hormiga"],
+    "rata": ["rata", "ratón"],
+    "mariposa": ["mariposa"],
+    "toro": ["toro"],
+    "dragón": ["dragón"],
+    "monstruo": ["monstruo", "bestia", "criatura"],
+    "madre": ["madre", "mamá"],
+    "padre": ["padre", "papá"],
+    "hijo": ["hijo", "hija"],
+    "hermano": ["hermano", "hermana"],
+    "abuelo": ["abuelo", "abuela"],
+    "bebé": ["bebé", "recién nacido"],
+    "niño": ["niño", "niña", "infancia"],
+    "pareja": ["pareja", "novio", "novia", "marido", "esposa", "esposo"],
+    "expareja": ["expareja", "exnovio", "exnovia", "ex pareja"],
+    "desconocido": ["desconocido", "extraño"],
+    "sombra": ["sombra"],
+    "anciano": ["anciano", "anciana", "viejo sabio"],
+    "muerto": ["muerto", "cadáver", "fantasma", "difunto"],
+    "muerte": ["muerte", "morir", "moría", "murió", "muriendo", "funeral", "entierro", "tumba", "cementerio"],
+    "boda": ["boda", "casarse", "vestido de novia", "anillo"],
+    "embarazo": ["embarazo", "embarazada", "parto"],
+    "sangre": ["sangre", "herida"],
+    "diente": ["diente", "muela"],
+    "pelo": ["pelo", "cabello"],
+    "ojo": ["ojo", "mirada"],
+    "mano": ["mano"],
+    "pie": ["descalzo"],
+    "desnudez": ["desnudo", "desnuda", "desnudez"],
+    "caída": ["caer", "caía", "caí", "cayendo", "cayó", "caída", "precipicio", "abismo"],
+    "vuelo": ["volar", "volaba", "volando", "volé", "vuelo", "flotar", "flotaba"],
+    "persecución": [
+        "perseguir", "perseguía", "perseguían", "persiguiendo", "persiguió", "persecución", "huir", "huía", "escapar",
+    ],
+    "ahogo": ["ahogar", "ahogarse", "ahogaba", "ahogándome", "asfixia"],
+    "pelea": ["pelea", "pelear", "peleaba", "luchar", "luchaba", "lucha", "guerra", "batalla"],
+    "arma": ["arma", "pistola", "cuchillo", "espada"],
+    "ataque": ["ataque", "atacar", "morder", "mordisco"],
+    "examen": ["examen", "suspender"],
+    "escuela": ["escuela", "colegio", "instituto", "universidad"],
+    "trabajo": ["trabajo", "oficina", "jefe"],
+    "dinero": ["dinero", "moneda", "billete", "tesoro", "oro"],
+    "coche": ["coche", "conducir"],
+    "tren": ["tren", "estación de tren", "vía del tren"],
+    "avión": ["avión", "aeropuerto"],
+    "barco": ["barco", "barca", "naufragio"],
+    "autobús": ["autobús", "bus"],
+    "viaje": ["viaje", "viajar", "maleta", "equipaje"],
+    "perderse": ["perderse", "perdido", "perdida"],
+    "llegar tarde": ["llegar tarde", "perder el tren", "perder el avión"],
+    "teléfono": ["teléfono", "móvil", "llamada de teléfono"],
+    "reloj": ["reloj"],
+    "cama": ["cama"],
+    "comida": ["comida", "comer", "banquete"],
+    "iglesia": ["iglesia", "templo", "catedral", "altar"],
+    "hospital": ["hospital", "médico", "enfermedad", "enfermo"],
+    "cárcel": ["cárcel", "prisión", "encerrado", "jaula"],
+    "fiesta": ["fiesta", "celebración"],
+    "ropa": ["ropa", "zapato"],
+    "máscara": ["máscara", "disfraz"],
+    "huevo": ["huevo", "nido"],
+    "terremoto": ["terremoto", "derrumbe"],
+    "ciudad": ["ciudad", "pueblo"],
+    "isla": ["isla"],
+    "nieve": ["nieve", "hielo"],
+    "viento": ["viento", "huracán", "tornado"],
+}
+
+# Words that say nothing about the symbols. They are left out when measuring how much of the dream the
+# lexicon covers (a normalized form, like the lexicon)
+STOPWORDS_RAW = (
+    "el la los las un una unos unas lo al del de a en con por para sin sobre entre hacia hasta desde tras "
+    "y e o u ni pero que como cuando donde mientras porque pues si no ya muy mas más menos tan tanto todo "
+    "toda todos todas otro otra otros otras mismo misma este esta estos estas ese esa esos esas aquel aquella "
+    "yo tu tú él ella nosotros vosotros ellos ellas me te se nos os le les mi mis su sus mío mía "
+    "ser estar haber tener ir hacer poder decir ver dar saber querer es era fue soy estaba estaban estoy "
+    "he ha había habían tengo tenía tenían iba iban voy hay hubo algo alguien nada nadie entonces luego "
+    "después antes también solo sólo aquí allí allá ahí sueño soñé soñaba sentía sentí de repente"
+)
+
+
+def strip_accents(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFD", text) if not unicodedata.combining(c))
+
+
+VOWELS = set("aeiou")
+
+
+def normalize_word(word: str) -> str:
+    """
+    Lowercase, accent-free, singular form of a word, so "Árboles", "árbol" and "arbol" are the same word.
+    The lexicon terms and the words of a dream both go through here (see tokenize), so a term matches its
+    plural and its singular alike. The result is a stem, not always a real word:
+      - plurals: -ces -> -z (peces), -es after a consonant (flores, autobuses), then -s after a vowel
+        (casas, bebés, and the -s of singulars like autobús, so it matches autobuses)
+      - a final -e after a consonant is dropped, so "madre" and "madres" both end up as "madr" and "ave"
+        and "aves" as "av"
+    """
+    word = strip_accents(word.lower())
+    if len(word) > 3:
+        if word.endswith("ces"):
+            word = word[:-3] + "z"
+        elif word.endswith("es") and word[-3] not in VOWELS:
+            word = word[:-2]
+    if len(word) > 2 and word.endswith("s") and word[-2] in VOWELS:
+        word = word[:-1]
+    if len(word) > 2 and word.endswith("e") and word[-2] not in VOWELS:
+        word = word[:-1]
+    return word
+
+
+# Splits a text into normalized words (anything that isn't a letter separates words)
+def tokenize(text: str) -> list:
+    words = []
+    current = []
+    for c in text:
+        if c.isalpha():
+            current.append(c)
+        elif current:
+            words.append(normalize_word("".join(current)))
+            current = []
+    if current:
+        words.append(normalize_word("".join(current)))
+    return words
+
+
+STOPWORDS = set(tokenize(STOPWORDS_RAW))
+
+
+class SymbolAutomaton:
+    """
+    Aho-Corasick automaton over words: finds every lexicon term in a text in a single pass, whatever the
+    number of terms. Each state is a dict of word -> next state, with a failure link and the terms ending there.
+
+    Args:
+        lexicon (dict): symbol -> list of terms (single words or phrases)
+    """
+
+    def __init__(self, lexicon: dict):
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]  # per state: (symbol, number of words of the term)
+        for symbol, terms in lexicon.items():
+            for term in set(terms) | {symbol}:
+                words = tokenize(term)
+                if words:
+                    self._add(words, symbol)
+        self._build_failure_links()
+
+    def _add(self, words: list, symbol: str):
+        state = 0
+        for word in words:
+            if word not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+                self.goto[state][word] = len(self.goto) - 1
+            state = self.goto[state][word]
+        self.outputs[state].append((symbol, len(words)))
+
+    def _build_failure_links(self):
+        # breadth first, so the failure link of a state always points to a shallower one that is already done
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for word, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and word not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(word, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def find(self, words: list) -> list:
+        """Returns (symbol, start, end) for every term found in the (normalized) words."""
+        hits = []
+        state = 0
+        for i, word in enumerate(words):
+            while state and word not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(word, 0)
+            for symbol, length in self.outputs[state]:
+                hits.append((symbol, i - length + 1, i + 1))
+        return hits
+
+
+class SymbolLexicon:
+    """
+    The lexicon plus its automaton, and counters of how step 0 was answered.
+
+    Args:
+        lexicon (dict): symbol -> terms (DEFAULT_LEXICON if not given)
+        extra_path (str): Optional JSON file with more symbols in the same format (added to the lexicon)
+    """
+
+    def __init__(self, lexicon: dict = None, extra_path: str = None):
+        lexicon = dict(lexicon or DEFAULT_LEXICON)
+        if extra_path:
+            try:
+                with open(extra_path, "r", encoding="utf-8") as f:
+                    for symbol, terms in json.load(f).items():
+                        lexicon[symbol] = list(lexicon.get(symbol, [])) + list(terms)
+            except (OSError, ValueError) as e:
+                logger.error(f"[LEXICON] Could not load {extra_path}: {e}")
+        self.automaton = SymbolAutomaton(lexicon)
+        self.counters = {"answered": 0, "hinted": 0}
+        self.lock = threading.Lock()
+
+    def extract(self, text: str) -> dict:
+        """
+        Finds the lexicon symbols in a text.
+
+        Returns:
+            dict: "symbols" (in order of first appearance, no duplicates) and "coverage" (fraction of the
+            meaningful words of the text that are part of a symbol, 0-1)
+        """
+        words = tokenize(text)
+        hits = self.automaton.find(words)
+        symbols = []
+        covered = set()
+        for symbol, start, end in sorted(hits, key=lambda hit: (hit[1], -(hit[2] - hit[1]))):
+            if symbol not in symbols:
+                symbols.append(symbol)
+            covered.update(range(start, end))
+        content = [i for i, word in enumerate(words) if word not in STOPWORDS and len(word) > 2]
+        coverage = sum(1 for i in content if i in covered) / len(content) if content else 0.0
+        return {"symbols": symbols, "coverage": round(coverage, 3)}
+
+    # counter is "answered" (the lexicon was enough) or "hinted" (the LLM got the hits as hints)
+    def count(self, counter: str):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.counters["answered"] + self.counters["hinted"]
+            return {
+                **self.counters,
+                "answered_rate": round(self.counters["answered"] / total, 3) if total else 0.0,
+            }
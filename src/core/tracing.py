@@ -0,0 +1,156 @@
+import os
+import sys
+import hmac
+import time
+import random
+import threading
+import contextvars
+from collections import Counter
+
+from src import config
+
+# ================================
+# ⏱️ Request tracing
+# ================================
+# Every API request gets a Trace in a context variable. span() (and the stage_timer of metrics) add their time
+# to it, and the middleware sends the totals back in the Server-Timing header, so a slow request shows where
+# its time went (validation, session, prompt, LLM...) right in the browser dev tools or curl -v.
+# asyncio tasks and asyncio.to_thread copy the context, so spans in worker threads land in the same trace.
+# Outside a request (scripts, jobs) there's no trace and span() costs one ContextVar lookup.
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []  # (name, seconds) in the order they finished
+
+    def record(self, name: str, seconds: float):
+        self.spans.append((name, seconds))  # list.append is atomic, spans can come from other threads
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: the time of every span name added up, then the total, in ms."""
+        totals = {}
+        for name, seconds in list(self.spans):
+            totals[name] = totals.get(name, 0.0) + seconds
+        totals["total"] = time.perf_counter() - self.started
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items())
+
+
+def start_trace():
+    """Starts a trace for the current request. Returns the trace and the token to end it with end_trace."""
+    trace = Trace()
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+
+def record_span(name: str, seconds: float):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record(name, seconds)
+
+
+class span:
+    """
+    Times a block into the trace of the current request (no-op when there is none):
+
+        with span("session_read"):
+            ...
+    """
+
+    __slots__ = ("name", "trace", "started")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = _current_trace.get()
+        if self.trace is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.record(self.name, time.perf_counter() - self.started)
+        return False
+
+
+# ================================
+# 🔬 Sampling profiler
+# ================================
+# Runs one request under a sampling profiler: a thread looks at the stack of every other thread (event loop,
+# session and LLM worker threads) every PROFILE_INTERVAL seconds and counts them. The result is saved in
+# PROFILE_DIR as collapsed stacks ("frame;frame;frame count" per line), which flamegraph.pl and speedscope
+# open as a flame graph.
+# The event loop is shared, so a profile also shows whatever other requests did at the same time. Only one
+# request is profiled at a time, and only if PROFILING_TOKEN is set and sent in the X-Profile header (or
+# PROFILE_SAMPLE_RATE picks it).
+
+_profiling = threading.Lock()
+
+
+def should_profile(header_token: str) -> bool:
+    """Whether this request has to be profiled: the right X-Profile token, or picked by PROFILE_SAMPLE_RATE."""
+    # constant time comparison, so the token can't be guessed from how long the check takes
+    if config.PROFILING_TOKEN and header_token and hmac.compare_digest(
+        header_token.encode("utf-8"), config.PROFILING_TOKEN.encode("utf-8")
+    ):
+        return True
+    return config.PROFILE_SAMPLE_RATE > 0 and random.random() < config.PROFILE_SAMPLE_RATE
+
+
+class SamplingProfiler:
+    """
+    Args:
+        interval (float): Seconds between samples
+    """
+
+    def __init__(self, interval: float = None):
+        self.interval = interval or config.PROFILE_INTERVAL
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> bool:
+        """Starts sampling. False if another request is already being profiled."""
+        if not _profiling.acquire(blocking=False):
+            return False
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        _profiling.release()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def save(self, name: str) -> str:
+        """Writes the collapsed stacks to PROFILE_DIR/<time>-<name>.collapsed and returns the path."""
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in name).strip("_") or "request"
+        path = os.path.join(config.PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{safe_name}.collapsed")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
@@ -1,21 +1,179 @@
 import os
+import time
+import atexit
+import random
 import openai
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+from src import config
+from src.services.embedding_cache import EmbeddingCache
+
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 # 📌 Model to use — this is the current recommended one (cheap + fast)
-EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_MODEL = config.EMBEDDING_MODEL
+
+# 💾 Vectors we already paid for are reused from the local cache
+embedding_cache = (
+    EmbeddingCache(config.EMBEDDING_CACHE_PATH, max_entries=config.EMBEDDING_CACHE_MAX_ENTRIES)
+    if config.EMBEDDING_CACHE_ENABLED
+    else None
+)
+if embedding_cache is not None:
+    # the cache keeps the times of recent hits in memory, they're written when the process exits (API or script)
+    atexit.register(embedding_cache.flush)
+
+
+class EmbeddingError(Exception):
+    """Something went wrong while creating an embedding."""
+
+
+class EmbeddingInputError(EmbeddingError, ValueError):
+    """The text can't be embedded (e.g. it's empty)."""
+
+
+class EmbeddingAPIError(EmbeddingError):
+    """The OpenAI embeddings API call failed or returned no vector."""
 
 
 def get_embedding(text: str) -> list[float]:
+    """
+    Returns the embedding of a text, from the cache if it was embedded before.
+
+    Raises:
+        EmbeddingInputError: If the text is empty
+        EmbeddingAPIError: If OpenAI fails or returns an empty vector
+    """
+    if not text or not text.strip():
+        raise EmbeddingInputError("Cannot embed an empty text")
+
+    if embedding_cache is not None:
+        cached = embedding_cache.get(EMBEDDING_MODEL, text)
+        if cached is not None:
+            return cached
+
     try:
         response = openai.embeddings.create(input=text, model=EMBEDDING_MODEL)
-        return response.data[0].embedding
-    except Exception as e:
-        print("X Error getting embedding:", e)
-        return []
+    except openai.OpenAIError as e:
+        raise EmbeddingAPIError(f"Error getting embedding: {e}") from e
+
+    embedding = response.data[0].embedding if response.data else []
+    if not embedding:
+        raise EmbeddingAPIError("The embeddings API returned an empty vector")
+
+    if embedding_cache is not None:
+        embedding_cache.put(EMBEDDING_MODEL, text, embedding)
+    return embedding
+
+
+# Errors worth retrying: rate limits, timeouts and OpenAI having a bad moment
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+_encoding = None
+
+
+# Tokens of a text for the text-embedding-3 models (tiktoken if installed, otherwise ~4 characters per token)
+def count_tokens(text: str) -> int:
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+# Groups the texts into batches that stay under the token and input limits of one API request
+def make_batches(texts: list, max_tokens: int, max_inputs: int) -> list:
+    batches = []
+    current = []
+    current_tokens = 0
+    for text in texts:
+        tokens = count_tokens(text)
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_inputs):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+# One API request for a batch, retried with exponential backoff (and some jitter) on temporary errors
+def embed_batch(batch: list, max_retries: int) -> list:
+    for attempt in range(max_retries + 1):
+        try:
+            response = openai.embeddings.create(input=batch, model=EMBEDDING_MODEL)
+            break
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise EmbeddingAPIError(f"Embedding batch failed after {attempt + 1} attempts: {e}") from e
+            time.sleep(min(30.0, 2**attempt) * random.uniform(0.5, 1.5))
+        except openai.OpenAIError as e:
+            raise EmbeddingAPIError(f"Error getting embeddings: {e}") from e
+
+    # the API can return them in any order, "index" is the position in the batch
+    vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    if len(vectors) != len(batch) or not all(vectors):
+        raise EmbeddingAPIError("The embeddings API returned missing or empty vectors")
+    return vectors
+
+
+def get_embeddings(texts: list[str]) -> list[list[float]]:
+    """
+    Embeds many texts with as few API calls as possible.
+
+    Texts already in the cache aren't sent, duplicates are sent once, and the rest are packed into batches
+    (by token count) that are sent concurrently, at most EMBEDDING_MAX_CONCURRENCY at a time.
+
+    Args:
+        texts (list[str]): The texts to embed
+
+    Returns:
+        list[list[float]]: One vector per text, in the same order as the input
+
+    Raises:
+        EmbeddingInputError: If any of the texts is empty
+        EmbeddingAPIError: If a batch still fails after its retries
+    """
+    empty = [i for i, text in enumerate(texts) if not text or not text.strip()]
+    if empty:
+        raise EmbeddingInputError(f"Cannot embed empty texts (positions {empty})")
+
+    vectors = {}
+    unique_texts = list(dict.fromkeys(texts))
+    if embedding_cache is not None:
+        vectors.update(embedding_cache.get_many(EMBEDDING_MODEL, unique_texts))
+    missing = [text for text in unique_texts if text not in vectors]
+
+    if missing:
+        batches = make_batches(
+            missing, config.EMBEDDING_BATCH_MAX_TOKENS, config.EMBEDDING_BATCH_MAX_INPUTS
+        )
+        workers = max(1, min(config.EMBEDDING_MAX_CONCURRENCY, len(batches)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embeddings") as pool:
+            results = pool.map(lambda batch: embed_batch(batch, config.EMBEDDING_MAX_RETRIES), batches)
+            for batch, batch_vectors in zip(batches, results):
+                new_vectors = dict(zip(batch, batch_vectors))
+                vectors.update(new_vectors)
+                # saved batch by batch, so if a later batch fails the finished ones aren't paid for again
+                if embedding_cache is not None:
+                    embedding_cache.put_many(EMBEDDING_MODEL, new_vectors)
+
+    return [vectors[text] for text in texts]
 
 
 # ------------------------------------------------------------------------------
@@ -0,0 +1,122 @@
+import os
+import time
+import array
+import sqlite3
+import hashlib
+import threading
+
+
+# 📌 Disk cache for embeddings. Each vector is stored once as a float32 blob (1536 dims = 6 KB) keyed by
+# sha256(model, text), so embedding the same dream, symbol or query again is a local lookup instead of an API call.
+# When the cache grows past max_entries the least recently used vectors are removed.
+# A hit doesn't write anything: the time it was used is kept in memory and written with the next batch of them
+# (or right before evicting, so the eviction sees every use). If the process dies before that the vector just
+# looks as old as its last written use, which only matters for the order of eviction.
+
+
+def embedding_cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Args:
+        db_path (str): SQLite file where the vectors are stored
+        max_entries (int): Max number of vectors kept, the least recently used go first
+        touch_batch (int): Uses kept in memory before they're written to the last_used column
+    """
+
+    def __init__(self, db_path: str, max_entries: int = 200_000, touch_batch: int = 256):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.max_entries = max(1, max_entries)
+        self.touch_batch = max(1, touch_batch)
+        self.touched = {}  # key -> time of its latest use, not written yet
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " key TEXT PRIMARY KEY,"
+                " model TEXT NOT NULL,"
+                " vector BLOB NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+            self.count = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model: str, texts: list) -> dict:
+        """Returns {text: vector} for the texts that are in the cache."""
+        keys = {embedding_cache_key(model, text): text for text in texts}
+        found = {}
+        now = time.time()
+        with self.lock:
+            key_list = list(keys)
+            # SQLite limits the number of ? in a query, so look them up in slices
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i : i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[keys[key]] = array.array("f", blob).tolist()
+                    self.touched[key] = now
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            if len(self.touched) >= self.touch_batch:
+                with self.conn:
+                    self._write_touched()
+        return found
+
+    def get(self, model: str, text: str):
+        """Returns the cached vector of a text or None."""
+        return self.get_many(model, [text]).get(text)
+
+    def put_many(self, model: str, vectors: dict):
+        """Stores {text: vector} and evicts the least recently used vectors if the cache is over its size."""
+        now = time.time()
+        rows = [
+            (embedding_cache_key(model, text), model, array.array("f", vector).tobytes(), now)
+            for text, vector in vectors.items()
+        ]
+        with self.lock, self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, model, vector, last_used) VALUES (?, ?, ?, ?)", rows
+            )
+            self.count += self.conn.total_changes - before
+            if self.count > self.max_entries:
+                self._write_touched()
+                # remove a bit more than needed so we don't evict on every single insert
+                excess = self.count - int(self.max_entries * 0.95)
+                self.conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+                self.count = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def put(self, model: str, text: str, vector: list):
+        self.put_many(model, {text: vector})
+
+    def _write_touched(self):
+        # called with the lock held, inside a transaction
+        if self.touched:
+            self.conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(used, key) for key, used in self.touched.items()],
+            )
+            self.touched = {}
+
+    def flush(self):
+        """Writes the uses kept in memory. Called when the app stops."""
+        with self.lock, self.conn:
+            self._write_touched()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": self.count, "max_entries": self.max_entries}
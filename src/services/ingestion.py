@@ -0,0 +1,198 @@
+import time
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# ================================
+# 🏭 Staged ingestion pipeline
+# ================================
+# Runs a chain of stages (e.g. load -> chunk -> embed -> upsert) at the same time, each in its own thread(s),
+# connected by small bounded queues. A fast stage can only get queue_size items ahead of the next one, so
+# memory stays flat no matter how many documents there are, and the slow stages (API calls) overlap with
+# the rest instead of waiting for the whole previous step to finish.
+
+DONE = object()  # marks the end of the items in a queue
+
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    Args:
+        name (str): Name shown in the progress report
+        fn (callable): Receives one item (or a list of items when batch_size > 1) and returns an iterable
+            with the items for the next stage (can be a generator, an empty list to drop the item, etc.)
+        workers (int): Threads running this stage in parallel (useful for API calls)
+        batch_size (int): Items passed to fn at once
+    """
+
+    def __init__(self, name: str, fn, workers: int = 1, batch_size: int = 1):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_seconds = 0.0
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    def stats(self) -> dict:
+        end = self.finished_at or time.monotonic()
+        elapsed = end - self.started_at if self.started_at else 0.0
+        return {
+            "in": self.items_in,
+            "out": self.items_out,
+            "busy_seconds": round(self.busy_seconds, 2),
+            "per_second": round(self.items_in / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+
+
+class PipelineError(Exception):
+    """A stage failed, the whole pipeline was stopped."""
+
+
+def run_pipeline(source, stages: list, queue_size: int = 64, progress_every: float = 5.0) -> dict:
+    """
+    Feeds the items of source through the stages and waits until everything has been processed.
+
+    Args:
+        source (iterable): Where the items come from (usually a generator, so nothing is loaded up front)
+        stages (list[Stage]): The stages, in order. Whatever the last stage returns is discarded
+        queue_size (int): Max items waiting between two stages
+        progress_every (float): Seconds between progress reports (0 turns them off)
+
+    Returns:
+        dict: Stats (items in/out, busy time, throughput) per stage
+
+    Raises:
+        PipelineError: If any stage (or the source) raises, with the original error as cause
+    """
+    source_stage = Stage("source", None)
+    all_stages = [source_stage, *stages]
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    failed = threading.Event()
+    errors = []
+
+    # put that gives up if another stage failed (otherwise we could wait forever on a full queue)
+    def put(q, item) -> bool:
+        while not failed.is_set():
+            try:
+                q.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fail(stage, e):
+        logger.error(f"[PIPELINE] Stage '{stage.name}' failed: {e}")
+        errors.append((stage.name, e))
+        failed.set()
+
+    def run_source():
+        source_stage.started_at = time.monotonic()
+        try:
+            for item in source:
+                source_stage.items_in += 1
+                source_stage.items_out += 1
+                if not put(queues[0], item):
+                    return
+        except Exception as e:
+            fail(source_stage, e)
+        finally:
+            source_stage.finished_at = time.monotonic()
+            put(queues[0], DONE)
+
+    def run_stage(index: int, stage: Stage, remaining_workers: list):
+        in_q = queues[index]
+        out_q = queues[index + 1] if index + 1 < len(queues) else None
+        with stage.lock:
+            if stage.started_at is None:
+                stage.started_at = time.monotonic()
+
+        finished = False
+        while not finished and not failed.is_set():
+            batch = []
+            while len(batch) < stage.batch_size:
+                try:
+                    item = in_q.get(timeout=0.2)
+                except queue.Empty:
+                    if failed.is_set():
+                        return
+                    # don't hold a half batch forever when the upstream is slow
+                    if batch:
+                        break
+                    continue
+                if item is DONE:
+                    # leave the marker for the other workers of this stage
+                    put(in_q, DONE)
+                    finished = True
+                    break
+                batch.append(item)
+            if not batch:
+                continue
+
+            started = time.monotonic()
+            try:
+                outputs = stage.fn(batch if stage.batch_size > 1 else batch[0])
+                produced = 0
+                for output in outputs or ():
+                    produced += 1
+                    if out_q is not None and not put(out_q, output):
+                        return
+            except Exception as e:
+                fail(stage, e)
+                return
+            with stage.lock:
+                stage.items_in += len(batch)
+                stage.items_out += produced
+                stage.busy_seconds += time.monotonic() - started
+
+        with stage.lock:
+            remaining_workers[0] -= 1
+            last = remaining_workers[0] == 0
+        if last:
+            stage.finished_at = time.monotonic()
+            if out_q is not None:
+                put(out_q, DONE)
+
+    def report():
+        parts = []
+        for i, stage in enumerate(all_stages):
+            s = stage.stats()
+            waiting = f" [{queues[i].qsize()} queued]" if i < len(queues) else ""
+            parts.append(f"{stage.name}: {s['in']} ({s['per_second']}/s){waiting}")
+        logger.info("[PIPELINE] " + " | ".join(parts))
+
+    threads = [threading.Thread(target=run_source, name="pipeline-source", daemon=True)]
+    for index, stage in enumerate(stages):
+        remaining_workers = [stage.workers]
+        for w in range(stage.workers):
+            threads.append(
+                threading.Thread(
+                    target=run_stage,
+                    args=(index, stage, remaining_workers),
+                    name=f"pipeline-{stage.name}-{w}",
+                    daemon=True,
+                )
+            )
+    for thread in threads:
+        thread.start()
+
+    last_report = time.monotonic()
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(0.1)
+        if progress_every and time.monotonic() - last_report >= progress_every:
+            report()
+            last_report = time.monotonic()
+    if progress_every:
+        report()
+
+    if errors:
+        name, error = errors[0]
+        raise PipelineError(f"Stage '{name}' failed: {error}") from error
+
+    return {stage.name: stage.stats() for stage in all_stages}
@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# ================================
+# 🗂️ Persistent job queue
+# ================================
+# Jobs (e.g. an /analyze request in job mode) are stored in SQLite before the client gets its job ID, so they
+# survive restarts. Workers claim a job with a lease and renew it while the job runs: if the process dies, the
+# lease runs out and the job is queued again (up to max_attempts times).
+# Every claim is identified by the job's attempts count. finish, release and renew only touch the job if it's
+# still the same claim, so a worker that lost its lease can't overwrite what the next one did.
+#
+# Job status:  queued -> running -> done | failed
+
+FINISHED = ("done", "failed")
+
+
+class JobQueue:
+    """
+    Args:
+        db_path (str): SQLite file of the queue
+        lease_seconds (float): How long a running job belongs to its worker before it can be taken again
+        max_attempts (int): Times a job is started before it's marked as failed (crashes, restarts)
+    """
+
+    def __init__(self, db_path: str, lease_seconds: float = 300, max_attempts: int = 3):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        # isolation_level=None: transactions are opened by hand (BEGIN IMMEDIATE) so two processes sharing
+        # the file can't claim the same job
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY,"
+                " kind TEXT NOT NULL,"
+                " group_key TEXT,"  # jobs with the same group_key run one at a time, oldest first
+                " status TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " result TEXT,"
+                " error TEXT,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " lease_until REAL,"
+                " created_at REAL NOT NULL,"
+                " started_at REAL,"
+                " finished_at REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_group ON jobs (group_key, status)")
+
+    def submit(self, kind: str, payload: dict, group_key: str = None) -> str:
+        """
+        Stores a new job and returns its ID.
+
+        Args:
+            group_key (str): Optional, jobs of the same group (e.g. the steps of one dream) never run at the
+                same time and start in the order they were submitted
+        """
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO jobs (job_id, kind, group_key, status, payload, created_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, group_key, json.dumps(payload, ensure_ascii=False), time.time()),
+            )
+        return job_id
+
+    def claim(self):
+        """
+        Takes the oldest queued job (or a running one whose lease ran out) and marks it as running.
+
+        Returns:
+            dict: {"job_id", "kind", "payload", "attempts"}, or None if there's nothing to do
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                # jobs abandoned too many times (they crash the worker, or keep timing out) are given up
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'failed', finished_at = ?, lease_until = NULL, error = ? "
+                    "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                    (
+                        now,
+                        json.dumps({"status": 500, "detail": "The job was interrupted too many times"}),
+                        now,
+                        self.max_attempts,
+                    ),
+                )
+                row = self.conn.execute(
+                    "SELECT job_id, kind, payload, attempts FROM jobs AS j "
+                    "WHERE (status = 'queued' OR (status = 'running' AND lease_until < ?)) "
+                    # nothing else of its group is running, and it's the oldest of its group still to do
+                    "AND (group_key IS NULL OR (NOT EXISTS (SELECT 1 FROM jobs AS r WHERE r.group_key = j.group_key "
+                    "AND r.status = 'running' AND r.lease_until >= ?) AND NOT EXISTS (SELECT 1 FROM jobs AS o "
+                    "WHERE o.group_key = j.group_key AND o.status IN ('queued', 'running') "
+                    "AND o.created_at < j.created_at))) "
+                    "ORDER BY created_at LIMIT 1",
+                    (now, now),
+                ).fetchone()
+                if row is None:
+                    self.conn.execute("COMMIT")
+                    return None
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, started_at = ? "
+                    "WHERE job_id = ?",
+                    (now + self.lease_seconds, now, row[0]),
+                )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        if row[3] > 0:
+            logger.warning(f"[JOBS] Job {row[0]} was interrupted before, running it again (attempt {row[3] + 1})")
+        return {"job_id": row[0], "kind": row[1], "payload": json.loads(row[2]), "attempts": row[3] + 1}
+
+    def renew(self, job_id: str, attempts: int) -> bool:
+        """Extends the lease of a running job. False if the claim isn't ours anymore."""
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND attempts = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, job_id, attempts),
+            )
+        return cursor.rowcount == 1
+
+    def finish(self, job_id: str, attempts: int, result: dict = None, error: dict = None) -> bool:
+        """
+        Stores the result (or the error) of a running job. attempts is the one returned by claim: if the job was
+        taken by another worker since then, nothing is stored and False is returned.
+        """
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, lease_until = NULL "
+                "WHERE job_id = ? AND attempts = ? AND status = 'running'",
+                (
+                    "failed" if error is not None else "done",
+                    json.dumps(result, ensure_ascii=False) if result is not None else None,
+                    json.dumps(error, ensure_ascii=False) if error is not None else None,
+                    time.time(),
+                    job_id,
+                    attempts,
+                ),
+            )
+        return cursor.rowcount == 1
+
+    def release(self, job_id: str, attempts: int):
+        """Puts a running job back in the queue (e.g. the worker is shutting down)."""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'queued', lease_until = NULL, attempts = MAX(0, attempts - 1) "
+                "WHERE job_id = ? AND attempts = ? AND status = 'running'",
+                (job_id, attempts),
+            )
+
+    def get(self, job_id: str):
+        """The job as shown to clients, or None if it doesn't exist."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT job_id, kind, status, result, error, attempts, created_at, started_at, finished_at "
+                "FROM jobs WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job = {
+            "job_id": row[0],
+            "kind": row[1],
+            "status": row[2],
+            "attempts": row[5],
+            "created_at": row[6],
+            "started_at": row[7],
+            "finished_at": row[8],
+        }
+        if row[3] is not None:
+            job["result"] = json.loads(row[3])
+        if row[4] is not None:
+            job["error"] = json.loads(row[4])
+        return job
+
+    def purge(self, older_than: float):
+        """Deletes finished jobs older than older_than seconds."""
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (time.time() - older_than,),
+            )
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+class JobWorkers:
+    """
+    Pool of asyncio workers (in the API event loop) that take jobs from a JobQueue and run them.
+
+    Args:
+        queue (JobQueue): Where the jobs come from
+        handlers (dict): kind -> async function(payload) returning the result dict. It raises JobFailed to
+            fail the job with a given status/detail, any other exception fails it with 500
+        workers (int): Jobs running at the same time
+        poll_interval (float): Seconds between looks at the queue when idle (jobs submitted by this process
+            wake the workers straight away, this is for the ones left by a previous run or another process)
+    """
+
+    def __init__(self, queue: JobQueue, handlers: dict, workers: int = 4, poll_interval: float = 1.0):
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        self.tasks = []
+        self.wakeup = None
+        self.finished = {}  # job_id -> asyncio.Event, for the clients long-polling a job of this process
+        self.waiting = {}  # job_id -> clients long-polling it, the event is dropped when the last one leaves
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self._run(i)) for i in range(self.workers)]
+        logger.info(f"[JOBS] {self.workers} worker(s) started, queue: {self.queue.stats()}")
+
+    async def stop(self):
+        """Cancels the workers. Jobs they were running are put back in the queue for the next start."""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def notify(self):
+        """Wakes the workers up (call it after submitting a job)."""
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def _run(self, number: int):
+        while True:
+            job = await asyncio.to_thread(self.queue.claim)
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._execute(job)
+
+    async def _execute(self, job: dict):
+        job_id, attempts = job["job_id"], job["attempts"]
+        result = error = None
+        # the handler can wait for a long time (background work queues behind every interactive request), so
+        # the lease is renewed while it runs instead of letting another worker take the job and run it again
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, attempts))
+        try:
+            handler = self.handlers[job["kind"]]
+            result = await handler(job["payload"])
+        except asyncio.CancelledError:
+            # shutting down: the job goes back to the queue instead of waiting for its lease to run out
+            await asyncio.to_thread(self.queue.release, job_id, attempts)
+            raise
+        except JobFailed as e:
+            error = {"status": e.status, "detail": e.detail}
+        except Exception as e:
+            logger.error(f"[JOBS] Job {job_id} failed: {e}")
+            error = {"status": 500, "detail": str(e)}
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+        if not await asyncio.to_thread(self.queue.finish, job_id, attempts, result, error):
+            logger.warning(f"[JOBS] Job {job_id} was taken by another worker, result of attempt {attempts} dropped")
+        event = self.finished.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    async def _heartbeat(self, job_id: str, attempts: int):
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            try:
+                renewed = await asyncio.to_thread(self.queue.renew, job_id, attempts)
+            except sqlite3.Error as e:
+                logger.error(f"[JOBS] Failed to renew the lease of job {job_id}: {e}")
+                continue
+            if not renewed:
+                logger.warning(f"[JOBS] Lost the lease of job {job_id}")
+                return
+
+    async def wait(self, job_id: str, timeout: float):
+        """
+        Returns the job once it's finished, or as it is when timeout runs out (long-poll).
+        None if the job doesn't exist.
+        """
+        deadline = time.monotonic() + timeout
+        self.waiting[job_id] = self.waiting.get(job_id, 0) + 1
+        try:
+            while True:
+                job = await asyncio.to_thread(self.queue.get, job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job["status"] in FINISHED or remaining <= 0:
+                    return job
+                # woken up by our own workers, or checks again later (the job may run in another process)
+                event = self.finished.setdefault(job_id, asyncio.Event())
+                try:
+                    await asyncio.wait_for(event.wait(), min(remaining, self.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # jobs of other processes (or unknown ids) are never finished here, so nothing else would drop it
+            self.waiting[job_id] -= 1
+            if not self.waiting[job_id]:
+                del self.waiting[job_id]
+                self.finished.pop(job_id, None)
+
+
+class JobFailed(Exception):
+    """Raised by a job handler to fail the job with an HTTP-like status and detail."""
+
+    def __init__(self, status: int, detail):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
@@ -0,0 +1,217 @@
+import os
+import json
+import sqlite3
+import threading
+
+import numpy as np
+
+# 🧠 Local vector index: same idea as the Pinecone index but inside the process.
+# Vectors live in a memory-mapped float32 file (vectors.f32) and their ids + metadata in a small SQLite
+# file next to it (meta.db). Vectors are normalised when stored, so cosine similarity is a single
+# matrix-vector product and top-k is an argpartition: well under a millisecond for a few thousand chunks.
+# Another process can write to the same index (scripts/embed_documents.py while the API runs): every query
+# checks SQLite's data_version, which changes when another connection commits, and reloads the rows if so.
+
+INITIAL_CAPACITY = 1024
+
+
+# Pinecone-style metadata filters: {"user_id": "abc"} or {"emotion": {"$in": ["miedo", "angustia"]}}
+def matches_filter(metadata: dict, filter: dict) -> bool:
+    for key, condition in filter.items():
+        value = metadata.get(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, expected in condition.items():
+            if op == "$eq" and value != expected:
+                return False
+            if op == "$ne" and value == expected:
+                return False
+            if op == "$in" and value not in expected:
+                return False
+            if op == "$nin" and value in expected:
+                return False
+            if op in ("$gt", "$gte", "$lt", "$lte"):
+                if value is None:
+                    return False
+                if op == "$gt" and not value > expected:
+                    return False
+                if op == "$gte" and not value >= expected:
+                    return False
+                if op == "$lt" and not value < expected:
+                    return False
+                if op == "$lte" and not value <= expected:
+                    return False
+    return True
+
+
+class LocalVectorIndex:
+    """
+    Args:
+        path (str): Folder where vectors.f32 and meta.db are kept
+        dim (int): Size of the vectors (1536 for text-embedding-3-small)
+    """
+
+    def __init__(self, path: str, dim: int = 1536):
+        os.makedirs(path, exist_ok=True)
+        self.dim = dim
+        self.vectors_path = os.path.join(path, "vectors.f32")
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(os.path.join(path, "meta.db"), check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                " row INTEGER PRIMARY KEY,"
+                " id TEXT UNIQUE NOT NULL,"
+                " metadata TEXT NOT NULL)"
+            )
+
+        self.vectors = None
+        self._load()
+
+    # Reads ids and metadata from meta.db into memory and (re)opens the vectors file
+    def _load(self):
+        # id -> row in the vectors file, and row -> id/metadata, kept in memory for fast filtering
+        self.rows = {}
+        self.ids = {}
+        self.metadata = {}
+        for row, id, metadata in self.conn.execute("SELECT row, id, metadata FROM items"):
+            self.rows[id] = row
+            self.ids[row] = id
+            self.metadata[row] = json.loads(metadata)
+        self.size = max(self.rows.values(), default=-1) + 1
+        # rows of deleted vectors, reused by the next inserts
+        self.free_rows = sorted(set(range(self.size)) - set(self.metadata))
+        self.live = np.zeros(self.size, dtype=bool)
+        self.live[list(self.metadata)] = True
+
+        existing = os.path.getsize(self.vectors_path) // (4 * self.dim) if os.path.exists(self.vectors_path) else 0
+        if self.vectors is not None:
+            del self.vectors
+        self._open(max(existing, self.size, INITIAL_CAPACITY))
+        self.data_version = self._data_version()
+
+    def _data_version(self) -> int:
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    # must be called with the lock held. The other process writes the vectors before committing their rows,
+    # so once the new rows are visible their vectors are in the file
+    def _refresh(self):
+        if self._data_version() != self.data_version:
+            self._load()
+
+    def _open(self, capacity: int):
+        mode = "r+" if os.path.exists(self.vectors_path) else "w+"
+        if mode == "r+" and os.path.getsize(self.vectors_path) < capacity * self.dim * 4:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(capacity * self.dim * 4)
+        self.capacity = capacity
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode=mode, shape=(capacity, self.dim))
+
+    # doubles the file when it's full
+    def _grow(self, needed: int):
+        if needed <= self.capacity:
+            return
+        self.vectors.flush()
+        del self.vectors
+        self._open(max(needed, self.capacity * 2))
+
+    def upsert(self, items: list):
+        """Adds or replaces vectors. items is a list of (id, embedding, metadata)."""
+        with self.lock:
+            self._refresh()
+            new_rows = []
+            for id, embedding, metadata in items:
+                vector = np.asarray(embedding, dtype=np.float32)
+                if vector.shape != (self.dim,):
+                    raise ValueError(f"Vector {id} has shape {vector.shape}, expected ({self.dim},)")
+                norm = np.linalg.norm(vector)
+                if norm > 0:
+                    vector = vector / norm
+
+                row = self.rows.get(id)
+                if row is None:
+                    row = self.free_rows.pop(0) if self.free_rows else self.size
+                    self.size = max(self.size, row + 1)
+                    self._grow(self.size)
+                    self.rows[id] = row
+                    self.ids[row] = id
+                self.vectors[row] = vector
+                self.metadata[row] = metadata or {}
+                new_rows.append((row, id, json.dumps(metadata or {})))
+
+            if len(self.live) < self.size:
+                self.live = np.concatenate([self.live, np.zeros(self.size - len(self.live), dtype=bool)])
+            self.live[[row for row, _, _ in new_rows]] = True
+            self.vectors.flush()
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO items (row, id, metadata) VALUES (?, ?, ?)", new_rows)
+
+    def delete(self, ids: list = None, filter: dict = None):
+        """Removes vectors by id and/or by metadata filter."""
+        with self.lock:
+            self._refresh()
+            targets = {id for id in (ids or []) if id in self.rows}
+            if filter:
+                targets.update(id for id, row in self.rows.items() if matches_filter(self.metadata[row], filter))
+            if not targets:
+                return
+            rows = [self.rows.pop(id) for id in targets]
+            for row in rows:
+                del self.metadata[row]
+                del self.ids[row]
+            self.live[rows] = False
+            self.free_rows = sorted(set(self.free_rows) | set(rows))
+            with self.conn:
+                self.conn.executemany("DELETE FROM items WHERE row = ?", [(row,) for row in rows])
+
+    def query(self, vector: list, top_k: int = 5, filter: dict = None) -> dict:
+        """Returns the top_k most similar vectors (cosine) in the same shape as a Pinecone query."""
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+
+        with self.lock:
+            self._refresh()
+            if self.size == 0:
+                return {"matches": []}
+            live = self.live[: self.size]
+            if filter:
+                mask = live.copy()
+                for row in np.flatnonzero(mask):
+                    if not matches_filter(self.metadata[row], filter):
+                        mask[row] = False
+                candidates = np.flatnonzero(mask)
+            elif live.all():
+                candidates = None  # every row is a candidate, no need to copy the vectors
+            else:
+                candidates = np.flatnonzero(live)
+
+            if candidates is None:
+                scores = np.asarray(self.vectors[: self.size]) @ query
+                rows = np.arange(self.size)
+            else:
+                if len(candidates) == 0:
+                    return {"matches": []}
+                scores = self.vectors[candidates] @ query
+                rows = candidates
+
+            k = min(top_k, len(rows))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return {
+                "matches": [
+                    {
+                        "id": self.ids[int(rows[i])],
+                        "score": float(scores[i]),
+                        "metadata": self.metadata[int(rows[i])],
+                    }
+                    for i in top
+                ]
+            }
+
+    def count(self) -> int:
+        with self.lock:
+            self._refresh()
+            return len(self.rows)
@@ -0,0 +1,380 @@
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src import config
+
+logger = logging.getLogger(__name__)
+
+# ================================
+# 📚 Notion crawler
+# ================================
+# Walks a Notion page and all of its child blocks/pages concurrently (several requests in flight, but never
+# more than the rate limit allows) and downloads the PDFs it finds. Everything goes through one
+# requests.Session, so connections are reused instead of opening a new one per call.
+
+NOTION_API = "https://api.notion.com/v1"
+NOTION_VERSION = "2022-06-28"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # files are written 1 MB at a time, never held in memory
+PAGE_TYPES = ("child_page", "child_database")  # blocks that are pages, with their own last_edited_time
+# Files hosted by Notion have presigned URLs that expire after about an hour. Blocks reused from the sync state
+# keep the URL of the crawl that saved them, so before downloading one whose URL expired (or is about to) the
+# block is fetched again for a fresh URL
+URL_EXPIRY_MARGIN = 60
+
+
+class RateLimiter:
+    """Token bucket shared by all threads: at most `rate` calls per second, with bursts up to `burst`."""
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_for = (1 - self.tokens) / self.rate
+            time.sleep(wait_for)
+
+
+class NotionCrawler:
+    """
+    Args:
+        token (str): Notion integration token
+        rate (float): Max Notion API requests per second
+        max_workers (int): Requests/downloads running at the same time
+    """
+
+    def __init__(self, token: str, rate: float = None, max_workers: int = None):
+        self.max_workers = max_workers or config.NOTION_MAX_WORKERS
+        self.limiter = RateLimiter(rate or config.NOTION_RATE_LIMIT)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.notion_headers = {
+            "Authorization": f"Bearer {token}",
+            "Notion-Version": NOTION_VERSION,
+        }
+
+    # One Notion API call, waiting for the rate limiter and retrying when Notion says we're going too fast
+    def _notion_get(self, path: str, params: dict = None, max_retries: int = 5) -> dict:
+        for attempt in range(max_retries + 1):
+            self.limiter.acquire()
+            response = self.session.get(
+                f"{NOTION_API}{path}", headers=self.notion_headers, params=params, timeout=30
+            )
+            if response.status_code == 429 or response.status_code >= 500:
+                if attempt == max_retries:
+                    response.raise_for_status()
+                delay = float(response.headers.get("Retry-After", 2**attempt))
+                logger.warning(f"[NOTION] {response.status_code} on {path}, retrying in {delay}s")
+                time.sleep(delay)
+                continue
+            response.raise_for_status()
+            return response.json()
+
+    def get_children(self, block_id: str) -> list:
+        """All the direct children of a block or page (every page of results)."""
+        children = []
+        cursor = None
+        while True:
+            params = {"page_size": 100}
+            if cursor:
+                params["start_cursor"] = cursor
+            response = self._notion_get(f"/blocks/{block_id}/children", params)
+            children.extend(response["results"])
+            cursor = response.get("next_cursor")
+            if not response.get("has_more"):
+                break
+        return children
+
+    def crawl(self, root_id: str, should_descend=None) -> list:
+        """
+        Returns every block under root_id, going into child blocks and child pages concurrently.
+        Each block gets a "_parent_id" key with the block/page it was found in.
+
+        Args:
+            root_id (str): Page (or block) to start from
+            should_descend (callable): Optional, receives a block with children and returns False to skip
+                its children (e.g. to leave out pages that are not needed)
+        """
+        blocks = []
+        seen = {root_id}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="notion-crawl") as pool:
+            pending = {pool.submit(self.get_children, root_id): root_id}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    parent_id = pending.pop(future)
+                    for block in future.result():
+                        block["_parent_id"] = parent_id
+                        blocks.append(block)
+                        if not block.get("has_children") or block["id"] in seen:
+                            continue
+                        if should_descend is not None and not should_descend(block):
+                            continue
+                        seen.add(block["id"])
+                        pending[pool.submit(self.get_children, block["id"])] = block["id"]
+        return blocks
+
+    def crawl_incremental(self, root_id: str, state, force: bool = False) -> dict:
+        """
+        Like crawl, but only asks Notion for the parts that changed since the sync saved in state.
+
+        Editing a block updates the last_edited_time of its page, so:
+        - a page whose last_edited_time didn't change is rebuilt from the state instead of being listed again,
+          only its child pages are checked (one /pages request each, as they have their own last_edited_time)
+        - inside a changed page everything is listed again, since nested blocks don't always get a new
+          last_edited_time when something inside them changes
+
+        Args:
+            root_id (str): Page to start from
+            state (NotionSyncState): What the previous sync saw
+            force (bool): List everything again (full sync)
+
+        Returns:
+            dict: "blocks" (every block under root_id, fresh or from the state), "changed" (ids of new or edited
+            blocks), "removed" (ids of blocks that are gone), plus what state.save_crawl needs to save this crawl
+        """
+        root = self._notion_get(f"/pages/{root_id}")
+        root_edited = root.get("last_edited_time", "")
+        blocks = []
+        fetched = {}
+        checked = {}
+        changed = set()
+        removed = set()
+        seen = {root_id}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="notion-crawl") as pool:
+            pending = {}
+
+            def list_children(block_id: str, page_changed: bool):
+                pending[pool.submit(self.get_children, block_id)] = ("list", block_id, page_changed)
+
+            # an unchanged part of the tree: its blocks come from the state, only the pages in it are checked
+            def reuse_children(parent_id: str):
+                stack = [parent_id]
+                while stack:
+                    for block in state.children(stack.pop()):
+                        blocks.append(block)
+                        if not block.get("has_children") or block["id"] in seen:
+                            continue
+                        seen.add(block["id"])
+                        if block.get("type") in PAGE_TYPES:
+                            check = pool.submit(self._notion_get, f"/pages/{block['id']}")
+                            pending[check] = ("check", block["id"], False)
+                        else:
+                            stack.append(block["id"])
+
+            # the root is always listed (even if it didn't change): that's where the last_edited_time of the
+            # blocks and child pages under it shows up
+            root_changed = force or state.last_edited(root_id) != root_edited
+            if root_changed:
+                changed.add(root_id)
+            list_children(root_id, root_changed)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, block_id, page_changed = pending.pop(future)
+                    if kind == "check":
+                        edited = future.result().get("last_edited_time", "")
+                        if edited != state.last_edited(block_id):
+                            changed.add(block_id)
+                            checked[block_id] = edited
+                            list_children(block_id, True)
+                        else:
+                            reuse_children(block_id)
+                        continue
+
+                    children = future.result()
+                    fetched[block_id] = children
+                    removed |= state.child_ids(block_id) - {block["id"] for block in children}
+                    for block in children:
+                        block["_parent_id"] = block_id
+                        blocks.append(block)
+                        block_changed = force or state.last_edited(block["id"]) != block.get("last_edited_time")
+                        if block_changed:
+                            changed.add(block["id"])
+                        if not block.get("has_children") or block["id"] in seen:
+                            continue
+                        seen.add(block["id"])
+                        is_page = block.get("type") in PAGE_TYPES
+                        descend = block_changed if is_page else block_changed or page_changed
+                        if descend or not state.has_children(block["id"]):
+                            list_children(block["id"], block_changed if is_page else page_changed)
+                        else:
+                            reuse_children(block["id"])
+
+        logger.info(
+            f"[NOTION] Incremental crawl of {root_id}: {len(blocks)} blocks, {len(fetched)} listings fetched, "
+            f"{len(changed)} changed, {len(removed)} removed"
+        )
+        return {
+            "blocks": blocks,
+            "changed": changed,
+            "removed": removed,
+            "root_edited": root_edited,
+            "fetched": fetched,
+            "checked": checked,
+        }
+
+    # Opens the download and hands back the response (headers already there, body not read yet)
+    def _open_download(self, url: str):
+        response = self.session.get(url, stream=True, timeout=60)
+        try:
+            response.raise_for_status()
+        except BaseException:
+            response.close()
+            raise
+        return response
+
+    def download_file(self, url: str, save_folder: str, extension: str = ".pdf", response=None) -> str:
+        """
+        Streams a file to save_folder in chunks and names it after its content hash, so the same file linked
+        from two blocks (or downloaded in an earlier run) is only stored once. Returns the path.
+
+        Args:
+            response: Optional, a download already opened with _open_download (to look at its headers first)
+        """
+        os.makedirs(save_folder, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=save_folder, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                with response or self._open_download(url) as response:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        digest.update(chunk)
+            file_path = os.path.join(save_folder, f"{digest.hexdigest()[:32]}{extension}")
+            if os.path.exists(file_path):
+                os.remove(tmp_path)  # duplicate, we already have this file
+            else:
+                os.replace(tmp_path, file_path)
+            return file_path
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    # A fresh download URL for the block: the one it has if it's an external link or still valid, else the one
+    # of the block fetched again from Notion
+    def _fresh_url(self, block: dict, url: str, force: bool = False) -> str:
+        file_info = block.get("file", {})
+        if file_info.get("type") != "file":
+            return url
+        if not force and not url_expired(file_info["file"].get("expiry_time")):
+            return url
+        return get_file_url(self._notion_get(f"/blocks/{block['id']}")) or url
+
+    # Downloads the file of a block unless the copy from the previous sync is still the same file
+    def _sync_file(self, block: dict, url: str, save_folder: str, state) -> tuple:
+        previous = state.get_file(block["id"]) if state is not None else None
+        edited = block.get("last_edited_time", "")
+        if previous and os.path.exists(previous[3]):
+            # block not edited: same file, no request at all
+            if previous[0] == edited:
+                return previous[3], False
+        url = self._fresh_url(block, url)
+        try:
+            response = self._open_download(url)
+        except requests.HTTPError as e:
+            # the URL can still be refused (expired early, clock skew): one more try with a fresh one
+            if e.response is None or e.response.status_code not in (400, 403) or block["file"]["type"] != "file":
+                raise
+            url = self._fresh_url(block, url, force=True)
+            response = self._open_download(url)
+        etag = response.headers.get("ETag")
+        size = response.headers.get("Content-Length")
+        size = int(size) if size and size.isdigit() else None
+        if previous and os.path.exists(previous[3]):
+            # block edited (or the URL re-signed) but the file is the same: the body is never read
+            same_etag = etag is not None and etag == previous[1]
+            same_size = etag is None and size is not None and size == previous[2]
+            if same_etag or same_size:
+                response.close()
+                state.save_file(block["id"], edited, etag, size, previous[3])
+                return previous[3], False
+        path = self.download_file(url, save_folder, response=response)
+        if state is not None:
+            state.save_file(block["id"], edited, etag, size or os.path.getsize(path), path)
+        return path, True
+
+    def download_pdfs(self, blocks: list, save_folder: str, state=None) -> dict:
+        """
+        Downloads the PDFs of the file blocks concurrently. Returns {block_id: path}.
+
+        Args:
+            state (NotionSyncState): Optional, files that didn't change since the previous sync (same
+                last_edited_time, or same ETag/size) are kept instead of downloaded again
+        """
+        downloads = {}
+        for block in blocks:
+            url = get_file_url(block)
+            if url and ".pdf" in url:
+                downloads[block["id"]] = (block, url)
+
+        paths = {}
+        downloaded_count = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="notion-download") as pool:
+            futures = {
+                pool.submit(self._sync_file, block, url, save_folder, state): block_id
+                for block_id, (block, url) in downloads.items()
+            }
+            for future in futures:
+                block_id = futures[future]
+                try:
+                    paths[block_id], downloaded = future.result()
+                    downloaded_count += downloaded
+                    logger.debug(
+                        f"[NOTION] {'Downloaded' if downloaded else 'Unchanged'}: {block_id} -> {paths[block_id]}"
+                    )
+                except Exception as e:
+                    logger.error(f"[NOTION] Failed to download file of block {block_id}: {e}")
+        logger.info(
+            f"[NOTION] {len(paths)} of {len(downloads)} files synced, {downloaded_count} downloaded, "
+            f"{len(paths) - downloaded_count} unchanged"
+        )
+        return paths
+
+
+# Whether a Notion file URL with this expiry_time (ISO 8601) has expired or is about to
+def url_expired(expiry_time: str) -> bool:
+    if not expiry_time:
+        return True
+    try:
+        expires_at = datetime.datetime.fromisoformat(expiry_time.replace("Z", "+00:00"))
+    except ValueError:
+        return True
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return expires_at.timestamp() - now.timestamp() < URL_EXPIRY_MARGIN
+
+
+# URL of a file block (files uploaded to Notion or external links), or None for other blocks
+def get_file_url(block: dict):
+    if block.get("type") != "file":
+        return None
+    file_info = block["file"]
+    if file_info["type"] == "external":
+        return file_info["external"]["url"]
+    if file_info["type"] == "file":
+        return file_info["file"]["url"]
+    return None
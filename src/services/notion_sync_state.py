@@ -0,0 +1,101 @@
+import os
+import json
+import sqlite3
+import threading
+
+# ================================
+# 🕒 Notion sync state
+# ================================
+# Remembers what the last Notion sync saw: every block with its last_edited_time (and the block itself, so
+# unchanged parts of the tree can be rebuilt without asking Notion again) and every downloaded file with its
+# ETag and size. The incremental crawl in notion_crawler.py uses it to only fetch what changed.
+
+
+class NotionSyncState:
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS blocks ("
+                " block_id TEXT PRIMARY KEY,"
+                " parent_id TEXT,"
+                " last_edited_time TEXT NOT NULL,"
+                " data TEXT NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_blocks_parent ON blocks (parent_id)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " block_id TEXT PRIMARY KEY,"
+                " last_edited_time TEXT NOT NULL,"
+                " etag TEXT,"
+                " size INTEGER,"
+                " path TEXT NOT NULL)"
+            )
+
+    def last_edited(self, block_id: str):
+        """last_edited_time seen in the previous sync, or None if the block is new."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT last_edited_time FROM blocks WHERE block_id = ?", (block_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def child_ids(self, parent_id: str) -> set:
+        with self.lock:
+            return {
+                row[0] for row in self.conn.execute("SELECT block_id FROM blocks WHERE parent_id = ?", (parent_id,))
+            }
+
+    def children(self, parent_id: str) -> list:
+        """The children of a block as they were saved in the previous sync."""
+        with self.lock:
+            rows = self.conn.execute("SELECT data FROM blocks WHERE parent_id = ?", (parent_id,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def has_children(self, parent_id: str) -> bool:
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM blocks WHERE parent_id = ? LIMIT 1", (parent_id,)).fetchone()
+        return row is not None
+
+    def save_crawl(self, root_id: str, crawl: dict):
+        """
+        Saves the result of NotionCrawler.crawl_incremental. Call it only once the sync using it has finished,
+        otherwise a failed sync would be taken as done and its changes skipped next time.
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO blocks (block_id, parent_id, last_edited_time, data) VALUES (?, NULL, ?, ?)",
+                (root_id, crawl["root_edited"], json.dumps({"id": root_id})),
+            )
+            for parent_id, children in crawl["fetched"].items():
+                # children that were removed in Notion disappear from the state too
+                self.conn.execute("DELETE FROM blocks WHERE parent_id = ?", (parent_id,))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO blocks (block_id, parent_id, last_edited_time, data) VALUES (?, ?, ?, ?)",
+                    [
+                        (block["id"], parent_id, block.get("last_edited_time", ""), json.dumps(block))
+                        for block in children
+                    ],
+                )
+            # pages that were only checked (not listed again from their parent)
+            self.conn.executemany(
+                "UPDATE blocks SET last_edited_time = ? WHERE block_id = ?",
+                [(edited, block_id) for block_id, edited in crawl["checked"].items()],
+            )
+
+    def get_file(self, block_id: str):
+        """(last_edited_time, etag, size, path) of the file downloaded for a block, or None."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT last_edited_time, etag, size, path FROM files WHERE block_id = ?", (block_id,)
+            ).fetchone()
+
+    def save_file(self, block_id: str, last_edited_time: str, etag: str, size: int, path: str):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (block_id, last_edited_time, etag, size, path) VALUES (?, ?, ?, ?, ?)",
+                (block_id, last_edited_time, etag, size, path),
+            )
@@ -1,16 +1,14 @@
 import os
-import pinecone
+from pinecone import Pinecone
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# 🔐 Initialize Pinecone with your secret API key and environment (from Pinecone dashboard
-pinecone.init(
-    api_key=os.getenv("PINECONE_API_KEY"), environment=os.getenv("PINECONE_ENVIRONMENT")
-)
+# 🔐 Connect with your secret API key (from Pinecone dashboard)
+pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
 
 # 🧠 Connect to the specific index you created (e.g., "dream-info")
-index = pinecone.Index(os.getenv("PINECONE_INDEX_NAME"))
+index = pc.Index(os.getenv("PINECONE_INDEX_NAME"))
 
 
 def upsert_embedding(id: str, embedding: list[float], metadata: dict):
@@ -22,18 +20,40 @@ def upsert_embedding(id: str, embedding: list[float], metadata: dict):
         embedding (list[float]): A list (array) that contains only floating-point numbers. The actual vector representation (1536-dim for OpenAI)
         metadata (dict): Extra info you want to attach for filtering (e.g., user_id, emotion)
     """
-    index.upsert([id, embedding, metadata])
+    upsert_embeddings([(id, embedding, metadata)])
 
 
-def query_embedding(vector: list[float], top_k=5):
+def upsert_embeddings(items: list):
+    """
+    Adds (or updates) many records in a single request.
+
+    Args:
+        items (list): List of (id, embedding, metadata) tuples
+    """
+    index.upsert(
+        vectors=[{"id": id, "values": embedding, "metadata": metadata or {}} for id, embedding, metadata in items]
+    )
+
+
+def delete_embeddings(ids: list[str] = None, filter: dict = None):
+    """Removes records by id (Pinecone accepts up to 1000 ids per call) and/or by metadata filter."""
+    ids = ids or []
+    for i in range(0, len(ids), 1000):
+        index.delete(ids=ids[i : i + 1000])
+    if filter:
+        index.delete(filter=filter)
+
+
+def query_embedding(vector: list[float], top_k=5, filter: dict = None):
     """
     Searches the index for the closest vectors to the input vector.
 
     Args:
         vector (list[float]): The query embedding (usually from user input or dream)
         top_k (int): Number of similar results to return
+        filter (dict): Optional metadata filter, e.g. {"user_id": "abc"}
 
     Returns:
         dict: List of top matching vectors + metadata
     """
-    return index.query(vector=vector, top_k=top_k, include_metadata=True)
+    return index.query(vector=vector, top_k=top_k, include_metadata=True, filter=filter)
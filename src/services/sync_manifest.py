@@ -0,0 +1,179 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+# ================================
+# 📒 Sync manifest
+# ================================
+# Records what has been embedded for the knowledge base: every document, its chunks, the hash of each chunk,
+# the embedding model used and whether the vector is already in the index. It's a SQLite file and it's
+# committed after every upsert batch, so if a sync crashes half way the next run continues from there
+# instead of paying for the same embeddings again.
+#
+# Chunk status:  pending  -> planned, not in the index yet
+#                upserted -> in the index
+#                stale    -> in the index but no longer part of its document, to be deleted
+
+
+def get_doc_hash(text: str) -> str:
+    """Generate a hash of the document text for change detection."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def generate_chunk_ids(doc_id: str, texts: list) -> list:
+    """
+    ID of each chunk: doc ID + hash of the chunk text. An edited paragraph gets a new ID, and the chunks that
+    didn't change keep theirs even if they moved. Repeated chunks in the same doc get a counter.
+    """
+    ids = []
+    seen = {}
+    for text in texts:
+        chunk_id = f"{doc_id}::{get_doc_hash(text)[:16]}"
+        seen[chunk_id] = seen.get(chunk_id, 0) + 1
+        ids.append(chunk_id if seen[chunk_id] == 1 else f"{chunk_id}-{seen[chunk_id]}")
+    return ids
+
+
+class SyncManifest:
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS docs ("
+                " doc_id TEXT PRIMARY KEY,"
+                " doc_hash TEXT NOT NULL,"
+                " status TEXT NOT NULL,"  # pending until all its chunks are upserted, then complete
+                " synced_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                " chunk_id TEXT PRIMARY KEY,"
+                " doc_id TEXT NOT NULL,"
+                " chunk_hash TEXT NOT NULL,"
+                " embedding_model TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_doc ON chunks (doc_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_status ON chunks (status)")
+
+    def is_doc_synced(self, doc_id: str, doc_hash: str) -> bool:
+        """True if the doc was fully synced with exactly this content."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM docs WHERE doc_id = ? AND doc_hash = ? AND status = 'complete'",
+                (doc_id, doc_hash),
+            ).fetchone()
+        return row is not None
+
+    def upserted_chunks(self, doc_id: str, embedding_model: str) -> dict:
+        """{chunk_id: chunk_hash} of the chunks of a doc that are in the index with this embedding model."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT chunk_id, chunk_hash FROM chunks "
+                "WHERE doc_id = ? AND status = 'upserted' AND embedding_model = ?",
+                (doc_id, embedding_model),
+            ).fetchall()
+        return dict(rows)
+
+    def diff_doc(self, doc_id: str, embedding_model: str, chunks: dict) -> tuple:
+        """
+        Compares the current version of a doc with what is in the index. Only reads, so a dry run can use it.
+
+        Args:
+            chunks (dict): {chunk_id: chunk_hash} of the current version of the doc
+
+        Returns:
+            tuple: (to_embed, removed), the chunk_ids that are new or changed (or were embedded with another
+            model) and the chunk_ids in the index that are no longer part of the doc
+        """
+        indexed = self.upserted_chunks(doc_id, embedding_model)
+        to_embed = {chunk_id for chunk_id, chunk_hash in chunks.items() if indexed.get(chunk_id) != chunk_hash}
+        return to_embed, set(indexed) - set(chunks)
+
+    def has_doc(self, doc_id: str) -> bool:
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM docs WHERE doc_id = ?", (doc_id,)).fetchone() is not None
+
+    def plan_doc(self, doc_id: str, doc_hash: str, embedding_model: str, chunks: dict, to_embed: set):
+        """
+        Saves the plan for a new or changed doc in one transaction.
+
+        Args:
+            chunks (dict): {chunk_id: chunk_hash} of the current version of the doc
+            to_embed (set): The chunk_ids that have to be embedded (the rest are already in the index)
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO docs (doc_id, doc_hash, status, synced_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (doc_id) DO UPDATE SET doc_hash = excluded.doc_hash, status = excluded.status, "
+                "synced_at = excluded.synced_at",
+                (doc_id, doc_hash, "pending" if to_embed else "complete", now),
+            )
+            # chunks that are no longer part of the doc become stale. Pending ones too: a crash can happen after
+            # the upsert but before its checkpoint, and deleting an ID that isn't in the index is harmless
+            existing = self.conn.execute("SELECT chunk_id FROM chunks WHERE doc_id = ?", (doc_id,)).fetchall()
+            self.conn.executemany(
+                "UPDATE chunks SET status = 'stale', updated_at = ? WHERE chunk_id = ?",
+                [(now, chunk_id) for (chunk_id,) in existing if chunk_id not in chunks],
+            )
+            self.conn.executemany(
+                "INSERT INTO chunks (chunk_id, doc_id, chunk_hash, embedding_model, status, updated_at) "
+                "VALUES (?, ?, ?, ?, 'pending', ?) "
+                "ON CONFLICT (chunk_id) DO UPDATE SET chunk_hash = excluded.chunk_hash, "
+                "embedding_model = excluded.embedding_model, status = 'pending', updated_at = excluded.updated_at",
+                [(chunk_id, doc_id, chunks[chunk_id], embedding_model, now) for chunk_id in to_embed],
+            )
+
+    def mark_upserted(self, chunk_ids: list):
+        """Checkpoint after an upsert batch: the chunks are in the index, and docs with nothing pending are complete."""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE chunks SET status = 'upserted', updated_at = ? WHERE chunk_id = ?",
+                [(now, chunk_id) for chunk_id in chunk_ids],
+            )
+            self.conn.execute(
+                "UPDATE docs SET status = 'complete', synced_at = ? WHERE status = 'pending' AND NOT EXISTS "
+                "(SELECT 1 FROM chunks WHERE chunks.doc_id = docs.doc_id AND chunks.status = 'pending')",
+                (now,),
+            )
+
+    def doc_ids(self) -> set:
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT doc_id FROM docs")}
+
+    def stale_chunk_ids(self) -> list:
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT chunk_id FROM chunks WHERE status = 'stale'")]
+
+    def chunk_ids_of_docs(self, doc_ids: set) -> list:
+        """
+        Every chunk of the docs, pending ones included: a pending chunk may have been upserted just before a
+        crash, and forget() drops its row, so this is the last chance to delete it from the index.
+        """
+        with self.lock:
+            return [
+                chunk_id
+                for doc_id in doc_ids
+                for (chunk_id,) in self.conn.execute("SELECT chunk_id FROM chunks WHERE doc_id = ?", (doc_id,))
+            ]
+
+    def forget(self, chunk_ids: list, doc_ids: set):
+        """Removes deleted chunks and docs from the manifest (after they were deleted from the index)."""
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM chunks WHERE chunk_id = ?", [(chunk_id,) for chunk_id in chunk_ids])
+            self.conn.executemany("DELETE FROM chunks WHERE doc_id = ?", [(doc_id,) for doc_id in doc_ids])
+            self.conn.executemany("DELETE FROM docs WHERE doc_id = ?", [(doc_id,) for doc_id in doc_ids])
+
+    def stats(self) -> dict:
+        with self.lock:
+            docs = dict(self.conn.execute("SELECT status, COUNT(*) FROM docs GROUP BY status").fetchall())
+            chunks = dict(self.conn.execute("SELECT status, COUNT(*) FROM chunks GROUP BY status").fetchall())
+        return {"docs": docs, "chunks": chunks}
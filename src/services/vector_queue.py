@@ -0,0 +1,167 @@
+import time
+import queue
+import random
+import logging
+import threading
+
+from src import config
+
+logger = logging.getLogger(__name__)
+
+# 🚀 Background write queue for the vector index.
+# Callers (e.g. the /analyze route) just drop a record in the queue and carry on. A worker thread collects
+# records until it has VECTOR_QUEUE_BATCH_SIZE of them or VECTOR_QUEUE_MAX_WAIT seconds have passed, embeds
+# the ones that only have text (with one get_embeddings call) and upserts the whole batch in one request.
+
+
+class VectorQueueFullError(Exception):
+    """The queue is full, the index can't keep up with the writes."""
+
+
+class VectorWriteQueue:
+    """
+    Args:
+        upsert_fn (callable): Receives a list of (id, embedding, metadata) and writes it to the index
+        embed_fn (callable): Receives a list of texts and returns their vectors (for records without embedding)
+        max_size (int): Records the queue can hold before enqueue starts blocking/failing (backpressure)
+        batch_size (int): Max records per upsert
+        max_wait (float): Max seconds a record waits for its batch to fill up
+        max_retries (int): Attempts per batch before it's given up (with exponential backoff between them)
+    """
+
+    def __init__(
+        self,
+        upsert_fn,
+        embed_fn=None,
+        max_size: int = 10000,
+        batch_size: int = 100,
+        max_wait: float = 2.0,
+        max_retries: int = 5,
+    ):
+        self.upsert_fn = upsert_fn
+        self.embed_fn = embed_fn
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.queue = queue.Queue(maxsize=max_size)
+        self.stats_counters = {"enqueued": 0, "upserted": 0, "batches": 0, "retries": 0, "failed": 0, "rejected": 0}
+        self.stats_lock = threading.Lock()
+        self._closing = threading.Event()
+        self._worker = threading.Thread(target=self._run, name="vector-writer", daemon=True)
+        self._worker.start()
+
+    def _count(self, counter: str, amount: int = 1):
+        with self.stats_lock:
+            self.stats_counters[counter] += amount
+
+    def enqueue(self, id: str, embedding: list = None, metadata: dict = None, text: str = None, timeout: float = None):
+        """
+        Adds a record to the queue. Give either the embedding or the text to embed.
+
+        Args:
+            timeout (float): Seconds to wait if the queue is full. None waits forever, 0 doesn't wait at all
+
+        Raises:
+            VectorQueueFullError: If the queue is still full after the timeout, or the queue is shutting down
+        """
+        if embedding is None and text is None:
+            raise ValueError("enqueue needs an embedding or a text")
+        if self._closing.is_set():
+            raise VectorQueueFullError("The vector queue is shutting down")
+        try:
+            self.queue.put((id, embedding, metadata or {}, text), block=timeout != 0, timeout=timeout or None)
+        except queue.Full:
+            self._count("rejected")
+            raise VectorQueueFullError(f"Vector queue is full ({self.queue.maxsize} pending records)")
+        self._count("enqueued")
+
+    # takes the next batch: waits for a first record, then for more until the batch is full or max_wait passes
+    def _next_batch(self) -> list:
+        try:
+            batch = [self.queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            # when shutting down we don't wait for the batch to fill, just take what's there
+            if self._closing.is_set():
+                remaining = 0
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+                for _ in batch:
+                    self.queue.task_done()
+            elif self._closing.is_set():
+                return
+
+    def _write(self, batch: list):
+        for attempt in range(self.max_retries + 1):
+            try:
+                to_embed = [i for i, record in enumerate(batch) if record[1] is None]
+                if to_embed:
+                    vectors = self.embed_fn([batch[i][3] for i in to_embed])
+                    for i, vector in zip(to_embed, vectors):
+                        id, _, metadata, text = batch[i]
+                        batch[i] = (id, vector, metadata, text)
+                self.upsert_fn([(id, embedding, metadata) for id, embedding, metadata, _ in batch])
+                self._count("upserted", len(batch))
+                self._count("batches")
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"[VECTOR QUEUE] Dropping batch of {len(batch)} after {attempt + 1} attempts: {e}")
+                    self._count("failed", len(batch))
+                    return
+                self._count("retries")
+                delay = min(30.0, 0.5 * 2**attempt) * random.uniform(0.5, 1.5)
+                logger.warning(f"[VECTOR QUEUE] Upsert failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            return {**self.stats_counters, "pending": self.queue.qsize()}
+
+    def close(self, timeout: float = None):
+        """Stops taking new records and waits until everything already queued has been written."""
+        self._closing.set()
+        self._worker.join(timeout)
+        if self._worker.is_alive():
+            logger.error(f"[VECTOR QUEUE] Shutdown timed out with {self.queue.qsize()} records pending")
+
+
+_vector_queue = None
+_vector_queue_lock = threading.Lock()
+
+
+# The queue of the app, created (and its worker started) the first time something is indexed
+def get_vector_queue() -> VectorWriteQueue:
+    global _vector_queue
+    with _vector_queue_lock:
+        if _vector_queue is None:
+            from src.services.embedding import get_embeddings
+            from src.services.vector_store import upsert_embeddings
+
+            _vector_queue = VectorWriteQueue(
+                upsert_embeddings,
+                embed_fn=get_embeddings,
+                max_size=config.VECTOR_QUEUE_MAX_SIZE,
+                batch_size=config.VECTOR_QUEUE_BATCH_SIZE,
+                max_wait=config.VECTOR_QUEUE_MAX_WAIT,
+                max_retries=config.VECTOR_QUEUE_MAX_RETRIES,
+            )
+        return _vector_queue
+
+
+# Called when the API shuts down: writes everything that is still queued
+def shutdown_vector_queue():
+    if _vector_queue is not None:
+        _vector_queue.close()
@@ -0,0 +1,72 @@
+from src import config
+
+# 🧠 Single entry point for the vector index. Callers import upsert_embedding/query_embedding from here and
+# VECTOR_BACKEND decides if they go to Pinecone (services/pinecone.py) or to the local index (services/local_index.py).
+# The backend module is only imported the first time it's used, so the local backend never needs Pinecone keys.
+
+_local_index = None
+
+
+def get_local_index():
+    global _local_index
+    if _local_index is None:
+        from src.services.local_index import LocalVectorIndex
+
+        _local_index = LocalVectorIndex(config.LOCAL_INDEX_PATH, dim=config.LOCAL_INDEX_DIM)
+    return _local_index
+
+
+def upsert_embedding(id: str, embedding: list[float], metadata: dict):
+    """
+    Adds (or updates) a record in the vector index.
+
+    Args:
+        id (str): A unique identifier for the vector (e.g., dream_id or doc_id)
+        embedding (list[float]): The vector representation (1536-dim for OpenAI)
+        metadata (dict): Extra info you want to attach for filtering (e.g., user_id, emotion)
+    """
+    upsert_embeddings([(id, embedding, metadata)])
+
+
+def upsert_embeddings(items: list):
+    """
+    Adds (or updates) many records in one go.
+
+    Args:
+        items (list): List of (id, embedding, metadata) tuples
+    """
+    if config.VECTOR_BACKEND == "local":
+        get_local_index().upsert(items)
+    else:
+        from src.services import pinecone
+
+        pinecone.upsert_embeddings(items)
+
+
+def delete_embeddings(ids: list[str] = None, filter: dict = None):
+    """Removes records by id and/or by metadata filter (e.g. {"doc_id": {"$in": [...]}})."""
+    if config.VECTOR_BACKEND == "local":
+        get_local_index().delete(ids=ids, filter=filter)
+    else:
+        from src.services import pinecone
+
+        pinecone.delete_embeddings(ids, filter=filter)
+
+
+def query_embedding(vector: list[float], top_k=5, filter: dict = None):
+    """
+    Searches the index for the closest vectors to the input vector.
+
+    Args:
+        vector (list[float]): The query embedding (usually from user input or dream)
+        top_k (int): Number of similar results to return
+        filter (dict): Optional metadata filter, e.g. {"user_id": "abc"}
+
+    Returns:
+        dict: {"matches": [{"id", "score", "metadata"}, ...]} with the top matching vectors
+    """
+    if config.VECTOR_BACKEND == "local":
+        return get_local_index().query(vector, top_k=top_k, filter=filter)
+    from src.services import pinecone
+
+    return pinecone.query_embedding(vector, top_k=top_k, filter=filter)
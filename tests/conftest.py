@@ -0,0 +1,17 @@
+import os
+import tempfile
+
+# Everything the app writes at import time (sessions, job queue, caches, index) goes to a temporary folder
+# instead of the repo. Set before any test imports src.config.
+_data_dir = tempfile.mkdtemp(prefix="dream-tests-")
+for name, path in {
+    "SESSION_PATH": "sessions/",
+    "SESSION_DB_PATH": "sessions/sessions.db",
+    "LLM_CACHE_PATH": "llm_cache.db",
+    "JOB_DB_PATH": "jobs.db",
+    "EMBEDDING_CACHE_PATH": "embedding_cache.db",
+    "LOCAL_INDEX_PATH": "vector_index",
+    "PROFILE_DIR": "profiles",
+}.items():
+    os.environ.setdefault(name, os.path.join(_data_dir, path))
+os.environ.setdefault("OPENAI_API_KEY", "test")
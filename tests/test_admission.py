@@ -0,0 +1,157 @@
+import asyncio
+
+import pytest
+
+from src.core.admission import AdmissionController, AdmissionRejected, TokenBuckets
+
+
+def make_controller(**kwargs):
+    options = {"max_in_flight": 1, "max_queue": 10, "max_wait": 5, "rate": 0}
+    options.update(kwargs)
+    return AdmissionController(**options)
+
+
+async def hold(controller, step, order, name, background=False, release=None):
+    async with controller.slot(step, background=background):
+        order.append(name)
+        if release is not None:
+            await release.wait()
+        else:
+            await asyncio.sleep(0)
+
+
+async def let_run():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+# ================================
+# Priority queue
+# ================================
+def test_waiters_get_the_slot_by_step_then_arrival_and_background_last():
+    async def main():
+        controller = make_controller()
+        order = []
+        release = asyncio.Event()
+        first = asyncio.create_task(hold(controller, 0, order, "running", release=release))
+        await let_run()
+
+        waiters = [
+            asyncio.create_task(hold(controller, 0, order, "background-step3", background=True)),
+            asyncio.create_task(hold(controller, 0, order, "step0-a")),
+            asyncio.create_task(hold(controller, 3, order, "step3")),
+            asyncio.create_task(hold(controller, 1, order, "step1")),
+            asyncio.create_task(hold(controller, 0, order, "step0-b")),
+        ]
+        await let_run()
+        assert controller.stats()["queued"] == 4
+        assert controller.stats()["queued_background"] == 1
+
+        release.set()
+        await asyncio.gather(first, *waiters)
+        return order, controller.stats()
+
+    order, stats = asyncio.run(main())
+    assert order == ["running", "step3", "step1", "step0-a", "step0-b", "background-step3"]
+    assert stats["in_flight"] == 0 and stats["queued"] == 0
+    assert stats["admitted"] == 6 and stats["waited"] == 5
+
+
+def test_requests_over_the_queue_limit_are_shed():
+    async def main():
+        controller = make_controller(max_queue=1)
+        release = asyncio.Event()
+        running = asyncio.create_task(hold(controller, 0, [], "running", release=release))
+        await let_run()
+        queued = asyncio.create_task(hold(controller, 0, [], "queued"))
+        await let_run()
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await hold(controller, 0, [], "shed")
+        # background work is never shed
+        background = asyncio.create_task(hold(controller, 0, [], "background", background=True))
+        await let_run()
+
+        release.set()
+        await asyncio.gather(running, queued, background)
+        return rejected.value, controller.stats()
+
+    rejected, stats = asyncio.run(main())
+    assert rejected.reason == "overloaded"
+    assert rejected.retry_after >= 1
+    assert stats["shed"] == 1 and stats["in_flight"] == 0
+
+
+def test_waiting_too_long_is_rejected_and_frees_its_place():
+    async def main():
+        controller = make_controller(max_wait=0.05)
+        release = asyncio.Event()
+        running = asyncio.create_task(hold(controller, 0, [], "running", release=release))
+        await let_run()
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await hold(controller, 0, [], "too late")
+        assert controller.stats()["queued"] == 0
+
+        release.set()
+        await running
+        # the timed out waiter left no stale entry behind: the next request runs straight away
+        order = []
+        await asyncio.wait_for(hold(controller, 0, order, "next"), 1)
+        return rejected.value, order, controller.stats()
+
+    rejected, order, stats = asyncio.run(main())
+    assert rejected.reason == "queue_timeout"
+    assert order == ["next"]
+    assert stats["queue_timeouts"] == 1 and stats["in_flight"] == 0
+
+
+def test_cancelled_waiter_does_not_keep_the_slot():
+    async def main():
+        controller = make_controller()
+        release = asyncio.Event()
+        running = asyncio.create_task(hold(controller, 0, [], "running", release=release))
+        await let_run()
+        order = []
+        cancelled = asyncio.create_task(hold(controller, 3, order, "cancelled"))
+        waiting = asyncio.create_task(hold(controller, 0, order, "waiting"))
+        await let_run()
+
+        cancelled.cancel()  # client went away while queued
+        release.set()
+        await asyncio.gather(running, waiting)
+        return order, controller.stats()
+
+    order, stats = asyncio.run(main())
+    assert order == ["waiting"]
+    assert stats["in_flight"] == 0 and stats["queued"] == 0
+
+
+# ================================
+# Per-user rate limit
+# ================================
+def test_token_bucket_allows_a_burst_then_limits():
+    buckets = TokenBuckets(rate=1.0, burst=2)
+    assert buckets.take("u") == 0
+    assert buckets.take("u") == 0
+    assert buckets.take("u") > 0
+    # other users have their own bucket
+    assert buckets.take("other") == 0
+
+
+def test_token_buckets_forget_least_recently_seen_users():
+    buckets = TokenBuckets(rate=1.0, burst=1, max_keys=2)
+    buckets.take("a")
+    buckets.take("b")
+    buckets.take("c")
+    assert list(buckets.buckets) == ["b", "c"]
+
+
+def test_check_charges_the_user_rate_limit():
+    controller = make_controller(rate=1.0, burst=1)
+    controller.check("u")
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.check("u")
+    controller.check("other")
+    assert rejected.value.reason == "rate_limited"
+    assert controller.stats()["rate_limited"] == 1
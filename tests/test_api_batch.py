@@ -0,0 +1,55 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("llama_index.llms.openai")
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from src.api import routes
+from src.core.admission import AdmissionController
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # default rate limit: 1 request per second, bursts of 10
+    monkeypatch.setattr(routes, "admission", AdmissionController(max_in_flight=4, rate=1.0, burst=10))
+
+    async def fake_run_analysis(input, validated_data):
+        return f"{input.dream_id}:{input.step}"
+
+    monkeypatch.setattr(routes, "_run_analysis", fake_run_analysis)
+    app = FastAPI()
+    app.include_router(routes.router)
+    return TestClient(app)
+
+
+def journal(user_id: str, dreams: int) -> dict:
+    return {
+        "items": [
+            {"user_id": user_id, "dream_id": f"d{i}", "step": 0, "input_data": {"dream": f"sueño {i}"}}
+            for i in range(dreams)
+        ]
+    }
+
+
+def test_batch_of_one_user_costs_one_request(client):
+    response = client.post("/analyze/batch", json=journal("u", 25))
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["failed"] == 0 and body["succeeded"] == 25
+    assert [result["response"] for result in body["results"]] == [f"d{i}:0" for i in range(25)]
+    assert routes.admission.stats()["rate_limited"] == 0
+    assert routes.admission.buckets.buckets["u"][0] == pytest.approx(9, abs=0.1)
+
+
+def test_batch_items_of_a_rate_limited_user_get_429(client):
+    for _ in range(10):
+        routes.admission.check("u")
+
+    batch = {"items": journal("u", 3)["items"] + journal("v", 1)["items"]}
+    body = client.post("/analyze/batch", json=batch).json()
+
+    assert [result.get("error", {}).get("status") for result in body["results"]] == [429, 429, 429, None]
+    assert routes.admission.stats()["rate_limited"] == 1
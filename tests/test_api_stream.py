@@ -0,0 +1,115 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("llama_index.llms.openai")
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from src.api import routes
+from src.api.schemas import DreamInput
+from src.core.admission import AdmissionController
+from src.core.llm_client import LLMTimeoutError
+
+
+class FakeModel:
+    """Replaces stream_dream_step: yields the tokens, then fails if told to, and records if it was closed."""
+
+    def __init__(self, tokens: list, error: Exception = None):
+        self.tokens = tokens
+        self.error = error
+        self.sent = 0
+        self.closed = False
+
+    async def __call__(self, step, data, convo_context):
+        try:
+            for token in self.tokens:
+                self.sent += 1
+                yield token
+            if self.error:
+                raise self.error
+        finally:
+            self.closed = True
+
+
+@pytest.fixture
+def saved(monkeypatch):
+    monkeypatch.setattr(routes, "admission", AdmissionController(max_in_flight=4, rate=100.0, burst=100))
+    saved = []
+
+    async def append_step(user_id, dream_id, step, response):
+        saved.append((user_id, dream_id, step, response))
+
+    monkeypatch.setattr(routes, "aappend_session_step", append_step)
+    monkeypatch.setattr(routes, "index_interpretation", lambda *args: None)
+    return saved
+
+
+def dream(step: int = 0) -> dict:
+    return {"user_id": "u-" + uuid.uuid4().hex, "dream_id": "d", "step": step, "input_data": {"dream": "volaba"}}
+
+
+def parse_events(body: str) -> list:
+    events = []
+    for block in body.strip().split("\n\n"):
+        name, data = block.split("\n")
+        events.append((name[len("event: ") :], json.loads(data[len("data: ") :])))
+    return events
+
+
+def stream(monkeypatch, model: FakeModel, payload: dict) -> list:
+    monkeypatch.setattr(routes, "stream_dream_step", model)
+    app = FastAPI()
+    app.include_router(routes.router)
+    response = TestClient(app).post("/analyze/stream", json=payload)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    return parse_events(response.text)
+
+
+def test_tokens_are_streamed_and_the_response_saved_at_the_end(monkeypatch, saved):
+    payload = dream()
+    events = stream(monkeypatch, FakeModel(["Vuelo ", "y ", "libertad. "]), payload)
+
+    assert events == [
+        ("token", {"text": "Vuelo "}),
+        ("token", {"text": "y "}),
+        ("token", {"text": "libertad. "}),
+        ("done", {"response": "Vuelo y libertad."}),
+    ]
+    assert saved == [(payload["user_id"], "d", 0, "Vuelo y libertad.")]
+
+
+def test_model_failure_ends_with_an_error_event_and_saves_nothing(monkeypatch, saved):
+    events = stream(monkeypatch, FakeModel(["Vuelo "], LLMTimeoutError("too slow")), dream())
+
+    assert events[0] == ("token", {"text": "Vuelo "})
+    name, data = events[-1]
+    assert name == "error" and data["status"] == 504 and data["degraded"]
+    assert saved == []
+
+
+def test_client_disconnect_stops_the_stream_and_saves_nothing(saved, monkeypatch):
+    model = FakeModel([f"t{i} " for i in range(100)])
+    monkeypatch.setattr(routes, "stream_dream_step", model)
+
+    class Request:
+        checks = 0
+
+        async def is_disconnected(self):
+            self.checks += 1
+            return self.checks > 3
+
+    async def consume():
+        response = await routes.analyze_dream_stream(DreamInput(**dream()), Request())
+        return [event async for event in response.body_iterator]
+
+    events = asyncio.run(consume())
+
+    assert len(events) == 3 and all(event.startswith("event: token") for event in events)
+    assert model.sent < 100 and model.closed
+    assert saved == []
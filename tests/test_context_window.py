@@ -0,0 +1,134 @@
+import asyncio
+import threading
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("llama_index.llms.openai")
+
+from src import config
+from src.core import context_window
+from src.core.session import append_session_step, get_session_context, update_session_context
+from src.core.session_store import format_step_entry
+
+
+@pytest.fixture
+def window(monkeypatch):
+    # one token per word, so the budgets below are easy to follow
+    monkeypatch.setattr(context_window, "count_tokens", lambda text: len(text.split()))
+    monkeypatch.setattr(config, "CONTEXT_TOKEN_BUDGET_BY_STEP", {})
+    monkeypatch.setattr(config, "CONTEXT_TOKEN_BUDGET", 40)
+    monkeypatch.setattr(config, "CONTEXT_SUMMARY_TRIGGER", 0.6)
+    scheduled = []
+    monkeypatch.setattr(context_window, "schedule_summary", lambda *args: scheduled.append(args))
+    return scheduled
+
+
+def conversation(turns: int, words: int = 8) -> str:
+    return "".join(format_step_entry(step, " ".join([f"t{step}"] * words)) for step in range(turns))
+
+
+def test_split_turns_round_trips_the_convo_context():
+    convo = conversation(3) + format_step_entry(3, "línea 1\nlínea 2")
+    turns = context_window.split_turns(convo)
+
+    assert [step for step, _ in turns] == [0, 1, 2, 3]
+    assert turns[3][1] == "línea 1\nlínea 2"
+    assert "".join(format_step_entry(s, t) for s, t in turns) == convo
+
+
+def test_short_conversation_is_used_as_is(window):
+    convo = conversation(2)
+    assert context_window.build_context_window("u", "d", {"convo_context": convo}, 1) == convo
+    assert window == []
+
+
+def test_long_conversation_keeps_the_newest_turns_and_folds_the_rest(window):
+    context = {"convo_context": conversation(8)}
+    result = context_window.build_context_window("u", "d", context, 2)
+
+    assert len(result.split()) <= 40
+    assert result.endswith(format_step_entry(7, " ".join(["t7"] * 8)))
+    assert "Paso 0:" not in result
+    # the turns that will fall out next are summarised ahead of time
+    assert window == [("u", "d", 0, 6)]
+
+
+def test_summary_replaces_the_turns_it_covers(window):
+    context = {
+        "convo_context": conversation(8),
+        "convo_summary": "el usuario soñó con agua",
+        "convo_summary_turns": 6,
+    }
+    result = context_window.build_context_window("u", "d", context, 2)
+
+    assert result.startswith("Resumen de la conversación anterior:\nel usuario soñó con agua\n")
+    assert "Paso 5:" not in result and "Paso 6:" in result and "Paso 7:" in result
+    # the summary is kept one turn ahead of what's left out
+    assert window == [("u", "d", 6, 7)]
+
+
+def test_window_is_built_off_the_event_loop(window, monkeypatch):
+    threads = []
+    monkeypatch.setattr(
+        context_window, "count_tokens", lambda text: threads.append(threading.current_thread()) or len(text.split())
+    )
+    user_id, dream_id = "u-" + uuid.uuid4().hex, "d"
+    for step in range(8):
+        append_session_step(user_id, dream_id, step, " ".join([f"t{step}"] * 8))
+
+    result = asyncio.run(context_window.aload_context_window(user_id, dream_id, 2))
+
+    assert "Paso 7:" in result
+    assert threads and threading.main_thread() not in threads
+
+
+class FakeLLM:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.prompts = []
+
+    def complete(self, prompt, step):
+        self.prompts.append(prompt)
+        if self.fail:
+            raise RuntimeError("summary model down")
+        return SimpleNamespace(text=" resumen nuevo ")
+
+
+def test_update_summary_saves_the_summary_and_how_far_it_goes(monkeypatch):
+    llm = FakeLLM()
+    monkeypatch.setattr(context_window, "summary_llm_client", llm)
+    user_id, dream_id = "u-" + uuid.uuid4().hex, "d"
+    for step in range(4):
+        append_session_step(user_id, dream_id, step, f"respuesta {step}")
+
+    context_window.update_summary(user_id, dream_id, 0, 3)
+
+    context = get_session_context(user_id, dream_id)
+    assert context["convo_summary"] == "resumen nuevo"
+    assert context["convo_summary_turns"] == 3
+    assert "respuesta 2" in llm.prompts[0] and "respuesta 3" not in llm.prompts[0]
+
+    # a summary that was already moved forward by someone else is left alone
+    context_window.update_summary(user_id, dream_id, 0, 4)
+    assert len(llm.prompts) == 1
+
+
+def test_failed_summaries_leave_the_interactive_breaker_alone(monkeypatch):
+    from src.core.pipeline import llm_client
+
+    llm = FakeLLM(fail=True)
+    monkeypatch.setattr(context_window, "summary_llm_client", llm)
+    user_id, dream_id = "u-" + uuid.uuid4().hex, "d"
+    append_session_step(user_id, dream_id, 0, "respuesta")
+    update_session_context(user_id, dream_id, {"convo_summary_turns": 0})
+    before = llm_client.breaker.status()
+
+    for _ in range(config.LLM_BREAKER_FAILURES + 1):
+        context_window.update_summary(user_id, dream_id, 0, 1)
+
+    assert llm_client.breaker.status() == before
+    assert "convo_summary" not in get_session_context(user_id, dream_id)
+    # and nothing is left marked as running
+    assert (user_id, dream_id) not in context_window.summaries_in_progress
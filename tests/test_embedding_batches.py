@@ -0,0 +1,88 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("openai")
+
+from src import config
+from src.services import embedding
+from src.services.embedding_cache import EmbeddingCache
+
+
+class FakeEmbeddings:
+    """Stands in for openai.embeddings: the vector of a text is [len(text)], returned in reverse order."""
+
+    def __init__(self, failures: int = 0):
+        self.requests = []
+        self.failures = failures
+
+    def create(self, input, model):
+        self.requests.append(list(input))
+        if self.failures:
+            self.failures -= 1
+            raise TimeoutError("temporary")
+        data = [SimpleNamespace(index=i, embedding=[float(len(text))]) for i, text in enumerate(input)]
+        return SimpleNamespace(data=data[::-1])
+
+
+@pytest.fixture
+def api(monkeypatch, tmp_path):
+    fake = FakeEmbeddings()
+    monkeypatch.setattr(embedding.openai, "embeddings", fake)
+    monkeypatch.setattr(embedding, "embedding_cache", EmbeddingCache(str(tmp_path / "cache.db")))
+    monkeypatch.setattr(embedding, "count_tokens", lambda text: len(text.split()))
+    monkeypatch.setattr(embedding, "RETRYABLE_ERRORS", (TimeoutError,))
+    monkeypatch.setattr(embedding.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(config, "EMBEDDING_BATCH_MAX_TOKENS", 10)
+    monkeypatch.setattr(config, "EMBEDDING_BATCH_MAX_INPUTS", 3)
+    monkeypatch.setattr(config, "EMBEDDING_MAX_RETRIES", 2)
+    return fake
+
+
+def test_make_batches_respects_token_and_input_limits(monkeypatch):
+    monkeypatch.setattr(embedding, "count_tokens", lambda text: len(text.split()))
+    texts = ["a b c", "d e f", "g h", "i", "j", "k", "una frase de once palabras que no cabe en un lote"]
+
+    batches = embedding.make_batches(texts, max_tokens=8, max_inputs=3)
+
+    assert batches == [["a b c", "d e f", "g h"], ["i", "j", "k"], [texts[-1]]]
+    assert [text for batch in batches for text in batch] == texts
+
+
+def test_vectors_come_back_in_input_order(api):
+    texts = ["agua", "casa grande", "fuego", "un río", "luna", "mar"]
+    assert embedding.get_embeddings(texts) == [[float(len(text))] for text in texts]
+    assert len(api.requests) == 2
+
+
+def test_duplicates_are_sent_once(api):
+    vectors = embedding.get_embeddings(["agua", "mar", "agua", "agua"])
+    assert vectors == [[4.0], [3.0], [4.0], [4.0]]
+    assert api.requests == [["agua", "mar"]]
+
+
+def test_cached_texts_are_not_sent_again(api):
+    embedding.get_embeddings(["agua", "mar"])
+    api.requests.clear()
+
+    assert embedding.get_embeddings(["mar", "luna", "agua"]) == [[3.0], [4.0], [4.0]]
+    assert api.requests == [["luna"]]
+
+
+def test_temporary_errors_are_retried(api):
+    api.failures = 2
+    assert embedding.get_embeddings(["agua"]) == [[4.0]]
+    assert len(api.requests) == 3
+
+
+def test_a_batch_that_keeps_failing_raises(api):
+    api.failures = 10
+    with pytest.raises(embedding.EmbeddingAPIError):
+        embedding.get_embeddings(["agua"])
+    assert len(api.requests) == 3
+
+
+def test_empty_texts_are_rejected(api):
+    with pytest.raises(embedding.EmbeddingInputError):
+        embedding.get_embeddings(["agua", "  "])
+    assert api.requests == []
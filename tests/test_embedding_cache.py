@@ -0,0 +1,93 @@
+import sqlite3
+
+import pytest
+
+from src.services.embedding_cache import EmbeddingCache, embedding_cache_key
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "embeddings.db")
+
+
+def last_used(db_path: str, model: str, text: str) -> float:
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute(
+            "SELECT last_used FROM embeddings WHERE key = ?", (embedding_cache_key(model, text),)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def test_round_trip_and_stats(db_path):
+    cache = EmbeddingCache(db_path)
+    cache.put_many("m", {"agua": [0.5, -1.0, 2.0], "casa": [1.0, 0.0, 0.25]})
+
+    assert cache.get_many("m", ["agua", "casa", "fuego"]) == {"agua": [0.5, -1.0, 2.0], "casa": [1.0, 0.0, 0.25]}
+    assert cache.get("m", "fuego") is None
+    assert cache.get("other-model", "agua") is None
+    assert cache.stats() == {"hits": 2, "misses": 3, "entries": 2, "max_entries": 200_000}
+
+
+def test_vectors_survive_a_restart(db_path):
+    EmbeddingCache(db_path).put("m", "agua", [0.5, 1.5])
+    cache = EmbeddingCache(db_path)
+    assert cache.get("m", "agua") == [0.5, 1.5]
+    assert cache.stats()["entries"] == 1
+
+
+def test_storing_the_same_text_twice_keeps_one_row(db_path):
+    cache = EmbeddingCache(db_path)
+    cache.put("m", "agua", [1.0])
+    cache.put("m", "agua", [2.0])
+    assert cache.stats()["entries"] == 1
+    assert cache.get("m", "agua") == [1.0]
+
+
+def test_lookups_of_more_than_500_texts(db_path):
+    cache = EmbeddingCache(db_path)
+    vectors = {f"texto {i}": [float(i)] for i in range(1200)}
+    cache.put_many("m", vectors)
+    assert cache.get_many("m", list(vectors)) == vectors
+
+
+def test_hits_are_written_in_batches(db_path):
+    cache = EmbeddingCache(db_path, touch_batch=3)
+    cache.put_many("m", {"a": [1.0], "b": [2.0], "c": [3.0]})
+    stored = last_used(db_path, "m", "a")
+
+    cache.get_many("m", ["a", "b"])
+    # below the batch size nothing is written on a hit
+    assert last_used(db_path, "m", "a") == stored
+
+    cache.get("m", "c")
+    assert last_used(db_path, "m", "a") > stored
+    assert cache.touched == {}
+
+
+def test_flush_writes_pending_hits(db_path):
+    cache = EmbeddingCache(db_path)
+    cache.put("m", "a", [1.0])
+    stored = last_used(db_path, "m", "a")
+    cache.get("m", "a")
+
+    cache.flush()
+    assert last_used(db_path, "m", "a") > stored
+
+
+def test_eviction_keeps_the_recently_used_vectors(db_path, monkeypatch):
+    clock = iter(range(1000, 2000))
+    monkeypatch.setattr("src.services.embedding_cache.time.time", lambda: float(next(clock)))
+    cache = EmbeddingCache(db_path, max_entries=20)
+    cache.put_many("m", {f"old {i}": [float(i)] for i in range(20)})
+    # used recently, but the use is still only in memory when the eviction runs
+    cache.get_many("m", ["old 0", "old 1"])
+
+    cache.put("m", "new", [1.0])
+
+    assert cache.stats()["entries"] == 19
+    assert cache.get_many("m", ["old 0", "old 1", "new"]).keys() == {"old 0", "old 1", "new"}
+    others = cache.get_many("m", [f"old {i}" for i in range(2, 20)])
+    assert len(others) == 16
@@ -0,0 +1,143 @@
+import time
+import asyncio
+
+from src.services.job_queue import JobQueue, JobWorkers
+
+
+def make_queue(tmp_path, **kwargs):
+    return JobQueue(str(tmp_path / "jobs.db"), **kwargs)
+
+
+def test_jobs_are_claimed_oldest_first_and_finished(tmp_path):
+    queue = make_queue(tmp_path)
+    first = queue.submit("analyze", {"n": 1})
+    second = queue.submit("analyze", {"n": 2})
+
+    job = queue.claim()
+    assert job == {"job_id": first, "kind": "analyze", "payload": {"n": 1}, "attempts": 1}
+    assert queue.finish(first, job["attempts"], result={"ok": True})
+    assert queue.get(first)["status"] == "done" and queue.get(first)["result"] == {"ok": True}
+    assert queue.claim()["job_id"] == second
+    assert queue.claim() is None
+
+
+def test_jobs_of_the_same_group_run_one_at_a_time(tmp_path):
+    queue = make_queue(tmp_path)
+    a1 = queue.submit("analyze", {}, group_key="dream-a")
+    a2 = queue.submit("analyze", {}, group_key="dream-a")
+    b1 = queue.submit("analyze", {}, group_key="dream-b")
+
+    assert queue.claim()["job_id"] == a1
+    assert queue.claim()["job_id"] == b1  # a2 waits for a1
+    assert queue.claim() is None
+    queue.finish(a1, 1, result={})
+    assert queue.claim()["job_id"] == a2
+
+
+def test_expired_lease_is_claimed_again_and_the_old_claim_cant_finish(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=0.05)
+    job_id = queue.submit("analyze", {})
+    first = queue.claim()
+    assert queue.claim() is None
+
+    time.sleep(0.06)  # the first worker died (or hung) and its lease ran out
+    second = queue.claim()
+    assert second["job_id"] == job_id and second["attempts"] == 2
+
+    # the first worker comes back: it can't renew, overwrite the result or put the job back
+    assert not queue.renew(job_id, first["attempts"])
+    assert not queue.finish(job_id, first["attempts"], result={"from": "first"})
+    queue.release(job_id, first["attempts"])
+    assert queue.get(job_id)["status"] == "running"
+
+    assert queue.finish(job_id, second["attempts"], result={"from": "second"})
+    assert queue.get(job_id)["result"] == {"from": "second"}
+
+
+def test_renewed_lease_is_not_claimed_again(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=0.1)
+    job_id = queue.submit("analyze", {})
+    job = queue.claim()
+    for _ in range(4):
+        time.sleep(0.05)
+        assert queue.renew(job_id, job["attempts"])
+    assert queue.claim() is None
+
+
+def test_job_abandoned_too_many_times_is_failed(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=0.01, max_attempts=2)
+    job_id = queue.submit("analyze", {})
+    queue.claim()
+    time.sleep(0.02)
+    queue.claim()
+    time.sleep(0.02)
+
+    assert queue.claim() is None
+    job = queue.get(job_id)
+    assert job["status"] == "failed" and job["error"]["status"] == 500
+
+
+def test_workers_keep_the_lease_of_a_job_that_runs_past_it(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=0.1)
+    runs = []
+
+    async def slow(payload):
+        runs.append(payload)
+        await asyncio.sleep(0.35)  # e.g. waiting for a background slot
+        return {"done": True}
+
+    async def main():
+        workers = JobWorkers(queue, {"slow": slow}, workers=2, poll_interval=0.02)
+        workers.start()
+        job_id = queue.submit("slow", {"n": 1})
+        workers.notify()
+        job = await workers.wait(job_id, 2)
+        await workers.stop()
+        return job
+
+    job = asyncio.run(main())
+    assert job["status"] == "done" and job["attempts"] == 1
+    assert runs == [{"n": 1}]
+
+
+def test_wait_returns_when_the_job_finishes_and_forgets_it(tmp_path):
+    queue = make_queue(tmp_path)
+
+    async def handler(payload):
+        await asyncio.sleep(0.05)
+        return {"echo": payload}
+
+    async def main():
+        workers = JobWorkers(queue, {"echo": handler}, workers=1, poll_interval=0.02)
+        job_id = queue.submit("echo", {"n": 1})
+        timed_out = await workers.wait(job_id, 0.01)
+        workers.start()
+        done = await asyncio.gather(workers.wait(job_id, 2), workers.wait(job_id, 2))
+        missing = await workers.wait("missing", 0.01)
+        await workers.stop()
+        return timed_out, done, missing, workers
+
+    timed_out, done, missing, workers = asyncio.run(main())
+    assert timed_out["status"] == "queued"
+    assert [job["result"] for job in done] == [{"echo": {"n": 1}}] * 2
+    assert missing is None
+    assert workers.finished == {} and workers.waiting == {}
+
+
+def test_stopped_worker_puts_its_job_back(tmp_path):
+    queue = make_queue(tmp_path)
+
+    async def stuck(payload):
+        await asyncio.sleep(10)
+
+    async def main():
+        workers = JobWorkers(queue, {"stuck": stuck}, workers=1, poll_interval=0.02)
+        job_id = queue.submit("stuck", {})
+        workers.start()
+        await asyncio.sleep(0.1)
+        await workers.stop()
+        return job_id
+
+    job_id = asyncio.run(main())
+    job = queue.get(job_id)
+    assert job["status"] == "queued" and job["attempts"] == 0
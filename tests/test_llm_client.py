@@ -0,0 +1,273 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from src import config
+from src.core.llm_client import CircuitBreaker, LLMError, LLMTimeoutError, LLMUnavailableError, ResilientLLM
+
+
+class ProviderError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+class FakeLLM:
+    """Answers with the prompt, after the given delays (one per call, the last one repeats) or errors."""
+
+    model = "fake"
+
+    def __init__(self, delays=(0.0,), errors=()):
+        self.delays = list(delays)
+        self.errors = list(errors)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _next(self):
+        with self.lock:
+            n = self.calls
+            self.calls += 1
+        delay = self.delays[min(n, len(self.delays) - 1)]
+        error = self.errors[n] if n < len(self.errors) else None
+        return n, delay, error
+
+    def complete(self, prompt):
+        n, delay, error = self._next()
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return f"{prompt} #{n}"
+
+    async def acomplete(self, prompt):
+        n, delay, error = self._next()
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return f"{prompt} #{n}"
+
+
+def make_client(llm, **kwargs):
+    options = {"timeout": 2, "timeout_by_step": {}, "max_retries": 0, "max_concurrency": 4, "hedge": False}
+    options.update(kwargs)
+    return ResilientLLM(llm, **options)
+
+
+# ================================
+# Circuit breaker
+# ================================
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(max_failures=2, cooldown=60)
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+
+    with pytest.raises(LLMUnavailableError) as error:
+        breaker.before_call()
+    assert breaker.status()["state"] == "open"
+    assert error.value.retry_after > 1
+
+
+def test_breaker_success_resets_the_failure_count():
+    breaker = CircuitBreaker(max_failures=2, cooldown=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.status()["state"] == "closed"
+
+
+def test_breaker_half_open_lets_one_trial_through():
+    breaker = CircuitBreaker(max_failures=1, cooldown=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+
+    breaker.before_call()  # the trial call
+    assert breaker.status()["state"] == "half_open"
+    with pytest.raises(LLMUnavailableError):
+        breaker.before_call()  # everyone else waits for the trial
+
+    breaker.record_failure()  # the trial failed: open again
+    assert breaker.status()["state"] == "open"
+
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.status()["state"] == "closed"
+    breaker.before_call()
+
+
+def test_client_fails_fast_while_breaker_is_open():
+    llm = FakeLLM(errors=[ProviderError(500)] * 2)
+    client = make_client(llm, breaker=CircuitBreaker(max_failures=2, cooldown=60))
+
+    for _ in range(2):
+        with pytest.raises(LLMError):
+            client.complete("p", step=0)
+    with pytest.raises(LLMUnavailableError):
+        client.complete("p", step=0)
+
+    assert llm.calls == 2
+    assert client.status()["counters"]["rejected"] == 1
+
+
+def test_client_errors_that_are_our_fault_do_not_open_the_breaker():
+    llm = FakeLLM(errors=[ProviderError(400)] * 3)
+    client = make_client(llm, max_retries=2, breaker=CircuitBreaker(max_failures=1, cooldown=60))
+
+    with pytest.raises(LLMError):
+        client.complete("p", step=0)
+
+    assert llm.calls == 1  # not retried either
+    assert client.breaker.status()["state"] == "closed"
+
+
+def test_client_retries_retryable_errors():
+    llm = FakeLLM(errors=[ProviderError(503)])
+    client = make_client(llm, max_retries=1)
+    client._backoff = lambda attempt, deadline: 0
+
+    assert client.complete("p", step=0) == "p #1"
+    assert client.status()["counters"]["retries"] == 1
+
+
+# ================================
+# Hedging
+# ================================
+@pytest.fixture
+def fast_hedging(monkeypatch):
+    monkeypatch.setattr(config, "LLM_HEDGE_MIN_SAMPLES", 3)
+    monkeypatch.setattr(config, "LLM_HEDGE_MIN_DELAY", 0.05)
+
+
+def test_no_hedge_until_enough_latency_samples(fast_hedging):
+    llm = FakeLLM(delays=[0.01, 0.01, 0.2])
+    client = make_client(llm, hedge=True)
+
+    client.complete("p", step=0)
+    client.complete("p", step=0)
+    client.complete("p", step=0)  # slow, but only 2 samples so far
+
+    assert llm.calls == 3
+    assert client.status()["counters"]["hedges"] == 0
+
+
+def test_slow_call_is_hedged_and_the_hedge_wins(fast_hedging):
+    # three fast calls to learn the p95, then a stuck one that the hedge (call #4) beats
+    llm = FakeLLM(delays=[0.01, 0.01, 0.01, 1.0, 0.01])
+    client = make_client(llm, hedge=True)
+    for _ in range(3):
+        client.complete("p", step=0)
+
+    started = time.monotonic()
+    assert client.complete("p", step=0) == "p #4"
+
+    assert time.monotonic() - started < 0.5
+    counters = client.status()["counters"]
+    assert counters["hedges"] == 1 and counters["hedge_wins"] == 1
+
+
+def test_async_slow_call_is_hedged_and_the_loser_cancelled(fast_hedging):
+    llm = FakeLLM(delays=[0.01, 0.01, 0.01, 1.0, 0.01])
+    client = make_client(llm, hedge=True)
+
+    async def main():
+        for _ in range(3):
+            await client.acomplete("p", step=0)
+        started = time.monotonic()
+        response = await client.acomplete("p", step=0)
+        elapsed = time.monotonic() - started
+        await asyncio.sleep(0)
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        return response, elapsed, pending
+
+    response, elapsed, pending = asyncio.run(main())
+    assert response == "p #4"
+    assert elapsed < 0.5
+    assert pending == []
+    assert client.status()["counters"]["hedge_wins"] == 1
+
+
+# ================================
+# Streams
+# ================================
+class StreamingLLM:
+    """astream_complete returns a generator that only "sends the request" when it's first iterated, like
+    llama_index's OpenAI client, and waits stall_at[i] seconds before chunk i."""
+
+    model = "fake"
+
+    def __init__(self, chunks, stall_at=None):
+        self.chunks = chunks
+        self.stall_at = stall_at or {}
+        self.closed = False
+
+    async def astream_complete(self, prompt):
+        async def stream():
+            try:
+                for i, chunk in enumerate(self.chunks):
+                    await asyncio.sleep(self.stall_at.get(i, 0))
+                    yield chunk
+            finally:
+                self.closed = True
+
+        return stream()
+
+
+def collect(client, step=0):
+    async def main():
+        stream = await client.astream_complete("p", step=step)
+        received = []
+        try:
+            async for chunk in stream:
+                received.append(chunk)
+        except LLMError as e:
+            return received, e
+        return received, None
+
+    return asyncio.run(main())
+
+
+def test_stream_relays_every_chunk():
+    llm = StreamingLLM(["ho", "la"])
+    client = make_client(llm)
+
+    assert collect(client) == (["ho", "la"], None)
+    assert llm.closed
+    assert client.status()["latency_seconds"]["0"]["p50"] >= 0
+
+
+def test_stream_that_never_starts_fails_at_the_step_deadline():
+    llm = StreamingLLM(["ho", "la"], stall_at={0: 10})
+    client = make_client(llm, timeout_by_step={0: 0.1}, breaker=CircuitBreaker(max_failures=1, cooldown=60))
+
+    async def main():
+        started = time.monotonic()
+        with pytest.raises(LLMTimeoutError):
+            await client.astream_complete("p", step=0)
+        return time.monotonic() - started
+
+    assert asyncio.run(main()) < 1
+    assert llm.closed
+    assert client.status()["counters"]["timeouts"] == 1
+    assert client.breaker.status()["state"] == "open"
+
+
+def test_stream_that_stalls_midway_fails_after_the_idle_timeout():
+    llm = StreamingLLM(["ho", "la", "!"], stall_at={1: 10})
+    client = make_client(llm, stream_idle_timeout=0.1)
+
+    started = time.monotonic()
+    received, error = collect(client)
+
+    assert time.monotonic() - started < 1
+    assert received == ["ho"]
+    assert isinstance(error, LLMTimeoutError)
+    assert llm.closed
+
+
+def test_empty_stream_finishes():
+    client = make_client(StreamingLLM([]))
+    assert collect(client) == ([], None)
+    assert client.breaker.status()["state"] == "closed"
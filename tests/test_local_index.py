@@ -0,0 +1,103 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from src.services.local_index import LocalVectorIndex, matches_filter
+
+
+def unit(i: int, dim: int = 4) -> list:
+    vector = [0.0] * dim
+    vector[i] = 1.0
+    return vector
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = LocalVectorIndex(str(tmp_path / "index"), dim=4)
+    index.upsert(
+        [
+            ("a", [1.0, 0.0, 0.0, 0.0], {"doc_id": "x", "year": 2020}),
+            ("b", [0.9, 0.1, 0.0, 0.0], {"doc_id": "y", "year": 2021}),
+            ("c", [0.5, 0.5, 0.0, 0.0], {"doc_id": "y", "year": 2022}),
+            ("d", [0.0, 0.0, 1.0, 0.0], {"doc_id": "z", "year": 2023}),
+        ]
+    )
+    return index
+
+
+def ids(result: dict) -> list:
+    return [match["id"] for match in result["matches"]]
+
+
+def test_query_returns_top_k_by_cosine_similarity(index):
+    result = index.query([2.0, 0.0, 0.0, 0.0], top_k=3)
+    assert ids(result) == ["a", "b", "c"]
+    assert result["matches"][0]["score"] == pytest.approx(1.0)
+    assert result["matches"][0]["metadata"] == {"doc_id": "x", "year": 2020}
+    assert ids(index.query(unit(0), top_k=50)) == ["a", "b", "c", "d"]
+
+
+@pytest.mark.parametrize(
+    "filter, expected",
+    [
+        ({"doc_id": "y"}, ["b", "c"]),
+        ({"doc_id": {"$in": ["x", "z"]}}, ["a", "d"]),
+        ({"doc_id": {"$nin": ["x", "z"]}}, ["b", "c"]),
+        ({"doc_id": {"$ne": "y"}}, ["a", "d"]),
+        ({"year": {"$gte": 2021, "$lt": 2023}}, ["b", "c"]),
+        ({"doc_id": "nope"}, []),
+    ],
+)
+def test_query_applies_metadata_filters(index, filter, expected):
+    assert ids(index.query(unit(0), top_k=10, filter=filter)) == expected
+
+
+def test_missing_field_never_matches_a_range():
+    assert not matches_filter({}, {"year": {"$gt": 2000}})
+
+
+def test_upsert_replaces_and_delete_removes(index):
+    index.upsert([("a", unit(3), {"doc_id": "x", "year": 2020})])
+    assert ids(index.query(unit(3), top_k=1)) == ["a"]
+
+    index.delete(ids=["a"])
+    index.delete(filter={"doc_id": "y"})
+    assert index.count() == 1
+    assert ids(index.query(unit(0), top_k=10)) == ["d"]
+
+
+def test_deleted_rows_are_reused(index):
+    index.delete(ids=["b"])
+    index.upsert([("e", unit(1), {})])
+    assert index.size == 4
+    assert ids(index.query(unit(1), top_k=1)) == ["e"]
+
+
+def test_index_survives_reopening(tmp_path, index):
+    index.delete(ids=["d"])
+    reopened = LocalVectorIndex(str(tmp_path / "index"), dim=4)
+    assert reopened.count() == 3
+    assert ids(reopened.query(unit(0), top_k=2)) == ["a", "b"]
+
+
+def test_grows_past_its_initial_capacity(tmp_path):
+    index = LocalVectorIndex(str(tmp_path / "index"), dim=4)
+    index.upsert([(f"v{i}", unit(i % 3), {}) for i in range(1499)] + [("last", unit(3), {})])
+    assert index.count() == 1500
+    assert ids(index.query(unit(3), top_k=1)) == ["last"]
+
+
+def test_writes_of_another_instance_are_seen_without_reopening(tmp_path, index):
+    # e.g. scripts/embed_documents.py adding knowledge while the API is running
+    writer = LocalVectorIndex(str(tmp_path / "index"), dim=4)
+    writer.upsert([(f"new{i}", [0.0, 0.0, 0.0, 1.0], {"doc_id": "w"}) for i in range(1200)])
+    writer.delete(ids=["a"])
+
+    assert index.count() == 1203
+    assert ids(index.query(unit(3), top_k=1, filter={"doc_id": "w"}))[0].startswith("new")
+    assert "a" not in ids(index.query(unit(0), top_k=10))
+
+
+def test_wrong_dimension_is_rejected(index):
+    with pytest.raises(ValueError):
+        index.upsert([("bad", [1.0, 0.0], {})])
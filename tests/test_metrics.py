@@ -0,0 +1,115 @@
+import asyncio
+import threading
+
+import pytest
+
+from src.core.metrics import MetricsRegistry, format_labels, format_value, track_request
+
+
+@pytest.fixture
+def registry():
+    return MetricsRegistry()
+
+
+def test_counter_is_added_up_across_threads(registry):
+    counter = registry.counter("things_total", "Things", ("kind",))
+
+    def record():
+        for _ in range(1000):
+            counter.inc("a")
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc("b", amount=2.5)
+
+    assert registry.render().splitlines() == [
+        "# HELP things_total Things",
+        "# TYPE things_total counter",
+        'things_total{kind="a"} 4000',
+        'things_total{kind="b"} 2.5',
+    ]
+
+
+def test_gauge_can_go_down_in_another_shard(registry):
+    gauge = registry.gauge("busy", "Busy workers")
+    gauge.inc()
+    gauge.inc()
+    thread = threading.Thread(target=gauge.dec)
+    thread.start()
+    thread.join()
+
+    assert "busy 1" in registry.render().splitlines()
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    histogram = registry.histogram("latency_seconds", "Latency", ("step",), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, 0)
+
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{step="0",le="0.1"} 2',
+        'latency_seconds_bucket{step="0",le="1"} 3',
+        'latency_seconds_bucket{step="0",le="+Inf"} 4',
+        'latency_seconds_sum{step="0"} 3.65',
+        'latency_seconds_count{step="0"} 4',
+    ]
+
+
+def test_collectors_are_read_on_every_scrape(registry):
+    hits = {"n": 0}
+    registry.add_collector(lambda: [("cache_hits_total", "counter", "Hits", [({"cache": "llm"}, hits["n"])])])
+
+    assert 'cache_hits_total{cache="llm"} 0' in registry.render()
+    hits["n"] = 7
+    assert 'cache_hits_total{cache="llm"} 7' in registry.render()
+
+
+def test_a_failing_collector_does_not_break_the_scrape(registry):
+    registry.counter("ok_total", "Still here").inc()
+
+    def broken():
+        raise RuntimeError("stats unavailable")
+
+    registry.add_collector(broken)
+    text = registry.render()
+
+    assert "ok_total 1" in text
+    assert "# collector failed: stats unavailable" in text
+
+
+def test_label_values_are_escaped():
+    assert format_labels({"path": 'a\\b"c\nd'}) == '{path="a\\\\b\\"c\\nd"}'
+    assert format_labels({}) == ""
+    assert format_value(3.0) == "3" and format_value(0.25) == "0.25"
+
+
+def test_track_request_records_status_and_in_flight():
+    from src.core.metrics import registry
+
+    class Rejected(Exception):
+        status_code = 429
+
+    def run(exc):
+        try:
+            with track_request("test-endpoint", 9):
+                if exc:
+                    raise exc
+        except BaseException:
+            pass
+
+    run(None)
+    run(Rejected())
+    run(ValueError("boom"))
+    run(asyncio.CancelledError())
+    text = registry.render()
+
+    for status in (200, 429, 500, 499):
+        assert f'dream_analyze_requests_total{{endpoint="test-endpoint",step="9",status="{status}"}} 1' in text
+    assert 'dream_analyze_in_flight{endpoint="test-endpoint"} 0' in text
+    assert 'dream_analyze_stage_seconds_count{step="9",stage="total"} 4' in text
+    # only the unexpected failure is counted as an error here
+    assert 'dream_analyze_errors_total{type="ValueError"}' in text
+    assert 'dream_analyze_errors_total{type="Rejected"}' not in text
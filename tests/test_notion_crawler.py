@@ -0,0 +1,121 @@
+import datetime
+
+import pytest
+import requests
+
+from src.services.notion_crawler import NotionCrawler, url_expired
+from src.services.notion_sync_state import NotionSyncState
+
+
+def iso(seconds_from_now: float) -> str:
+    moment = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=seconds_from_now)
+    return moment.isoformat().replace("+00:00", "Z")
+
+
+def hosted_file_block(url: str, expiry_time: str, edited: str = "2024-01-01T00:00:00.000Z") -> dict:
+    return {
+        "id": "block-1",
+        "type": "file",
+        "last_edited_time": edited,
+        "file": {"type": "file", "file": {"url": url, "expiry_time": expiry_time}},
+    }
+
+
+class FakeResponse:
+    def __init__(self, body: bytes = b"%PDF-1.4 test", status: int = 200):
+        self.body = body
+        self.status_code = status
+        self.headers = {"ETag": '"abc"', "Content-Length": str(len(body))}
+
+    def iter_content(self, chunk_size):
+        yield self.body
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture
+def crawler(monkeypatch):
+    crawler = NotionCrawler("token", rate=100)
+    crawler.opened = []
+    crawler.fetched = []
+    crawler.refused = set()
+
+    def open_download(url):
+        crawler.opened.append(url)
+        if url in crawler.refused:
+            error = requests.HTTPError("403 Forbidden")
+            error.response = FakeResponse(status=403)
+            raise error
+        return FakeResponse()
+
+    def notion_get(path, params=None):
+        crawler.fetched.append(path)
+        return hosted_file_block("https://files.notion/fresh.pdf", iso(3600))
+
+    monkeypatch.setattr(crawler, "_open_download", open_download)
+    monkeypatch.setattr(crawler, "_notion_get", notion_get)
+    return crawler
+
+
+def test_url_expired():
+    assert url_expired(iso(-10))
+    assert url_expired(iso(30))  # about to expire
+    assert not url_expired(iso(3600))
+    assert url_expired(None) and url_expired("not a date")
+
+
+def test_valid_url_is_downloaded_as_is(crawler, tmp_path):
+    block = hosted_file_block("https://files.notion/a.pdf", iso(3600))
+    path, downloaded = crawler._sync_file(block, "https://files.notion/a.pdf", str(tmp_path), None)
+
+    assert downloaded and open(path, "rb").read() == b"%PDF-1.4 test"
+    assert crawler.opened == ["https://files.notion/a.pdf"]
+    assert crawler.fetched == []
+
+
+def test_expired_url_of_a_reused_block_is_refreshed(crawler, tmp_path):
+    # the block comes from the sync state of a crawl made hours ago
+    block = hosted_file_block("https://files.notion/old.pdf", iso(-7200))
+    crawler._sync_file(block, "https://files.notion/old.pdf", str(tmp_path), None)
+
+    assert crawler.fetched == ["/blocks/block-1"]
+    assert crawler.opened == ["https://files.notion/fresh.pdf"]
+
+
+def test_refused_url_is_retried_with_a_fresh_one(crawler, tmp_path):
+    crawler.refused.add("https://files.notion/a.pdf")
+    block = hosted_file_block("https://files.notion/a.pdf", iso(3600))
+    path, downloaded = crawler._sync_file(block, "https://files.notion/a.pdf", str(tmp_path), None)
+
+    assert downloaded
+    assert crawler.opened == ["https://files.notion/a.pdf", "https://files.notion/fresh.pdf"]
+
+
+def test_external_links_are_never_refreshed(crawler, tmp_path):
+    crawler.refused.add("https://example.com/a.pdf")
+    block = {"id": "block-2", "type": "file", "file": {"type": "external", "external": {"url": "https://example.com/a.pdf"}}}
+
+    with pytest.raises(requests.HTTPError):
+        crawler._sync_file(block, "https://example.com/a.pdf", str(tmp_path), None)
+    assert crawler.fetched == []
+
+
+def test_failed_download_recovers_on_the_next_run(crawler, tmp_path):
+    state = NotionSyncState(str(tmp_path / "state.db"))
+    block = hosted_file_block("https://files.notion/old.pdf", iso(-7200))
+    crawler.refused.add("https://files.notion/fresh.pdf")
+
+    assert crawler.download_pdfs([block], str(tmp_path / "raw"), state=state) == {}
+    assert state.get_file("block-1") is None
+
+    crawler.refused.clear()
+    paths = crawler.download_pdfs([block], str(tmp_path / "raw"), state=state)
+    assert list(paths) == ["block-1"]
+    assert state.get_file("block-1")[3] == paths["block-1"]
@@ -0,0 +1,150 @@
+import time
+
+from src.core.session_store import CachedSessionStore, SessionStore, format_step_entry
+
+
+# Backend that only records what it was asked to write
+class RecordingStore(SessionStore):
+    def __init__(self, sessions: dict = None):
+        self.sessions = sessions or {}
+        self.calls = []
+        self.closed = False
+
+    def load(self, user_id, dream_id):
+        self.calls.append(("load", user_id, dream_id))
+        return dict(self.sessions.get((user_id, dream_id), {}))
+
+    def save(self, user_id, dream_id, context):
+        self.calls.append(("save", user_id, dream_id))
+        self.sessions[(user_id, dream_id)] = dict(context)
+
+    def append_step(self, user_id, dream_id, step, response):
+        self.calls.append(("append_step", user_id, dream_id, step))
+        context = self.sessions.setdefault((user_id, dream_id), {})
+        context["convo_context"] = context.get("convo_context", "") + format_step_entry(step, response)
+
+    def close(self):
+        self.closed = True
+
+    def writes(self):
+        return [call for call in self.calls if call[0] != "load"]
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+# ================================
+# CachedSessionStore
+# ================================
+def test_cached_store_writes_back_only_on_flush():
+    backend = RecordingStore()
+    store = CachedSessionStore(backend, flush_interval=0)
+
+    store.save("u", "d", {"convo_context": "hola"})
+    store.append_step("u", "d", 1, "respuesta")
+
+    assert backend.writes() == []
+    assert store.load("u", "d")["convo_context"] == "hola" + format_step_entry(1, "respuesta")
+    assert store.stats()["dirty"] == 1
+
+    store.flush()
+    # the pending full save already includes the appended step, so it's written once
+    assert backend.writes() == [("save", "u", "d")]
+    assert backend.sessions[("u", "d")]["convo_context"] == "hola" + format_step_entry(1, "respuesta")
+    assert store.stats()["dirty"] == 0
+
+
+def test_cached_store_flushes_appends_as_appends():
+    backend = RecordingStore({("u", "d"): {"convo_context": "hola"}})
+    store = CachedSessionStore(backend, flush_interval=0)
+
+    store.append_step("u", "d", 1, "uno")
+    store.append_step("u", "d", 2, "dos")
+    store.flush()
+
+    assert backend.writes() == [("append_step", "u", "d", 1), ("append_step", "u", "d", 2)]
+    assert backend.sessions[("u", "d")]["convo_context"] == (
+        "hola" + format_step_entry(1, "uno") + format_step_entry(2, "dos")
+    )
+
+
+def test_cached_store_serves_reads_from_memory():
+    backend = RecordingStore({("u", "d"): {"convo_context": "hola"}})
+    store = CachedSessionStore(backend, flush_interval=0)
+
+    first = store.load("u", "d")
+    first["convo_context"] = "changed by the caller"
+    second = store.load("u", "d")
+
+    assert second["convo_context"] == "hola"
+    assert [call for call in backend.calls if call[0] == "load"] == [("load", "u", "d")]
+    assert store.stats()["hits"] == 1 and store.stats()["misses"] == 1
+
+
+def test_cached_store_background_flusher_writes_dirty_sessions():
+    backend = RecordingStore()
+    store = CachedSessionStore(backend, flush_interval=0.05)
+    try:
+        store.save("u", "d", {"convo_context": "hola"})
+        assert wait_until(lambda: ("u", "d") in backend.sessions)
+        assert wait_until(lambda: store.stats()["dirty"] == 0)
+    finally:
+        store.close()
+
+
+def test_cached_store_writes_dirty_session_when_evicted():
+    backend = RecordingStore()
+    store = CachedSessionStore(backend, max_entries=2, flush_interval=0)
+
+    store.save("u", "a", {"convo_context": "a"})
+    store.save("u", "b", {"convo_context": "b"})
+    assert backend.writes() == []
+
+    store.save("u", "c", {"convo_context": "c"})  # pushes "a" out of the cache
+
+    assert backend.writes() == [("save", "u", "a")]
+    assert backend.sessions[("u", "a")] == {"convo_context": "a"}
+    assert store.stats()["dirty_evictions"] == 1
+    # evicted sessions are loaded again from the backend
+    assert store.load("u", "a") == {"convo_context": "a"}
+
+
+def test_cached_store_close_flushes_and_closes_backend():
+    backend = RecordingStore()
+    store = CachedSessionStore(backend, flush_interval=60)
+
+    store.save("u", "d", {"convo_context": "hola"})
+    store.close()
+
+    assert backend.sessions[("u", "d")] == {"convo_context": "hola"}
+    assert backend.closed
+    assert not store._flusher.is_alive()
+
+
+def test_cached_store_keeps_failed_writes_dirty():
+    class FailingOnce(RecordingStore):
+        failed = False
+
+        def save(self, user_id, dream_id, context):
+            if not self.failed:
+                self.failed = True
+                raise OSError("disk full")
+            super().save(user_id, dream_id, context)
+
+    backend = FailingOnce()
+    store = CachedSessionStore(backend, flush_interval=0)
+
+    store.save("u", "d", {"convo_context": "hola"})
+    store.flush()
+    assert store.stats()["dirty"] == 1
+
+    store.flush()
+    assert backend.sessions[("u", "d")] == {"convo_context": "hola"}
+    assert store.stats()["dirty"] == 0
+
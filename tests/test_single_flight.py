@@ -0,0 +1,85 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from src.core.single_flight import SingleFlight
+
+
+def test_do_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def slow():
+        calls.append(1)
+        release.wait(2)
+        return "answer"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("key", slow))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    # let every thread join the call before it finishes
+    deadline = time.monotonic() + 2
+    while flight.stats()["coalesced"] < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1]
+    assert results == ["answer"] * 5
+    assert flight.stats() == {"calls": 1, "coalesced": 4, "in_flight": 0}
+
+
+def test_do_shares_the_exception_and_forgets_the_key():
+    flight = SingleFlight()
+
+    def failing():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        flight.do("key", failing)
+    # nothing is cached: the next call runs again
+    assert flight.do("key", lambda: "ok") == "ok"
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_ado_coalesces_concurrent_calls():
+    async def main():
+        flight = SingleFlight()
+        calls = []
+
+        async def slow():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "answer"
+
+        results = await asyncio.gather(*(flight.ado("key", slow) for _ in range(5)))
+        other = await flight.ado("other", slow)
+        return calls, results, other, flight.stats()
+
+    calls, results, other, stats = asyncio.run(main())
+    assert calls == [1, 1]
+    assert results == ["answer"] * 5 and other == "answer"
+    assert stats == {"calls": 2, "coalesced": 4, "in_flight": 0}
+
+
+def test_ado_call_survives_the_caller_that_started_it():
+    async def main():
+        flight = SingleFlight()
+
+        async def slow():
+            await asyncio.sleep(0.05)
+            return "answer"
+
+        first = asyncio.ensure_future(flight.ado("key", slow))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(flight.ado("key", slow))
+        await asyncio.sleep(0)
+        first.cancel()  # e.g. the client that sent the first request disconnected
+        return await second
+
+    assert asyncio.run(main()) == "answer"
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from src.core.symbol_lexicon import SymbolLexicon, normalize_word, tokenize
+
+
+@pytest.fixture(scope="module")
+def lexicon():
+    return SymbolLexicon()
+
+
+@pytest.mark.parametrize(
+    "singular, plural",
+    [
+        ("ave", "aves"),
+        ("padre", "padres"),
+        ("casa", "casas"),
+        ("flor", "flores"),
+        ("pez", "peces"),
+        ("león", "leones"),
+        ("árbol", "árboles"),
+        ("bebé", "bebés"),
+        ("autobús", "autobuses"),
+        ("pie", "pies"),
+        ("noche", "noches"),
+        ("ataque", "ataques"),
+        ("rey", "reyes"),
+    ],
+)
+def test_singular_and_plural_normalize_the_same(singular, plural):
+    assert normalize_word(singular) == normalize_word(plural)
+
+
+def test_case_and_accents_are_ignored():
+    assert normalize_word("Árbol") == normalize_word("arbol") == normalize_word("ÁRBOLES")
+
+
+def test_tokenize_splits_on_anything_that_is_not_a_letter():
+    assert tokenize("¡Casas, ríos... y 3 peces!") == ["casa", "rio", "y", "pez"]
+
+
+@pytest.mark.parametrize(
+    "dream, symbol",
+    [
+        ("vi un ave enorme", "pájaro"),
+        ("vi unas aves enormes", "pájaro"),
+        ("hablaba con mi padre", "padre"),
+        ("hablaba con mis padres", "padre"),
+        ("unos bebés lloraban", "bebé"),
+        ("subí a dos autobuses", "autobús"),
+    ],
+)
+def test_terms_match_in_singular_and_plural(lexicon, dream, symbol):
+    assert symbol in lexicon.extract(dream)["symbols"]
+
+
+def test_symbols_come_in_order_of_appearance_without_duplicates(lexicon):
+    result = lexicon.extract("Una serpiente en el mar. Otra serpiente en la casa, junto al océano")
+    assert result["symbols"] == ["serpiente", "mar", "casa"]
+
+
+def test_phrases_are_matched_as_a_whole(lexicon):
+    assert "boda" in lexicon.extract("llevaba un vestido de novia")["symbols"]
+    # "vestido" alone is left out on purpose, it usually just means a dress
+    assert lexicon.extract("llevaba un vestido azul")["symbols"] == []
+    assert lexicon.extract("iba a perder el tren")["symbols"] == ["llegar tarde", "tren"]
+
+
+def test_coverage_ignores_stopwords(lexicon):
+    assert lexicon.extract("Soñé que estaba en el mar")["coverage"] == 1.0
+    assert lexicon.extract("mar azul")["coverage"] == 0.5
+    assert lexicon.extract("y de la") == {"symbols": [], "coverage": 0.0}
+
+
+def test_extra_symbols_are_added_from_a_file(tmp_path):
+    path = tmp_path / "extra.json"
+    path.write_text(json.dumps({"reloj": ["cronómetro"], "ballena": ["cachalote"]}), encoding="utf-8")
+    lexicon = SymbolLexicon(extra_path=str(path))
+
+    assert lexicon.extract("un cachalote con un cronómetro y un reloj")["symbols"] == ["ballena", "reloj"]
+
+
+def test_unreadable_extra_file_keeps_the_default_lexicon(tmp_path):
+    path = tmp_path / "extra.json"
+    path.write_text("{not json", encoding="utf-8")
+    assert SymbolLexicon(extra_path=str(path)).extract("el mar")["symbols"] == ["mar"]
+
+
+def test_stats():
+    lexicon = SymbolLexicon()
+    assert lexicon.stats() == {"answered": 0, "hinted": 0, "answered_rate": 0.0}
+    lexicon.count("answered")
+    lexicon.count("hinted")
+    lexicon.count("hinted")
+    assert lexicon.stats() == {"answered": 1, "hinted": 2, "answered_rate": 0.333}
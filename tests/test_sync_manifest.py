@@ -0,0 +1,119 @@
+import pytest
+
+from src.services.sync_manifest import SyncManifest, generate_chunk_ids, get_doc_hash
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    return SyncManifest(str(tmp_path / "manifest.db"))
+
+
+def chunks_of(doc_id: str, texts: list) -> dict:
+    return {chunk_id: get_doc_hash(text) for chunk_id, text in zip(generate_chunk_ids(doc_id, texts), texts)}
+
+
+def sync(manifest: SyncManifest, doc_id: str, texts: list, model: str = "m") -> tuple:
+    """What embed_documents.py does for one doc, with every chunk upserted."""
+    chunks = chunks_of(doc_id, texts)
+    to_embed, removed = manifest.diff_doc(doc_id, model, chunks)
+    manifest.plan_doc(doc_id, get_doc_hash("".join(texts)), model, chunks, to_embed)
+    manifest.mark_upserted(list(to_embed))
+    return to_embed, removed
+
+
+def test_chunk_ids_depend_on_the_text_not_the_position():
+    ids = generate_chunk_ids("doc", ["uno", "dos", "tres"])
+    moved = generate_chunk_ids("doc", ["cero", "uno", "dos", "tres"])
+
+    assert moved[1:] == ids
+    assert all(chunk_id.startswith("doc::") for chunk_id in ids)
+    assert generate_chunk_ids("other", ["uno"])[0] != ids[0]
+
+
+def test_repeated_chunks_get_a_counter():
+    ids = generate_chunk_ids("doc", ["igual", "igual", "otro", "igual"])
+    assert ids[1] == ids[0] + "-2" and ids[3] == ids[0] + "-3"
+    assert len(set(ids)) == 4
+
+
+def test_new_doc_embeds_every_chunk(manifest):
+    chunks = chunks_of("doc", ["a", "b"])
+    assert manifest.diff_doc("doc", "m", chunks) == (set(chunks), set())
+
+
+def test_editing_one_paragraph_only_embeds_that_chunk(manifest):
+    sync(manifest, "doc", ["intro", "agua", "fuego"])
+    to_embed, removed = sync(manifest, "doc", ["intro", "agua del mar", "fuego"])
+
+    old, new = generate_chunk_ids("doc", ["agua"])[0], generate_chunk_ids("doc", ["agua del mar"])[0]
+    assert to_embed == {new}
+    assert removed == {old}
+    assert manifest.stale_chunk_ids() == [old]
+
+
+def test_unchanged_doc_has_nothing_to_do(manifest):
+    sync(manifest, "doc", ["intro", "agua"])
+    assert manifest.diff_doc("doc", "m", chunks_of("doc", ["intro", "agua"])) == (set(), set())
+
+
+def test_a_new_embedding_model_embeds_everything_again(manifest):
+    sync(manifest, "doc", ["intro", "agua"])
+    to_embed, _ = manifest.diff_doc("doc", "new-model", chunks_of("doc", ["intro", "agua"]))
+    assert len(to_embed) == 2
+
+
+def test_a_crash_resumes_from_the_last_checkpoint(manifest, tmp_path):
+    chunks = chunks_of("doc", ["a", "b", "c", "d"])
+    ids = list(chunks)
+    manifest.plan_doc("doc", "hash-1", "m", chunks, set(ids))
+    manifest.mark_upserted(ids[:2])  # first upsert batch, then the sync dies
+
+    reopened = SyncManifest(str(tmp_path / "manifest.db"))
+    assert not reopened.is_doc_synced("doc", "hash-1")
+    to_embed, _ = reopened.diff_doc("doc", "m", chunks)
+    assert to_embed == set(ids[2:])
+
+    reopened.plan_doc("doc", "hash-1", "m", chunks, to_embed)
+    reopened.mark_upserted(ids[2:])
+    assert reopened.is_doc_synced("doc", "hash-1")
+    assert reopened.stats() == {"docs": {"complete": 1}, "chunks": {"upserted": 4}}
+
+
+def test_doc_with_nothing_to_embed_is_complete_right_away(manifest):
+    chunks = chunks_of("doc", ["a"])
+    manifest.plan_doc("doc", "hash-1", "m", chunks, set(chunks))
+    manifest.mark_upserted(list(chunks))
+    # edited, but only a chunk was removed
+    manifest.plan_doc("doc", "hash-2", "m", {}, set())
+    assert manifest.is_doc_synced("doc", "hash-2")
+    assert manifest.stale_chunk_ids() == list(chunks)
+
+
+def test_dry_run_diff_leaves_the_manifest_untouched(manifest):
+    sync(manifest, "doc", ["intro", "agua"])
+    before = manifest.stats()
+
+    to_embed, removed = manifest.diff_doc("doc", "m", chunks_of("doc", ["intro", "fuego"]))
+
+    assert len(to_embed) == 1 and len(removed) == 1
+    assert manifest.stats() == before
+    assert manifest.stale_chunk_ids() == []
+
+
+def test_deleted_docs_are_removed_in_one_go(manifest):
+    sync(manifest, "keep", ["a"])
+    sync(manifest, "gone", ["b", "c"])
+    sync(manifest, "keep", ["a2"])
+    # the chunks of "gone" that were planned but never checkpointed are deleted too
+    gone_ids = generate_chunk_ids("gone", ["b", "c", "d"])
+    manifest.plan_doc("gone", "hash-3", "m", chunks_of("gone", ["b", "c", "d"]), {gone_ids[2]})
+
+    deleted_docs = manifest.doc_ids() - {"keep"}
+    delete_ids = manifest.stale_chunk_ids() + manifest.chunk_ids_of_docs(deleted_docs)
+    assert deleted_docs == {"gone"}
+    assert sorted(delete_ids) == sorted(generate_chunk_ids("keep", ["a"]) + gone_ids)
+
+    manifest.forget(delete_ids, deleted_docs)
+    assert manifest.doc_ids() == {"keep"}
+    assert manifest.stale_chunk_ids() == []
+    assert manifest.stats()["chunks"] == {"upserted": 1}